@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+import os, json, time, random, argparse, tempfile, shutil, subprocess, platform
+from PreProcessUtils import str2bool
+
+# Offline benchmark of the preprocessing pipeline. A synthetic corpus with the
+# layout of CORD19 v19 (metadata.csv and nested <subset>/<subset>/pdf_json and
+# pmc_json folders) is generated with controlled paper sizes and language mix,
+# PreProcess_v19.main is run on it end to end (by default with blank spaCy
+# pipelines and the offline translation stub) and the throughput, memory and
+# stage timings are written as JSON, so that two commits can be compared.
+
+SUBSETS = ["comm_use_subset", "noncomm_use_subset", "custom_license", "biorxiv_medrxiv"]
+
+ENGLISH_WORDS = ("the patients with severe acute respiratory syndrome coronavirus infection were treated "
+                 "in intensive care units viral load was measured by quantitative PCR and the binding of "
+                 "the spike protein to the receptor was analysed in cell lines mice and ferrets fever cough "
+                 "and pneumonia were the most common symptoms of COVID-19 and SARS-CoV-2 transmission").split()
+ABBREVIATIONS = ["angiotensin converting enzyme 2 (ACE2)", "severe acute respiratory syndrome (SARS)",
+                 "Middle East respiratory syndrome (MERS)", "polymerase chain reaction (PCR)"]
+OTHER_WORDS = {
+    "es": ("los pacientes con infección por coronavirus fueron tratados en la unidad de cuidados intensivos "
+           "la carga viral se midió y la fiebre y la tos fueron los síntomas más frecuentes").split(),
+    "fr": ("les patients atteints de pneumonie ont été traités dans les services de réanimation la charge "
+           "virale a été mesurée et la fièvre et la toux étaient les symptômes les plus fréquents").split()}
+SECTION_NAMES = {"en": ["Introduction", "Methods", "Results", "Discussion", "Conclusions"],
+                 "es": ["Introducción", "Métodos", "Resultados", "Discusión"],
+                 "fr": ["Introduction", "Méthodes", "Résultats", "Discussion"]}
+
+
+def _sentence(rng, language):
+    words = ENGLISH_WORDS if language == "en" else OTHER_WORDS[language]
+    sentence = [rng.choice(words) for _ in range(rng.randint(8, 30))]
+    if language == "en" and rng.random() < 0.2:
+        sentence.insert(rng.randint(0, len(sentence)), rng.choice(ABBREVIATIONS))
+    #capitalize() would also lower the abbreviations
+    sentence = " ".join(sentence)
+    return sentence[0].upper() + sentence[1:] + "."
+
+def synthetic_paragraph(rng, language, n_words):
+    sentences = []
+    while sum(len(s.split()) for s in sentences) < n_words:
+        sentences.append(_sentence(rng, language))
+    return " ".join(sentences)
+
+def _paper(rng, paper_id, language, n_sections, words_per_section, n_ref_entries, huge_section_words):
+    sections = [{"text": synthetic_paragraph(rng, language, rng.randint(*words_per_section)),
+                 "section": rng.choice(SECTION_NAMES[language]), "cite_spans": [], "ref_spans": []}
+                for _ in range(n_sections)]
+    if huge_section_words:
+        #supplementary tables dumped as text
+        sections.append({"text": synthetic_paragraph(rng, language, huge_section_words), "section": "Supplementary",
+                         "cite_spans": [], "ref_spans": []})
+    abstract = [{"text": synthetic_paragraph(rng, language, rng.randint(80, 250)), "section": "Abstract",
+                 "cite_spans": [], "ref_spans": []} for _ in range(rng.randint(0, 2))]
+    ref_entries = {"FIGREF{}".format(i): {"text": _sentence(rng, language), "type": "figure"} for i in range(n_ref_entries)}
+    return {"paper_id": paper_id, "metadata": {"title": _sentence(rng, language), "authors": []},
+            "abstract": abstract, "body_text": sections, "bib_entries": {}, "ref_entries": ref_entries,
+            "back_matter": []}
+
+def generate_corpus(root, n_papers=200, sections=(3, 12), words_per_section=(50, 400), ref_entries=(0, 5),
+                    language_mix=None, pmc_ratio=0.3, huge_section_ratio=0.0, huge_section_words=20000, seed=0):
+    """
+    Write a synthetic CORD19 v19 tree to root. language_mix maps a language
+    ("en", "es", "fr") to its share of the papers. A pmc_ratio share of the
+    papers also gets a PMC parse of the same text. Returns the number of files.
+    """
+    rng = random.Random(seed)
+    language_mix = language_mix or {"en": 0.9, "es": 0.05, "fr": 0.05}
+    languages, weights = zip(*language_mix.items())
+    rows = []
+    n_files = 0
+    for paper_nb in range(n_papers):
+        subset = SUBSETS[paper_nb % len(SUBSETS)]
+        language = rng.choices(languages, weights)[0]
+        sha = "{:040x}".format(rng.getrandbits(160))
+        pmcid = "PMC{}".format(1000000 + paper_nb) if rng.random() < pmc_ratio else ""
+        huge = huge_section_words if rng.random() < huge_section_ratio else 0
+        paper = _paper(rng, sha, language, rng.randint(*sections), words_per_section, rng.randint(*ref_entries), huge)
+        parses = [("pdf_json", sha + ".json", paper)]
+        if pmcid:
+            parses.append(("pmc_json", pmcid + ".xml.json", dict(paper, paper_id=pmcid)))
+        for folder, name, content in parses:
+            path = os.path.join(root, subset, subset, folder)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            with open(os.path.join(path, name), "w", encoding="utf-8") as f:
+                json.dump(content, f, ensure_ascii=False)
+            n_files += 1
+        rows.append({"cord_uid": "uid{:06d}".format(paper_nb), "sha": sha, "source_x": "synthetic",
+                     "title": paper["metadata"]["title"], "pmcid": pmcid, "full_text_file": subset,
+                     "has_pdf_parse": True, "has_pmc_xml_parse": bool(pmcid)})
+    import pandas as pd
+    pd.DataFrame(rows).to_csv(os.path.join(root, "metadata.csv"), index=False)
+    return n_files
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def run_benchmark(corpus_path, work_dir, pipeline_args):
+    #run the whole pipeline in a fresh working directory and summarize the run
+    from PreProcess_v19 import main
+    old_cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        summary = main(["--CORD19_path", os.path.abspath(corpus_path), "--resume", "False",
+                        "--discovery_cache", "False"] + pipeline_args)
+    finally:
+        os.chdir(old_cwd)
+
+    reports = summary["worker_reports"]
+    n_papers = sum(report["n_papers"] for report in reports)
+    n_sentences = sum(report["n_sentences"] for report in reports)
+    nlp_s = summary["timings"]["nlp_s"]
+    stage_metrics = summary["stage_metrics"] or {}
+    workers = {}
+    for report in reports:
+        worker = workers.setdefault(report["pid"], {"pid": report["pid"], "n_tasks": 0, "n_papers": 0, "peak_rss_gib": 0.0})
+        worker["n_tasks"] += 1
+        worker["n_papers"] += report["n_papers"]
+        worker["peak_rss_gib"] = max(worker["peak_rss_gib"], report["peak_rss_gib"] or 0.0)
+    return {"commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+            "pipeline_args": pipeline_args,
+            "planning": summary["planning"],
+            "metrics": {"n_workers": summary["n_workers"],
+                        "n_files": summary["n_files"],
+                        "n_papers": n_papers,
+                        "n_sentences": n_sentences,
+                        "n_failed_files": len(summary["failed_files"]),
+                        "papers_per_s": n_papers / nlp_s if nlp_s else None,
+                        "sentences_per_s": n_sentences / nlp_s if nlp_s else None,
+                        "max_worker_peak_rss_gib": max([w["peak_rss_gib"] for w in workers.values()] or [0.0])},
+            "stages": summary["timings"],
+            "pipeline_stages": stage_metrics.get("stage_totals_s", {}),
+            "paper_latency_s": stage_metrics.get("latency_s", {}),
+            "workers": list(workers.values())}
+
+def check_output(work_dir, results):
+    """
+    Smoke test of a run: no file lost with a crashed worker, every file
+    annotated and every written paper readable back. Returns the problems.
+    """
+    from ShardStore import ShardReader, SHARD_FOLDER
+    metrics = results["metrics"]
+    problems = []
+    if metrics["n_failed_files"]:
+        problems.append("{} files failed".format(metrics["n_failed_files"]))
+    if metrics["n_papers"] != metrics["n_files"]:
+        problems.append("{} of {} files annotated".format(metrics["n_papers"], metrics["n_files"]))
+    folder = os.path.join(work_dir, "preprocessed")
+    shard_folder = os.path.join(folder, SHARD_FOLDER)
+    n_written = 0
+    try:
+        if os.path.exists(shard_folder):
+            for paper in ShardReader(shard_folder).iter_papers():
+                n_written += "paper_id" in paper
+        else:
+            for name in os.listdir(folder):
+                if name.endswith(".json"):
+                    with open(os.path.join(folder, name), encoding="utf-8") as f:
+                        n_written += "paper_id" in json.load(f)
+    except (ValueError, OSError) as e:
+        problems.append("unreadable output: {}".format(e))
+    if n_written != metrics["n_papers"]:
+        problems.append("{} papers written for {} annotated".format(n_written, metrics["n_papers"]))
+    return problems
+
+def compare_results(old, new):
+    #relative change of every metric and stage timing of two benchmark results
+    print("       {:<28} {:>12} {:>12} {:>8}".format("", "old", "new", "change"))
+    for group in ("metrics", "stages", "pipeline_stages"):
+        for key, new_value in new.get(group, {}).items():
+            old_value = old.get(group, {}).get(key)
+            if not isinstance(new_value, (int, float)) or not isinstance(old_value, (int, float)):
+                continue
+            change = "{:+.1%}".format((new_value - old_value) / old_value) if old_value else "n/a"
+            print("       {:<28} {:>12.3f} {:>12.3f} {:>8}".format(key, old_value, new_value, change))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline benchmark of the CORD19 preprocessing pipeline on a synthetic corpus.',
+                                     epilog='Any other argument is passed on to PreProcess_v19 (e.g. --batch_size 64).')
+    parser.add_argument('--n_papers', type=int, default=None, help='Number of synthetic papers. Default 200, 20 with --smoke')
+    parser.add_argument('--words_per_section', type=int, nargs=2, default=[50, 400], help='Range of words per section. Default 50 400')
+    parser.add_argument('--non_english', type=float, default=0.1, help='Share of Spanish and French papers. Default 0.1')
+    parser.add_argument('--huge_sections', type=float, default=0.0, help='Share of papers with a huge supplementary section. Default 0')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus', type=str, default=None,
+                        help='Existing corpus to use (or where to keep the generated one). Default: a temporary folder')
+    parser.add_argument('--real_models', type=str2bool, default=False, nargs='?', const=True,
+                        help="Use the SciSpacy models and the configured translation backend instead of the stubs. Default False")
+    parser.add_argument('--output', type=str, default="benchmark_results.json", help='Where to write the results. Default benchmark_results.json')
+    parser.add_argument('--compare', type=str, default=None, help='Earlier results file to compare with.')
+    parser.add_argument('--smoke', type=str2bool, default=False, nargs='?', const=True,
+                        help="Check that the run annotated every paper and wrote readable output, exit with an error otherwise. Default False")
+    args, pipeline_args = parser.parse_known_args()
+    if args.n_papers is None:
+        args.n_papers = 20 if args.smoke else 200
+
+    if not args.real_models:
+        pipeline_args = ["--stub_models", "True", "--translation_backend", "stub"] + pipeline_args
+
+    temp_dir = tempfile.mkdtemp(prefix="cord19_benchmark_")
+    corpus_path = args.corpus or os.path.join(temp_dir, "corpus")
+    if not os.path.exists(os.path.join(corpus_path, "metadata.csv")):
+        generate_corpus(corpus_path, args.n_papers, words_per_section=tuple(args.words_per_section),
+                        language_mix={"en": 1 - args.non_english, "es": args.non_english / 2, "fr": args.non_english / 2},
+                        huge_section_ratio=args.huge_sections, seed=args.seed)
+    work_dir = os.path.join(temp_dir, "work")
+    os.makedirs(work_dir)
+
+    results = run_benchmark(corpus_path, work_dir, pipeline_args)
+    problems = check_output(work_dir, results) if args.smoke else []
+    shutil.rmtree(temp_dir)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results["metrics"], indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
+    if args.smoke:
+        print("Smoke run {}".format("failed: " + "; ".join(problems) if problems else "passed"))
+        if problems:
+            raise SystemExit(1)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import os, json, math, time
+from collections import defaultdict
+from contextlib import contextmanager
+from psutil import Process
+
+# Per-stage timing of the pipeline. Every worker appends one JSON line per paper
+# to preprocessed/metrics/<run_id>_<pid>.jsonl with the time spent in each stage,
+# the time its reading and writing took in the I/O threads, the paper latency
+# and, every few papers, the RSS of the worker. The main
+# process aggregates the files of its run at the end. Stages can be nested
+# (UMLS linking runs inside the spaCy parse): the time of a nested stage is
+# subtracted from the enclosing one, so the stage times of a paper add up.
+METRICS_FOLDER = "metrics"
+
+STAGES = ["json_load", "language_detection", "translation", "abbreviation_detection", "parsing", "abbreviation_reparse",
+          "umls_linking", "sentence_features", "ner", "output"]
+
+
+class StageTimer:
+
+    def __init__(self):
+        self.paper_stages = defaultdict(float)
+        #time spent in nested stages, one entry per open stage
+        self._children = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._children.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            children = self._children.pop()
+            self.paper_stages[name] += elapsed - children
+            if self._children:
+                self._children[-1] += elapsed
+
+    def start_paper(self):
+        self.paper_stages = defaultdict(float)
+        self.paper_start = time.perf_counter()
+
+    def end_paper(self):
+        return time.perf_counter() - self.paper_start, dict(self.paper_stages)
+
+
+class TimedComponent:
+    #wraps a spaCy pipeline component to time it as a stage of its own,
+    #with the timer of the process that runs it (the models can be forked)
+    def __init__(self, component, stage_name):
+        self.component = component
+        self.stage_name = stage_name
+        self.name = getattr(component, "name", stage_name)
+
+    def __call__(self, doc):
+        with get_timer().stage(self.stage_name):
+            return self.component(doc)
+
+
+class MetricsWriter:
+
+    def __init__(self, folder, run_id, sample_every=10):
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, "{}_{}.jsonl".format(run_id, os.getpid()))
+        self.sample_every = sample_every
+        self.n_papers = 0
+        self.process = Process()
+        self.records = []
+
+    def record(self, record):
+        self.n_papers += 1
+        if self.n_papers % self.sample_every == 1 or self.sample_every == 1:
+            #memory_info is cheap, unlike the unique memory of memory_full_info
+            record["rss_gib"] = self.process.memory_info().rss/1024**3
+        record["pid"] = os.getpid()
+        self.records.append(json.dumps(record))
+
+    def flush(self):
+        if self.records:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(self.records) + "\n")
+            self.records = []
+
+
+_timers = {}
+_writers = {}
+
+def get_timer():
+    if os.getpid() not in _timers:
+        _timers[os.getpid()] = StageTimer()
+    return _timers[os.getpid()]
+
+def get_metrics_writer(folder, run_id):
+    key = (os.getpid(), folder, run_id)
+    if key not in _writers:
+        _writers[key] = MetricsWriter(folder, run_id)
+    return _writers[key]
+
+def instrument_component(nlp, component, stage_name):
+    #replace the component in the spaCy pipeline by its timed wrapper, once
+    for name, pipe in nlp.pipeline:
+        if pipe is component:
+            nlp.replace_pipe(name, TimedComponent(component, stage_name))
+            return
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def aggregate_metrics(folder, run_id, n_slowest=10):
+    """
+    Read the metrics of all workers of a run: stage totals and shares, paper
+    latency percentiles and histogram (power-of-two buckets in seconds), the
+    slowest papers and the RSS samples of every worker.
+    """
+    records = []
+    if os.path.exists(folder):
+        for name in os.listdir(folder):
+            if name.startswith(run_id + "_") and name.endswith(".jsonl"):
+                with open(os.path.join(folder, name), encoding="utf-8") as f:
+                    records.extend(json.loads(line) for line in f if line.strip())
+    stage_totals = defaultdict(float)
+    io_totals = defaultdict(float)
+    for record in records:
+        for stage, seconds in record["stages"].items():
+            stage_totals[stage] += seconds
+        for stage, seconds in record.get("io_s", {}).items():
+            io_totals[stage] += seconds
+    total = sum(stage_totals.values())
+    #the reader and writer threads work while the NLP runs, the NLP only waits for them
+    #in json_load and output: the rest of their time is hidden behind the NLP
+    io_overlap = {"read_s": io_totals["read"], "read_wait_s": stage_totals.get("json_load", 0.0),
+                  "write_s": io_totals["write"], "write_wait_s": stage_totals.get("output", 0.0)}
+    io_overlap["hidden_s"] = (max(0.0, io_overlap["read_s"] - io_overlap["read_wait_s"]) +
+                              max(0.0, io_overlap["write_s"] - io_overlap["write_wait_s"]))
+    latencies = sorted(record["latency_s"] for record in records)
+    histogram = defaultdict(int)
+    for latency in latencies:
+        histogram["<{:g}s".format(2 ** math.ceil(math.log2(max(latency, 2 ** -10))))] += 1
+    rss = defaultdict(list)
+    for record in records:
+        if "rss_gib" in record:
+            rss[record["pid"]].append(record["rss_gib"])
+    slowest = sorted(records, key=lambda record: record["latency_s"], reverse=True)[:n_slowest]
+    return {"run_id": run_id,
+            "n_papers": len(records),
+            "stage_totals_s": dict(stage_totals),
+            "stage_shares": {stage: seconds / total for stage, seconds in stage_totals.items()} if total else {},
+            "io_overlap_s": io_overlap,
+            "latency_s": {"p50": _percentile(latencies, 0.5), "p90": _percentile(latencies, 0.9),
+                          "p99": _percentile(latencies, 0.99), "max": latencies[-1] if latencies else None},
+            "latency_histogram": dict(sorted(histogram.items(), key=lambda item: float(item[0][1:-1]))),
+            "slowest_papers": [{k: record[k] for k in ("paper_id", "path", "size", "latency_s", "stages")} for record in slowest],
+            "worker_rss_gib": {str(pid): {"samples": len(values), "max": max(values), "last": values[-1]} for pid, values in rss.items()}}
+
+def print_metrics_report(summary):
+    if not summary["n_papers"]:
+        return
+    print("\n       Stage breakdown over {} papers".format(summary["n_papers"]))
+    for stage in sorted(summary["stage_totals_s"], key=lambda stage: -summary["stage_totals_s"][stage]):
+        print("       {:<22} {:10.2f} s {:6.1%}".format(stage, summary["stage_totals_s"][stage], summary["stage_shares"][stage]))
+    io = summary["io_overlap_s"]
+    print("       reading {:.2f} s (NLP waited {:.2f} s), writing {:.2f} s (NLP waited {:.2f} s): {:.2f} s of I/O overlapped with the NLP".format(
+        io["read_s"], io["read_wait_s"], io["write_s"], io["write_wait_s"], io["hidden_s"]))
+    latency = summary["latency_s"]
+    print("       paper latency: p50 {:.3f} s, p90 {:.3f} s, p99 {:.3f} s, max {:.3f} s".format(
+        latency["p50"], latency["p90"], latency["p99"], latency["max"]))
+    print("       latency histogram: " + ", ".join("{} {}".format(k, v) for k, v in summary["latency_histogram"].items()))
+    print("       slowest papers:")
+    for record in summary["slowest_papers"][:5]:
+        stage = max(record["stages"], key=record["stages"].get) if record["stages"] else "-"
+        print("       {:8.2f} s {} ({} bytes, mostly {})".format(record["latency_s"], record["path"], record["size"], stage))
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import os, json, time, sqlite3, hashlib, threading
+from PreProcessUtils import SCISPACY_MODELS
+
+# The manifest is a SQLite file next to the preprocessed output. Every worker
+# records each paper as soon as it is written, so a crashed or interrupted run
+# can be resumed just by starting it again.
+MANIFEST_NAME = "manifest.sqlite"
+
+_connections = {}
+
+
+def manifest_path(folder_name):
+    return os.path.join(folder_name, MANIFEST_NAME)
+
+# settings that change the output files, besides the model choices
+OUTPUT_SETTINGS = ["stub_models", "translation_backend", "sent2vec_mode", "output_format", "vector_store", "vector_dtype", "max_section_chars"]
+
+def config_hash(model_prefs_dict):
+    #only the models and the output format matter, not batch sizes etc.
+    prefs = sorted((k, v) for k, v in model_prefs_dict.items() if k in SCISPACY_MODELS or k in OUTPUT_SETTINGS)
+    return hashlib.sha1(json.dumps(prefs).encode("utf-8")).hexdigest()
+
+def content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+def file_sha(path_to_file):
+    #split on '.' instead of os.path.splitext because of the "xml.json" files
+    return os.path.basename(path_to_file).split('.')[0]
+
+def _connect(path):
+    #SQLite connections can't be shared between threads (e.g. the async writer of a worker)
+    key = (path, threading.get_ident())
+    if key not in _connections:
+        conn = sqlite3.connect(path, timeout=60)
+        #switching to WAL takes an exclusive lock without waiting for it, it is done once by init_manifest
+        if conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS papers (
+                            sha TEXT PRIMARY KEY,
+                            input_path TEXT,
+                            input_size INTEGER,
+                            input_mtime REAL,
+                            content_hash TEXT,
+                            config_hash TEXT,
+                            paper_id TEXT,
+                            output_path TEXT,
+                            completed_at REAL)""")
+        #run settings the next runs must keep, e.g. the duplicate policy
+        conn.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+        conn.commit()
+        _connections[key] = conn
+    return _connections[key]
+
+def close_manifest(path):
+    conn = _connections.pop((path, threading.get_ident()), None)
+    if conn is not None:
+        conn.close()
+
+def init_manifest(path):
+    #create the manifest before the workers start, so that they don't race to create it
+    _connect(path)
+    #the forked workers must not inherit the connection
+    close_manifest(path)
+
+def record_paper(path, path_to_file, content_digest, model_prefs_dict, paper_id, output_path):
+    #output_path is None for papers skipped by the pipeline (no text, unknown language)
+    stat = os.stat(path_to_file)
+    conn = _connect(path)
+    conn.execute("INSERT OR REPLACE INTO papers VALUES (?,?,?,?,?,?,?,?,?)",
+                 (file_sha(path_to_file), path_to_file, stat.st_size, stat.st_mtime,
+                  content_digest, config_hash(model_prefs_dict), paper_id, output_path, time.time()))
+    conn.commit()
+
+def record_setting(path, name, value):
+    conn = _connect(path)
+    conn.execute("INSERT OR REPLACE INTO settings VALUES (?,?)", (name, value))
+    conn.commit()
+    close_manifest(path)
+
+def load_setting(path, name):
+    #None when there is no manifest or it was written before the setting was recorded
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path, timeout=60)
+    try:
+        row = conn.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    conn.close()
+    return row[0] if row is not None else None
+
+def load_manifest(path):
+    #sha -> record, read once so that every lookup afterwards is a dict lookup
+    if not os.path.exists(path):
+        return {}
+    conn = sqlite3.connect(path, timeout=60)
+    rows = conn.execute("""SELECT sha, input_size, input_mtime, content_hash, config_hash, output_path
+                           FROM papers""").fetchall()
+    conn.close()
+    return {row[0]: {"input_size": row[1], "input_mtime": row[2], "content_hash": row[3],
+                     "config_hash": row[4], "output_path": row[5]} for row in rows}
+
+def existing_outputs(manifest):
+    #paths of the output files and shards that are on the disk,
+    #one directory listing per output folder instead of a stat per paper
+    folders = set(os.path.dirname(record["output_path"]) for record in manifest.values() if record["output_path"] is not None)
+    existing = set()
+    for folder in folders:
+        if os.path.isdir(folder):
+            with os.scandir(folder) as entries:
+                existing.update(entry.path for entry in entries)
+    return existing
+
+def is_up_to_date(record, path_to_file, file_size, file_mtime, current_config_hash, outputs):
+    #file_size and file_mtime come from the discovery scan, outputs from existing_outputs(),
+    #so that only a touched file costs a read
+    if record is None or record["config_hash"] != current_config_hash:
+        return False
+    if record["output_path"] is not None and record["output_path"] not in outputs:
+        return False
+    if record["input_size"] != file_size:
+        return False
+    if record["input_mtime"] == file_mtime:
+        return True
+    #touched but maybe not changed: compare the content
+    with open(path_to_file, "rb") as f:
+        return content_hash(f.read()) == record["content_hash"]
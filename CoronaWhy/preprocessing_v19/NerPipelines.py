@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import json, time, argparse
+
+# The four SciSpacy NER models come with a tagger and a parser, but the
+# pipeline only reads their entities (and their sentences when en_core_sci_lg
+# is off). In spaCy 2 every component has its own token features, so loading
+# the NER models without the components nobody reads leaves the entities as
+# they are. On top of that, the "shared" mode tokenizes each text once: the
+# NER models get Docs built from the tokens of the core model's sentences (or
+# of a single tokenizer pass) in their own vocab, so that each model still
+# uses its own vectors and labels. A run only uses the shared tokens once
+# they have given the same entities as the separate tokenizers on the first
+# papers of the corpus.
+NER_PIPELINES = ["full", "ner", "shared"]
+#paragraphs of the first papers the shared tokens are checked on
+SHARED_CHECK_TEXTS = 200
+
+
+def disabled_components(model_prefs_dict):
+    #the components of the NER models the pipeline doesn't read
+    mode = model_prefs_dict.get("ner_pipeline", "full")
+    if mode == "full":
+        return []
+    if model_prefs_dict["en_core_sci_lg"]:
+        return ["tagger", "parser"]
+    #without the core model the sentences come from the parsers of the NER models
+    return ["tagger"]
+
+def doc_from_tokens(vocab, tokens):
+    #a Doc of another model's vocab with the same tokens and text as a Doc or Span
+    from spacy.tokens import Doc
+    words = [token.text for token in tokens]
+    spaces = [bool(token.whitespace_) for token in tokens]
+    if spaces and hasattr(tokens, "start"):
+        #a span's text doesn't include the whitespace after its last token
+        spaces[-1] = False
+    return Doc(vocab, words=words, spaces=spaces)
+
+def pipe_components(nlp, docs, batch_size=None):
+    #run the components of nlp on docs that are already tokenized
+    for name, proc in nlp.pipeline:
+        if batch_size and hasattr(proc, "pipe"):
+            docs = list(proc.pipe(docs, batch_size=batch_size))
+        else:
+            docs = [proc(doc) for doc in docs]
+    return list(docs)
+
+def ner_on_sentences(special_nlp, sentences, shared, batch_size=None, n_process=1):
+    #docs of a NER model for the sentence spans of the core model
+    from PreProcessUtils import pipe_texts
+    if shared:
+        return pipe_components(special_nlp, [doc_from_tokens(special_nlp.vocab, sentence) for sentence in sentences], batch_size)
+    texts = [str(sentence.text) for sentence in sentences]
+    if batch_size:
+        return pipe_texts(special_nlp, texts, batch_size, n_process)
+    return [special_nlp(text) for text in texts]
+
+def ner_on_texts(nlps, texts, shared, batch_size=None, n_process=1, max_chars=None):
+    #docs of every NER model for the texts, one list per model
+    from PreProcessUtils import pipe_texts
+    if not shared or not nlps:
+        if batch_size:
+            return [pipe_texts(special_nlp, texts, batch_size, n_process, max_chars) for special_nlp in nlps]
+        return [[special_nlp(text) for text in texts] for special_nlp in nlps]
+    tokenized = [nlps[0].make_doc(text) for text in texts]
+    model_docs = [tokenized] + [[doc_from_tokens(special_nlp.vocab, doc) for doc in tokenized] for special_nlp in nlps[1:]]
+    return [pipe_components(special_nlp, docs, batch_size) for special_nlp, docs in zip(nlps, model_docs)]
+
+def model_entities(model_docs):
+    #(start, end, label) of the entities found by each model
+    return [[(ent.start_char, ent.end_char, ent.label_) for doc in docs for ent in doc.ents] for docs in model_docs]
+
+def sample_texts(paths, max_texts=SHARED_CHECK_TEXTS):
+    #the abstract and body paragraphs of the first papers
+    texts = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            paper = json.load(f)
+        texts += [paragraph["text"] for paragraph in (paper.get("abstract") or []) + paper.get("body_text", [])]
+        if len(texts) >= max_texts:
+            break
+    return texts[:max_texts]
+
+def check_shared_tokens(model_prefs_dict, texts, batch_size=None):
+    """
+    Whether the NER models of model_prefs_dict find the same entities in
+    texts with the shared tokens as with their own tokenizers: on the
+    sentences of en_core_sci_lg like the pipeline, or on the whole texts
+    without it. The models are loaded with load_models.
+    """
+    from PreProcessUtils import load_models
+    nlp, _, nlps = load_models(model_prefs_dict)
+    if nlp is None:
+        runs = [ner_on_texts(nlps, texts, shared, batch_size) for shared in (False, True)]
+    else:
+        #only the sentences of the core model are needed
+        with nlp.disable_pipes(*[name for name in nlp.pipe_names if name not in ("parser", "sentencizer")]):
+            sentences = [sentence for doc in nlp.pipe(texts) for sentence in doc.sents]
+        runs = [[ner_on_sentences(special_nlp, sentences, shared, batch_size) for special_nlp in nlps] for shared in (False, True)]
+    return model_entities(runs[0]) == model_entities(runs[1])
+
+
+def compare_pipelines(texts, models, batch_size=None):
+    """
+    Run the NER models on the sentences of en_core_sci_lg in every mode and
+    return the time of each mode and whether its entities are the same as
+    with the full pipelines.
+    """
+    import spacy
+    core = spacy.load("en_core_sci_lg", disable=["ner"])
+    sentences = [sentence for doc in core.pipe(texts) for sentence in doc.sents]
+    results = {}
+    reference = None
+    for mode in NER_PIPELINES:
+        prefs = {"en_core_sci_lg": True, "ner_pipeline": mode}
+        nlps = [spacy.load(model, disable=disabled_components(prefs)) for model in models]
+        start = time.perf_counter()
+        entities = model_entities([ner_on_sentences(special_nlp, sentences, mode == "shared", batch_size) for special_nlp in nlps])
+        results[mode] = {"seconds": time.perf_counter() - start}
+        if reference is None:
+            reference = entities
+        results[mode]["same_entities"] = entities == reference
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the NER pipelines (full, ner, shared) on synthetic biomedical text.')
+    parser.add_argument('--n_paragraphs', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=None)
+    parser.add_argument('--models', type=str, nargs='+', default=["en_ner_craft_md", "en_ner_jnlpba_md", "en_ner_bc5cdr_md", "en_ner_bionlp13cg_md"])
+    args = parser.parse_args()
+    import random
+    from Benchmark_v19 import synthetic_paragraph
+    rng = random.Random(0)
+    texts = [synthetic_paragraph(rng, "en", 150) for _ in range(args.n_paragraphs)]
+    for mode, result in compare_pipelines(texts, args.models, args.batch_size).items():
+        print("{:<7} {:8.2f} s   same entities as full: {}".format(mode, result["seconds"], result["same_entities"]))
@@ -1,26 +1,48 @@
 
-def pipeline(paths_to_files, process_nb, model_prefs_dict):
+def pipeline(paths_to_files, process_nb, model_prefs_dict, show_progress=True, on_done=None):
     
     #this function is supposed to run within multiprocessing
     #so the imports go this way...
-    import os, json, uuid, re, warnings
+    #paths_to_files can be a generator, e.g. of the tasks a worker takes from the scheduler,
+    #on_done(path) is called once the output of a file is written
+    import os, json, uuid, re, warnings, time
     from tqdm import tqdm
-    import numpy as np
     from langdetect import detect
-    from PreProcessUtils import init_nlp, init_ner, translate, extract_tables_from_json, further_clean_section
-    from collections import defaultdict
+    from PreProcessUtils import extract_tables_from_json, further_clean_section
+    from PreProcessUtils import load_models, process_memory, pipe_texts, expand_abbreviations, add_entities, detect_abbreviations, split_text, regroup
+    from NerPipelines import ner_on_sentences, ner_on_texts
+    from Manifest import manifest_path, record_paper, content_hash
+    from VectorStore import get_writer, VECTOR_FOLDER
+    from ShardStore import get_shard_writer, SHARD_FOLDER
+    from Translation import get_translator, init_language_detection, CACHE_NAME
+    from UmlsCache import canonical_name, cache_stats
+    from SentenceVectors import sentence_vectors
+    from Instrumentation import get_timer, get_metrics_writer, instrument_component, METRICS_FOLDER
+    from Streaming import prefetch, get_async_writer
     
     folder_name = "preprocessed"
     if not os.path.exists(folder_name):
         os.mkdir(folder_name)
+    manifest = manifest_path(folder_name)
     
-    if model_prefs_dict["en_core_sci_lg"]:
-        nlp, linker = init_nlp()
-    else:
-        nlp, linker = None, None
+    #models preloaded by the parent are inherited copy-on-write from the fork,
+    #otherwise they are loaded by the first task of this process and kept for the next ones
+    nlp, linker, nlps = load_models(model_prefs_dict)
     
-    nlps = init_ner(model_prefs_dict)
+    memory_start = process_memory()
+    n_papers, n_sentences = 0, 0
+    umls_stats_start = cache_stats(linker)
     
+    #time spent in each stage of every paper, written to preprocessed/metrics
+    timer = get_timer()
+    metrics_run_id = model_prefs_dict.get("metrics_run_id")
+    if metrics_run_id is not None:
+        metrics_writer = get_metrics_writer(os.path.join(folder_name, METRICS_FOLDER), metrics_run_id)
+        #UMLS linking runs inside the spaCy parse, time it apart
+        if nlp is not None and linker is not None:
+            instrument_component(nlp, linker, "umls_linking")
+    else:
+        metrics_writer = None
     
     
     
@@ -47,19 +69,133 @@ def pipeline(paths_to_files, process_nb, model_prefs_dict):
                           'MULTI-TISSUE_STRUCTURE', 'DEVELOPING_ANATOMICAL_STRUCTURE', 'ORGANISM_SUBDIVISION',
                           'CELLULAR_COMPONENT', 'PATHOLOGICAL_FORMATION']
 
-    pbar = tqdm(total=len(paths_to_files))
-    pbar.set_description("Preprocessing json files - Process no.{}: ".format(process_nb))
+    #batched mode streams all sections (and sentences for the NER models) of a paper through nlp.pipe
+    batch_size = model_prefs_dict.get("batch_size")
+    n_process = model_prefs_dict.get("n_process", 1)
+    sent2vec_mode = model_prefs_dict.get("sent2vec_mode", "sum")
+    #the NER models reuse the tokens of the core model (or of one tokenizer pass) instead of tokenizing again
+    shared_tokens = model_prefs_dict.get("ner_pipeline", "full") == "shared"
+    #expand the abbreviations found by a minimal pipeline before the single full parse,
+    #or parse the section, expand its abbreviations and parse it again
+    detect_first = model_prefs_dict.get("abbreviation_mode", "reparse") == "detect"
+    #sections longer than this are processed in pieces cut at paragraph or sentence boundaries,
+    #batches hold at most this many characters
+    max_section_chars = model_prefs_dict.get("max_section_chars")
+    #sentence vectors as JSON float lists or as rows of this worker's binary shard
+    if model_prefs_dict.get("vector_store", "json") == "npy":
+        vector_writer = get_writer(os.path.join(folder_name, VECTOR_FOLDER), model_prefs_dict.get("vector_dtype", "float32"))
+    else:
+        vector_writer = None
+    #languages and translations come from the cache filled by the translation stage,
+    #a text missing from it is kept as it is rather than sent over the network
+    translator = get_translator(model_prefs_dict.get("translation_backend", "googletrans"), os.path.join(folder_name, CACHE_NAME), cache_only=True)
+    init_language_detection()
+    #one JSON file per paper or compressed JSONL shards of this worker
+    if model_prefs_dict.get("output_format", "files") == "jsonl":
+        shard_writer = get_shard_writer(os.path.join(folder_name, SHARD_FOLDER))
+    else:
+        shard_writer = None
+
+    def read_json_file(path_to_file):
+        start = time.perf_counter()
+        with open(path_to_file, "rb") as f:
+            content = f.read()
+            f.close()
+        json_file = json.loads(content)
+        return path_to_file, len(content), json_file, content_hash(content), time.perf_counter() - start
+    
+    #time of the last write, read by record_metrics which runs right after it in the same thread
+    write_times = {}
     
+    def skip_paper(path_to_file, content_digest, paper_id):
+        #nothing to write, the file is only recorded in the manifest
+        record_paper(manifest, path_to_file, content_digest, model_prefs_dict, paper_id, None)
+        if on_done is not None:
+            on_done(path_to_file)
     
-    #iterate over a list of file paths
-    for path_to_file in paths_to_files:
+    def write_paper(preprocessed_file, path_to_file, content_digest):
+        start = time.perf_counter()
+        #save the preprocessed file on the disk
+        if shard_writer is not None:
+            output_path = shard_writer.write(preprocessed_file)
+        else:
+            output_path = os.path.join(folder_name,preprocessed_file["paper_id"]+".json")
+            with open(output_path, "w", encoding="utf-8") as f:
+                json.dump(preprocessed_file, f, ensure_ascii=False)
+                f.close()
+        #the paper is done, a resumed run can skip it
+        record_paper(manifest, path_to_file, content_digest, model_prefs_dict, preprocessed_file["paper_id"], output_path)
+        write_times["write"] = time.perf_counter() - start
+        if on_done is not None:
+            on_done(path_to_file)
+    
+    def record_metrics(record):
+        #reading and writing run beside the NLP (with io_queue_size), their own time shows the overlap
+        record["io_s"]["write"] = write_times.pop("write", 0.0)
+        metrics_writer.record(record)
+    
+    def parse_section(section_text):
+        if detect_first:
+            #let unabbreviate the abbreviations found by the minimal pipeline
+            with timer.stage("abbreviation_detection"):
+                expanded_text = expand_abbreviations(detect_abbreviations(nlp, [section_text])[0])
+                if expanded_text is not None:
+                    section_text = expanded_text
+            #let spacy digest the text content, once
+            with timer.stage("parsing"):
+                return nlp(section_text)
+        #let spacy digest the text content
+        with timer.stage("parsing"):
+            doc = nlp(section_text)
+        #let unabbreviate the abbreviation
+        with timer.stage("abbreviation_reparse"):
+            expanded_text = expand_abbreviations(doc)
+            if expanded_text is not None:
+                # Reassign fixed body text to article in df.
+                section_text = expanded_text
+                # We have new text. Re-nlp the doc for futher processing!
+                doc = nlp(section_text)
+        return doc
+    
+    def section_sentences(docs):
+        #sentences of the pieces of a section with their sent2vec, in order;
+        #a piece is parsed when the sentences of the previous one are done
+        for doc in docs:
+            sentences = list(doc.sents)
+            #sent2vec of all sentences of the piece at once
+            section_vectors = sentence_vectors(doc, sentences, sent2vec_mode)
+            for single_sentence, sentence_vector in zip(sentences, section_vectors):
+                yield single_sentence, sentence_vector
+    
+    #the next files are read by a prefetching thread and the output is written by a writer thread,
+    #while this thread runs the NLP; at most io_queue_size papers wait on either side
+    io_queue_size = model_prefs_dict.get("io_queue_size", 0)
+    if io_queue_size:
+        papers = prefetch(paths_to_files, read_json_file, io_queue_size)
+        async_writer = get_async_writer(io_queue_size)
+        output = async_writer.submit
+    else:
+        papers = (read_json_file(path_to_file) for path_to_file in paths_to_files)
+        async_writer = None
+        output = lambda function, *args: function(*args)
+    
+    pbar = tqdm(total=len(paths_to_files) if hasattr(paths_to_files, "__len__") else None, disable=not show_progress)
+    pbar.set_description("Preprocessing json files - Process no.{}: ".format(process_nb))
+    n_files = 0
+    
+    #iterate over the file paths
+    while True:
         
         #create dict to store all annotations, lemmas, NERs etc...
         preprocessed_file = dict()
-        #read in the json file
-        with open(path_to_file, "rb") as f:
-            json_file = json.load(f)
-            f.close()
+        timer.start_paper()
+        #read in the json file, or take it from the prefetching thread
+        with timer.stage("json_load"):
+            paper = next(papers, None)
+        if paper is None:
+            break
+        path_to_file, content_size, json_file, content_digest, read_s = paper
+        n_files += 1
     
         #add paper id to file dict
         paper_id = json_file["paper_id"]
@@ -87,6 +223,7 @@ def pipeline(paths_to_files, process_nb, model_prefs_dict):
         if len(all_text) > 5:
             pass
         else:
+            output(skip_paper, path_to_file, content_digest, paper_id)
             continue
             pass#add some actions if the file doesn't have any text
         
@@ -96,16 +233,21 @@ def pipeline(paths_to_files, process_nb, model_prefs_dict):
         #find out the language of the paper
         #what to do if language other than EN? Translate or omit...?
         try:
-            found_lang = detect(all_text[:1000])
+            with timer.stage("language_detection"):
+                found_lang = translator.cache.get_language(path_to_file) or detect(all_text[:1000])
             preprocessed_file['language'] = found_lang
         except:
             warnings.warn('Language of this text body cannot be recognised: {}\nWe are skipping this text body'.format(all_text[:1000]))
+            output(skip_paper, path_to_file, content_digest, paper_id)
             continue
         if found_lang != 'en':
-            #if language other than EN then use Google translator to translate section by section
+            #if language other than EN then translate section by section
             original_text = '\n'.join(['\n'.join([section_body['section'], section_body['text']]) for section_body in body_text])
             preprocessed_file["original_text"] = original_text
-            body_text = [{'text':translate(section_body['text']),'section':translate(section_body['section'])} for section_body in body_text]
+            with timer.stage("translation"):
+                translations = translator.translate_texts([section_body['text'] for section_body in body_text] +
+                                                          [section_body['section'] for section_body in body_text])
+            body_text = [{'text':text,'section':section} for text, section in zip(translations[:len(body_text)], translations[len(body_text):])]
         else:
             preprocessed_file["original_text"] = []
         
@@ -116,6 +258,37 @@ def pipeline(paths_to_files, process_nb, model_prefs_dict):
         
         
         section_ids_list = []
+        #sentence dicts (and their spans) still waiting for the NER models in the batched mode
+        ner_sentence_dicts = []
+        ner_sentences = []
+        if batch_size:
+            #the pieces of all sections, regrouped by section after the parse
+            section_pieces = [split_text(section_body['text'], max_section_chars) for section_body in body_text]
+            piece_texts = [piece for pieces in section_pieces for piece in pieces]
+            if model_prefs_dict["en_core_sci_lg"] and detect_first:
+                with timer.stage("abbreviation_detection"):
+                    detection_docs = detect_abbreviations(nlp, piece_texts, batch_size, n_process, max_section_chars)
+                    expanded_texts = [expand_abbreviations(doc) for doc in detection_docs]
+                    piece_texts = [text if expanded_text is None else expanded_text for text, expanded_text in zip(piece_texts, expanded_texts)]
+                with timer.stage("parsing"):
+                    piece_docs = pipe_texts(nlp, piece_texts, batch_size, n_process, max_section_chars)
+                section_docs = regroup(piece_docs, section_pieces)
+            elif model_prefs_dict["en_core_sci_lg"]:
+                with timer.stage("parsing"):
+                    piece_docs = pipe_texts(nlp, piece_texts, batch_size, n_process, max_section_chars)
+                #re-parse only the pieces whose abbreviations have been expanded
+                with timer.stage("abbreviation_reparse"):
+                    expanded = [(nb, expand_abbreviations(doc)) for nb, doc in enumerate(piece_docs)]
+                    expanded = [(nb, text) for nb, text in expanded if text is not None]
+                    if expanded:
+                        expanded_docs = pipe_texts(nlp, [text for _, text in expanded], batch_size, n_process, max_section_chars)
+                        for (nb, _), doc in zip(expanded, expanded_docs):
+                            piece_docs[nb] = doc
+                section_docs = regroup(piece_docs, section_pieces)
+            else:
+                with timer.stage("ner"):
+                    special_piece_docs = ner_on_texts(nlps, piece_texts, shared_tokens, batch_size, n_process, max_section_chars)
+                special_section_docs = [regroup(piece_docs, section_pieces) for piece_docs in special_piece_docs]
         #iterate over a list of sections
         for section_nb, section_body in enumerate(body_text):
             #print("---new section---")
@@ -135,61 +308,51 @@ def pipeline(paths_to_files, process_nb, model_prefs_dict):
                 preprocessed_file["text_body"].append({"section_id":section_id,"section_name":section_name})
                 
             if model_prefs_dict["en_core_sci_lg"]:
-                #let spacy digest the text content
-                doc = nlp(section_text)
-                #let unabbreviate the abbreviation
-                if len(doc._.abbreviations) > 0:
-                    doc._.abbreviations.sort()
-                    join_list = []
-                    start = 0
-                    for abbrev in doc._.abbreviations:
-                        join_list.append(str(doc.text[start:abbrev.start_char]))
-                        if len(abbrev._.long_form) > 5: #Increase length so "a" and "an" don't get un-abbreviated
-                            join_list.append(str(abbrev._.long_form))
-                        else:
-                            join_list.append(str(doc.text[abbrev.start_char:abbrev.end_char]))
-                        start = abbrev.end_char
-                    # Reassign fixed body text to article in df.
-                    section_text = "".join(join_list)
-                    # We have new text. Re-nlp the doc for futher processing!
-                    doc = nlp(section_text)
+                if batch_size:
+                    docs = section_docs[section_nb]
+                else:
+                    #oversized sections are parsed piece by piece
+                    docs = (parse_section(piece) for piece in split_text(section_text, max_section_chars))
                 
                 section_sent_ids_list = []
-                for single_sentence in doc.sents:
-                    sentence_dict = {}
-                    sentence_id = str(uuid.uuid1())
-                    section_sent_ids_list.append(sentence_id)
-                    sentence_dict["sentence_id"] = sentence_id
-                    tokens = str(single_sentence.text)
-                    sentence_dict["tokens"] = tokens
-                    lemmas = [token.lemma_.lower() for token in single_sentence if not token.is_stop and re.search('[a-zA-Z]', str(token))]
-                    sentence_dict["lemmas"] = lemmas
-                    sent_ents = []
-                    for ent in single_sentence.ents: 
-                        if len(ent._.umls_ents) > 0:
-                            poss = linker.umls.cui_to_entity[ent._.umls_ents[0][0]].canonical_name
-                            sent_ents.append(poss)
-                    sentence_dict["umls"] = sent_ents
-                    umls_ids = [entity._.umls_ents[0][0] for entity in single_sentence.ents if len(entity._.umls_ents) > 0]
-                    sentence_dict["umls_ids"] = umls_ids
-                    sentence_vectors = [token.vector for token in single_sentence if not token.is_stop]
-                    if len(sentence_vectors)>0:
-                        sentence_vector = np.stack(sentence_vectors, axis=0).sum(0).tolist()
-                    else:
-                        sentence_vector = []
-                    sentence_dict["sent2vec"] = sentence_vector
+                with timer.stage("sentence_features"):
+                    for single_sentence, sentence_vector in section_sentences(docs):
+                        sentence_dict = {}
+                        sentence_id = str(uuid.uuid1())
+                        section_sent_ids_list.append(sentence_id)
+                        sentence_dict["sentence_id"] = sentence_id
+                        tokens = str(single_sentence.text)
+                        sentence_dict["tokens"] = tokens
+                        lemmas = [token.lemma_.lower() for token in single_sentence if not token.is_stop and re.search('[a-zA-Z]', str(token))]
+                        sentence_dict["lemmas"] = lemmas
+                        sent_ents = []
+                        for ent in single_sentence.ents: 
+                            if len(ent._.umls_ents) > 0:
+                                poss = canonical_name(linker, ent._.umls_ents[0][0])
+                                sent_ents.append(poss)
+                        sentence_dict["umls"] = sent_ents
+                        umls_ids = [entity._.umls_ents[0][0] for entity in single_sentence.ents if len(entity._.umls_ents) > 0]
+                        sentence_dict["umls_ids"] = umls_ids
+                        if vector_writer is not None:
+                            if len(sentence_vector)>0:
+                                sentence_dict["sent2vec_row"] = vector_writer.append(sentence_vector)
+                            else:
+                                sentence_dict["sent2vec_row"] = None
+                        else:
+                            if len(sentence_vector)>0:
+                                sentence_vector = sentence_vector.tolist()
+                            sentence_dict["sent2vec"] = sentence_vector
                     
-                    #preprocess each sentences also with additional SciSpacy models
-                    for special_nlp in nlps:
-                        single_sentence_special = special_nlp(tokens)
-                        keys = list(set([ent.label_ for ent in single_sentence_special.ents]))
-                        for key in keys:
-                            if key not in scispacy_ent_types:
-                                sentence_dict[key] = []
-                            values = [ent.text for ent in single_sentence_special.ents if ent.label_ == key]
-                            sentence_dict[key] = values
-                    #add sentence dictionary to the file dict
-                    preprocessed_file[sentence_id] = sentence_dict
+                        #preprocess each sentences also with additional SciSpacy models
+                        if batch_size:
+                            ner_sentence_dicts.append(sentence_dict)
+                            ner_sentences.append(single_sentence)
+                        else:
+                            for special_nlp in nlps:
+                                with timer.stage("ner"):
+                                    add_entities(sentence_dict, ner_on_sentences(special_nlp, [single_sentence], shared_tokens)[0])
+                        #add sentence dictionary to the file dict
+                        preprocessed_file[sentence_id] = sentence_dict
                 #add list of sentence ids to the file dict
                 preprocessed_file[section_id] = section_sent_ids_list
             #without en_core_sci_lg
@@ -198,18 +361,17 @@ def pipeline(paths_to_files, process_nb, model_prefs_dict):
                 sentences = []
                 sentences_full_text = []
                 #run each of the smaller SciSpacy models selected by the user
-                for special_nlp in nlps:
-                    doc = special_nlp(section_text)
+                if batch_size:
+                    model_docs = [docs[section_nb] for docs in special_section_docs]
+                else:
+                    with timer.stage("ner"):
+                        model_docs = ner_on_texts(nlps, split_text(section_text, max_section_chars), shared_tokens)
+                for docs in model_docs:
                     model_sentences = []
-                    for single_sentence in doc.sents:
+                    for single_sentence in (sentence for doc in docs for sentence in doc.sents):
                         sentence_dict = {}
                         sentences_full_text.append(str(single_sentence.text))
-                        keys = list(set([ent.label_ for ent in single_sentence.ents]))
-                        for key in keys:
-                            if key not in scispacy_ent_types:
-                                sentence_dict[key] = []
-                            values = [ent.text for ent in single_sentence.ents if ent.label_ == key]
-                            sentence_dict[key] = values
+                        add_entities(sentence_dict, single_sentence)
                         model_sentences.append(sentence_dict)
                     sentences.append(model_sentences)
                 #We have k senteces from n models.
@@ -229,12 +391,52 @@ def pipeline(paths_to_files, process_nb, model_prefs_dict):
                     preprocessed_file[sentence_id] = sentence_dict
                
                 preprocessed_file[section_id] = section_sent_ids_list
+        
+        #run the NER models over all sentences of the paper at once,
+        #the sentence dicts are updated in place so they keep their ids
+        if ner_sentence_dicts:
+            with timer.stage("ner"):
+                for special_nlp in nlps:
+                    special_docs = ner_on_sentences(special_nlp, ner_sentences, shared_tokens, batch_size, n_process)
+                    for sentence_dict, single_sentence_special in zip(ner_sentence_dicts, special_docs):
+                        add_entities(sentence_dict, single_sentence_special)
                         
-        #save the preprocessed file on the disk
-        with open(os.path.join(folder_name,paper_id+".json"), "w", encoding="utf-8") as f:
-            json.dump(preprocessed_file, f, ensure_ascii=False)
-            f.close()
+        paper_sentences = sum(len(preprocessed_file[section_id]) for section_id in section_ids_list)
+        with timer.stage("output"):
+            #the vector rows must be on the disk before the paper refers to them
+            if vector_writer is not None:
+                vector_writer.flush()
+                preprocessed_file["sent2vec_shard"] = vector_writer.name
+            
+            output(write_paper, preprocessed_file, path_to_file, content_digest)
+        n_papers += 1
+        n_sentences += paper_sentences
+        if metrics_writer is not None:
+            latency, stages = timer.end_paper()
+            #recorded by the writer, after the paper
+            output(record_metrics, {"paper_id": paper_id, "path": path_to_file, "size": content_size,
+                                    "n_sentences": paper_sentences, "latency_s": latency, "stages": stages,
+                                    "io_s": {"read": read_s}})
         pbar.update()
-        
-    return True
+    
+    #all papers must be written before the call reports back, once for a whole stream of tasks
+    if async_writer is not None:
+        async_writer.drain()
+    if metrics_writer is not None:
+        metrics_writer.flush()
+    memory_end = process_memory()
+    memory_report = {"process_nb": process_nb,
+                     "pid": memory_end["pid"],
+                     "uss_start_gib": memory_start["uss_gib"],
+                     "uss_end_gib": memory_end["uss_gib"],
+                     "rss_end_gib": memory_end["rss_gib"],
+                     "peak_rss_gib": memory_end["peak_rss_gib"],
+                     "n_files": n_files,
+                     "n_papers": n_papers,
+                     "n_sentences": n_sentences}
+    #UMLS link cache statistics of this call only, the cache lives as long as the worker
+    umls_stats_end = cache_stats(linker)
+    if umls_stats_end is not None:
+        memory_report["umls_cache"] = {k: v - umls_stats_start[k] for k, v in umls_stats_end.items()}
+    return memory_report
                
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import os
+import pandas as pd
+
+# Many CORD19 papers have a PDF parse (pdf_json/<sha>.json) and a PMC parse
+# (pmc_json/<pmcid>.xml.json) of the same text, and some have the parses of
+# several PDFs. The planning stage joins the files found on disk to the rows
+# of metadata.csv by sha and pmcid and keeps one parse per cord_uid, so that
+# no paper is annotated twice. Files without a metadata row are kept.
+DUPLICATE_POLICIES = ["pmc", "pdf", "largest", "all"]
+
+
+def _parse_type(path):
+    return "pmc" if os.path.basename(os.path.dirname(path)) == "pmc_json" or path.endswith(".xml.json") else "pdf"
+
+KEY_COLUMNS = ["cord_uid", "sha", "pmcid"]
+
+
+def metadata_keys(df):
+    #sha (a row can list several, the first is the main PDF) and pmcid -> (cord_uid, rank of the sha in the row)
+    if "cord_uid" not in df.columns:
+        return {}
+    keys = {}
+    for row in df[[column for column in KEY_COLUMNS if column in df.columns]].itertuples(index=False):
+        row = row._asdict()
+        if type(row["cord_uid"]) != str:
+            continue
+        if type(row.get("sha")) == str:
+            for rank, sha in enumerate(row["sha"].split(";")):
+                keys.setdefault(sha.strip(), (row["cord_uid"], rank))
+        if type(row.get("pmcid")) == str:
+            keys.setdefault(row["pmcid"].strip(), (row["cord_uid"], 0))
+    return keys
+
+def _metadata_keys(directory):
+    metadata_path = os.path.join(directory, "metadata.csv")
+    columns = set(pd.read_csv(metadata_path, nrows=0).columns)
+    return metadata_keys(pd.read_csv(metadata_path, usecols=[column for column in KEY_COLUMNS if column in columns], dtype=str))
+
+def _preference(policy, parse_type, rank, size):
+    #smaller is better
+    if policy == "largest":
+        return (-size, rank)
+    preferred = 0 if parse_type == policy else 1
+    return (preferred, rank, -size)
+
+def plan_papers(directory, shas, paths, sizes, policy="pmc", keys=None):
+    """
+    Keep one parse per paper of the files found in the CORD19 directory.
+    policy "pmc" prefers the PMC parse, "pdf" the PDF parse (the first sha of
+    the metadata row among several), "largest" the largest file and "all"
+    keeps every file. keys is the join of metadata_keys(), e.g. from the
+    discovery index, else metadata.csv is read. Returns the shas, paths and
+    sizes of the kept files and a report of the work eliminated.
+    """
+    report = {"policy": policy, "n_files": len(paths), "n_bytes": int(sum(sizes)),
+              "n_papers": None, "n_unmatched": None, "n_dropped": 0, "n_bytes_dropped": 0}
+    if policy == "all" or not paths:
+        return shas, paths, sizes, report
+    if keys is None:
+        keys = _metadata_keys(directory)
+    papers = {}
+    n_unmatched = 0
+    for nb, (sha, path, size) in enumerate(zip(shas, paths, sizes)):
+        if sha in keys:
+            cord_uid, rank = keys[sha]
+        else:
+            #not in the metadata: a paper of its own
+            cord_uid, rank = "file:" + path, 0
+            n_unmatched += 1
+        papers.setdefault(cord_uid, []).append((_preference(policy, _parse_type(path), rank, size), nb))
+    kept = sorted(min(candidates)[1] for candidates in papers.values())
+    report.update({"n_papers": len(papers), "n_unmatched": n_unmatched,
+                   "n_dropped": len(paths) - len(kept),
+                   "n_bytes_dropped": int(sum(sizes) - sum(sizes[nb] for nb in kept))})
+    return [shas[nb] for nb in kept], [paths[nb] for nb in kept], [sizes[nb] for nb in kept], report
+
+def print_planning_report(report):
+    if report["policy"] == "all":
+        print("""
+           Duplicate planning is off: all {} files will be considered.
+        """.format(report["n_files"]))
+        return
+    share = report["n_bytes_dropped"] / report["n_bytes"] if report["n_bytes"] else 0.0
+    print("""
+           Duplicate planning ({} parse preferred): {} files belong to {} papers ({} files without a metadata row).
+           {} duplicate parses ({:.1f} MiB, {:.1%} of the text to annotate) are left out.
+        """.format(report["policy"], report["n_files"], report["n_papers"], report["n_unmatched"],
+               report["n_dropped"], report["n_bytes_dropped"] / 1024**2, share))
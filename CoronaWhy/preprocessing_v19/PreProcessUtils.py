@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 from googletrans import Translator
-import os, scispacy, json, spacy, argparse
-from tqdm import tqdm
+import os, json, spacy, argparse, gc, sys
+from psutil import Process
 import pandas as pd
 from scispacy.abbreviation import AbbreviationDetector
 # UMLS linking will find concepts in the text, and link them to UMLS. 
 from scispacy.umls_linking import UmlsEntityLinker
+from concurrent.futures import ThreadPoolExecutor
+from UmlsCache import install_cache
+from Planning import metadata_keys, KEY_COLUMNS
 
 
 def str2bool(v):
@@ -177,65 +180,283 @@ def init_nlp():
     
     return(spacy_nlp, linker)
 
+class _StubUmls:
+    cui_to_entity = {}
+
+class StubLinker:
+    #stands in for the UMLS linker of the stub pipelines, it links nothing
+    def __init__(self):
+        self.umls = _StubUmls()
+        self.candidate_generator = lambda mention_texts, k: [[] for _ in mention_texts]
+
+    def __call__(self, doc):
+        return doc
+
+def init_stub_nlp():
+    #blank English pipeline with sentence splitting only, for benchmarks and tests
+    from spacy.tokens import Doc
+    spacy_nlp = spacy.blank('en')
+    spacy_nlp.add_pipe(spacy_nlp.create_pipe('sentencizer'))
+    spacy_nlp.max_length=2000000
+    if not Doc.has_extension("abbreviations"):
+        Doc.set_extension("abbreviations", default=[])
+    return spacy_nlp
+
+# models the user can switch on and off, the core model first
+SCISPACY_MODELS = ["en_core_sci_lg", "en_ner_craft_md", "en_ner_jnlpba_md","en_ner_bc5cdr_md","en_ner_bionlp13cg_md"]
+
 def init_ner(model_prefs_dict):
-    models = ["en_ner_craft_md", "en_ner_jnlpba_md","en_ner_bc5cdr_md","en_ner_bionlp13cg_md"]
-    nlps = [spacy.load(model) for model in models if model_prefs_dict[model]]
+    from NerPipelines import disabled_components
+    models = SCISPACY_MODELS[1:]
+    #without the tagger and parser (if no one reads them) the models are faster and smaller
+    nlps = [spacy.load(model, disable=disabled_components(model_prefs_dict)) for model in models if model_prefs_dict[model]]
     return nlps
 
+def split_text(text, max_chars):
+    """
+    Split a text longer than max_chars characters into pieces of at most
+    max_chars, cut at the last paragraph break before the limit, else at the
+    last line break, sentence end or space. Shorter texts are returned as the
+    only piece.
+    """
+    if not max_chars or len(text) <= max_chars:
+        return [text]
+    pieces = []
+    start = 0
+    while len(text) - start > max_chars:
+        window = text[start:start + max_chars]
+        cut = max_chars
+        for separator in ("\n\n", "\n", ". ", " "):
+            position = window.rfind(separator)
+            if position > 0:
+                cut = position + len(separator)
+                break
+        pieces.append(text[start:start + cut])
+        start += cut
+    pieces.append(text[start:])
+    #the whitespace at the cuts would become tokens of their own
+    return [piece.strip() for piece in pieces if piece.strip()]
+
+def regroup(items, groups):
+    #split the flat list items into lists as long as the lists in groups
+    items = iter(items)
+    return [[next(items) for _ in group] for group in groups]
+
+def length_buckets(texts, batch_size, max_chars=None):
+    #indices of texts of similar length, at most batch_size texts and max_chars characters per bucket
+    bucket, bucket_chars = [], 0
+    for nb in sorted(range(len(texts)), key=lambda nb: len(texts[nb])):
+        if bucket and (len(bucket) == batch_size or (max_chars and bucket_chars + len(texts[nb]) > max_chars)):
+            yield bucket
+            bucket, bucket_chars = [], 0
+        bucket.append(nb)
+        bucket_chars += len(texts[nb])
+    if bucket:
+        yield bucket
+
+def pipe_texts(nlp, texts, batch_size, n_process=1, max_chars=None):
+    #stream texts through nlp.pipe in batches of similar length (less padding,
+    #no batch of only huge texts); the docs come back in the input order
+    docs = [None] * len(texts)
+    if n_process > 1:
+        order = sorted(range(len(texts)), key=lambda nb: len(texts[nb]))
+        for nb, doc in zip(order, nlp.pipe([texts[nb] for nb in order], batch_size=batch_size, n_process=n_process)):
+            docs[nb] = doc
+        return docs
+    for bucket in length_buckets(texts, batch_size, max_chars):
+        for nb, doc in zip(bucket, nlp.pipe([texts[nb] for nb in bucket], batch_size=len(bucket))):
+            docs[nb] = doc
+    return docs
+
+def expand_abbreviations(doc):
+    #rebuild the text with the long forms, None if there is nothing to expand
+    if len(doc._.abbreviations) == 0:
+        return None
+    doc._.abbreviations.sort()
+    join_list = []
+    start = 0
+    for abbrev in doc._.abbreviations:
+        join_list.append(str(doc.text[start:abbrev.start_char]))
+        if len(abbrev._.long_form) > 5: #Increase length so "a" and "an" don't get un-abbreviated
+            join_list.append(str(abbrev._.long_form))
+        else:
+            join_list.append(str(doc.text[abbrev.start_char:abbrev.end_char]))
+        start = abbrev.end_char
+    return "".join(join_list)
+
+def detect_abbreviations(nlp, texts, batch_size=None, n_process=1, max_chars=None):
+    #docs of a pipeline reduced to what the abbreviation detector needs: the tokens, its matcher uses no tag, parse or entity
+    disabled = [name for name, proc in nlp.pipeline if not isinstance(proc, AbbreviationDetector)]
+    with nlp.disable_pipes(*disabled):
+        if batch_size:
+            return pipe_texts(nlp, texts, batch_size, n_process, max_chars)
+        return [nlp(text) for text in texts]
+
+def add_entities(sentence_dict, doc):
+    #entity texts grouped by their label, e.g. sentence_dict["DISEASE"] = [...]
+    for key in list(set([ent.label_ for ent in doc.ents])):
+        sentence_dict[key] = [ent.text for ent in doc.ents if ent.label_ == key]
+
+# Models loaded once in the parent process. Forked workers inherit them
+# copy-on-write, so the vectors table, the UMLS KB and the NER weights are
+# kept in RAM only once for the whole pool.
+_shared_models = {}
+
+def _model_key(model_prefs_dict):
+    return tuple((model, model_prefs_dict[model]) for model in SCISPACY_MODELS) + (model_prefs_dict.get("stub_models", False), model_prefs_dict.get("ner_pipeline", "full"))
+
+def load_models(model_prefs_dict):
+    #load the models once per process and reuse them for every following task
+    key = _model_key(model_prefs_dict)
+    if key not in _shared_models and model_prefs_dict.get("stub_models", False):
+        nlp, linker = (init_stub_nlp(), StubLinker()) if model_prefs_dict["en_core_sci_lg"] else (None, None)
+        nlps = [init_stub_nlp() for model in SCISPACY_MODELS[1:] if model_prefs_dict[model]]
+        _shared_models[key] = (nlp, linker, nlps)
+    if key not in _shared_models:
+        if model_prefs_dict["en_core_sci_lg"]:
+            nlp, linker = init_nlp()
+            if model_prefs_dict.get("umls_cache_size"):
+                install_cache(linker, model_prefs_dict["umls_cache_size"], model_prefs_dict.get("umls_cache_path"))
+        else:
+            nlp, linker = None, None
+        nlps = init_ner(model_prefs_dict)
+        _shared_models[key] = (nlp, linker, nlps)
+    return _shared_models[key]
+
+def unload_models(model_prefs_dict):
+    #drop the models loaded in this process, e.g. for a check before the workers are forked
+    _shared_models.pop(_model_key(model_prefs_dict), None)
+    gc.collect()
+
+def preload_models(model_prefs_dict):
+    nlp, linker, nlps = load_models(model_prefs_dict)
+    # Move everything loaded so far into the permanent generation, so that
+    # the garbage collector of the workers doesn't write to (and copy)
+    # the pages holding the models.
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    return nlp, linker, nlps
+
+def process_memory():
+    #resident and unique (not shared with other processes) memory in GiB
+    process = Process()
+    try:
+        mem = process.memory_full_info()
+        uss = mem.uss
+    except Exception:
+        mem = process.memory_info()
+        uss = None
+    try:
+        import resource
+        #ru_maxrss is in KiB on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    except ImportError:
+        peak = None
+    return {"pid": process.pid,
+            "rss_gib": mem.rss/1024**3,
+            "uss_gib": uss/1024**3 if uss is not None else None,
+            "peak_rss_gib": peak/1024**3 if peak is not None else None}
+
+def print_memory_report(parent_memory, worker_reports):
+    print("\n       Memory report (GiB)")
+    if parent_memory is not None:
+        print("       parent after model preload: RSS {:.2f}, unique {}".format(
+            parent_memory["rss_gib"], _format_gib(parent_memory["uss_gib"])))
+    #a worker runs many tasks: keep its first start and its last end sample
+    workers = {}
+    for report in worker_reports:
+        if not isinstance(report, dict):
+            continue
+        if report["pid"] not in workers:
+            workers[report["pid"]] = dict(report, n_tasks=0)
+        worker = workers[report["pid"]]
+        worker["n_tasks"] += 1
+        worker["uss_end_gib"] = report["uss_end_gib"]
+        worker["rss_end_gib"] = report["rss_end_gib"]
+    for pid, report in workers.items():
+        print("       worker pid {} ({} tasks): unique RSS {} after model load, {} at the end; RSS {:.2f} at the end".format(
+            pid, report["n_tasks"], _format_gib(report["uss_start_gib"]),
+            _format_gib(report["uss_end_gib"]), report["rss_end_gib"]))
+
+def _format_gib(value):
+    return "n/a" if value is None else "{:.2f}".format(value)
+
+def _scan_folder(folder):
+    #sub-folders and (name, path, size, mtime) of the files of a folder, in one directory read
+    subfolders, files = [], []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subfolders.append(entry.path)
+            else:
+                stat = entry.stat()
+                files.append((entry.name, entry.path, stat.st_size, stat.st_mtime))
+    return subfolders, files
+
+def _folder_mtimes(paths):
+    return {path: os.stat(path).st_mtime for path in paths}
+
+def _load_discovery_index(index_path, directory):
+    #the cached file list, or None if any of the scanned folders has changed since
+    if index_path is None or not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        index = json.load(f)
+    #indices of older versions don't have the metadata join or the file mtimes
+    if index.get("directory") != os.path.abspath(directory) or "metadata_keys" not in index or "file_mtimes" not in index:
+        return None
+    try:
+        if _folder_mtimes(index["mtimes"]) != index["mtimes"]:
+            return None
+    except OSError:
+        return None
+    return index
+
 # Parse and process the metadata
-def preprocess_metadata(directory):
+def preprocess_metadata(directory, index_path=None, n_threads=32):
     
-    rows = []
-    problem_rows = []
-
+    #the shas, paths, sizes and mtimes of the files and the sha/pmcid -> (cord_uid, rank) join of Planning
+    index = _load_discovery_index(index_path, directory)
+    if index is not None:
+        return index["shas"], index["paths"], index["sizes"], index["file_mtimes"], index["metadata_keys"]
     
-
-    df = pd.read_csv(os.path.join(directory,"metadata.csv"), low_memory=False) 
-    df.reset_index(drop=True, inplace=True)
-    sha_list = list(df.sha)
+    #the folder names and the columns of the join are needed from the metadata
+    metadata_path = os.path.join(directory,"metadata.csv")
+    columns = set(pd.read_csv(metadata_path, nrows=0).columns)
+    df = pd.read_csv(metadata_path, usecols=[column for column in ["full_text_file"] + KEY_COLUMNS if column in columns], dtype=str)
+    keys = metadata_keys(df)
     folder_files = list(set(df.full_text_file.tolist()))
     #sanity check --> get rid of potential non-strings
     folder_files = [x for x in folder_files if type(x) == str]
     
-    files_paths = []
-    #single_folder = folder_files[0]
-    for big_folder in folder_files:
-        #folders are nested
-        local_folder = os.path.join(directory, big_folder, big_folder)
-        for f1 in os.listdir(local_folder):
-            local_path = os.path.join(local_folder,f1)
-            for f2 in os.listdir(local_path):
-                files_paths.append((f2, os.path.join(local_path,f2)))
-                #print(f2, local_path)
-                #quit()
+    #folders are nested, and reading them is I/O bound (often network storage),
+    #so the folders of each level are scanned concurrently
+    local_folders = [os.path.join(directory, big_folder, big_folder) for big_folder in folder_files]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        top_level = list(executor.map(_scan_folder, local_folders))
+        subfolders = [subfolder for folders, _ in top_level for subfolder in folders]
+        files_paths = list(executor.map(_scan_folder, subfolders))
+    files_paths = [file_path for _, files in files_paths for file_path in files]
     
-    sha_from_folders, paths_list = zip(*files_paths)
-    
-    #for x in sha_from_folders:
-    #    if '.xml' in x:
-    #        print(x)
+    if files_paths:
+        names, paths_list, sizes, file_mtimes = (list(x) for x in zip(*files_paths))
+    else:
+        names, paths_list, sizes, file_mtimes = [], [], [], []
     
     #split on '.' insteead os.path.splittext because of some "xml.json" formats
-    sha_from_folders = [x.split('.')[0] for x in sha_from_folders]
+    sha_from_folders = [x.split('.')[0] for x in names]
     
+    if index_path is not None:
+        index = {"directory": os.path.abspath(directory),
+                 "mtimes": _folder_mtimes([metadata_path] + local_folders + subfolders),
+                 "shas": sha_from_folders, "paths": paths_list, "sizes": sizes, "file_mtimes": file_mtimes, "metadata_keys": keys}
+        if os.path.dirname(index_path) and not os.path.exists(os.path.dirname(index_path)):
+            os.makedirs(os.path.dirname(index_path))
+        with open(index_path, "w") as f:
+            json.dump(index, f)
     
-    #sha_list, sha_from_folders = set(sha_list), set(sha_from_folders)
-    #print(list(sha_list)[:10], list(sha_from_folders)[0])
-    #print(len(sha_from_folders.difference(sha_list)))
-    #quit()        
-        #print(f)
-    #onlyfiles = [f for f in os.listdir(local_folder) if os.path.isfile(os.path.join(local_folder,f))]
-    
-    #print(onlyfiles)
-    #print(len(df))
-    
-
-    #print('Successfully processed {} rows'.format(len(output.index)))
-    #print('{} rows could not be processed'.format(len(problem_rows)))
-    #print('----')
-    #print('{} unique articles in this dataset'.format(len(output.cord_uid.unique().tolist())))
-    
-    return sha_from_folders, paths_list
+    return sha_from_folders, paths_list, sizes, file_mtimes, keys
 
                     
 def init_list_cols():
@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
-import random, argparse, os, json
-from PreProcessUtils import preprocess_metadata, chunking, str2bool
-from Pipeline_v19 import pipeline
-from pathos.pools import ProcessPool
-from pathos.helpers import cpu_count
+import random, argparse, os, json, time
+from PreProcessUtils import preprocess_metadata, str2bool, SCISPACY_MODELS, preload_models, unload_models, process_memory, print_memory_report
+from Scheduler import size_ordered_tasks, schedule
+from Supervisor import MemorySupervisor, initial_workers, print_scaling_report
+from Translation import translation_stage, CACHE_NAME
+from UmlsCache import print_cache_report
+from Instrumentation import aggregate_metrics, print_metrics_report, METRICS_FOLDER
+from Manifest import manifest_path, load_manifest, init_manifest, config_hash, is_up_to_date, existing_outputs, file_sha, load_setting, record_setting
+from Planning import plan_papers, print_planning_report
+from NerPipelines import check_shared_tokens, sample_texts
+from pathos.helpers import cpu_count, mp
 from psutil import virtual_memory
 
 
 
-def main():
+def main(argv=None):
     
     parser = argparse.ArgumentParser(description='Multi-CPU Preprocessing Pipeline for CORD19-v19.')
     #path
@@ -21,8 +27,79 @@ def main():
     parser.add_argument('--max_n_files', type=int, default=None, const=10, nargs='?',
                     help='Optional maximal number of files you want to preprocess (for development purposes)')
     #supposed/desired amount of free RAM per worker 
-    parser.add_argument('--RAM_per_worker', type=int, default=12, const=12, nargs='?',
-                    help='Amount of RAM in GiBs that each worker should obtain. It restricts the number of engaged workers. Default value 12 GiB')
+    parser.add_argument('--RAM_per_worker', type=int, default=None, const=12, nargs='?',
+                    help='Amount of RAM in GiBs that each worker should obtain. It restricts the number of engaged workers. Default value 12 GiB, or 3 GiB with --preload_models')
+    #fixed number of workers
+    parser.add_argument('--n_workers', type=int, default=None, const=None, nargs='?',
+                    help='Number of workers. Default None (as many as the CPUs and the free RAM allow)')
+    #number of workers adapted to the measured memory of the workers
+    parser.add_argument('--adaptive_workers', type=str2bool, default=True, nargs='?', const=True,
+                    help="Start with the number of workers that RAM_per_worker allows, then measure the memory of the workers and add or hold back workers during the run so that the memory stays below the system limit. Ignored with --n_workers. Default True")
+    parser.add_argument('--memory_reserve', type=float, default=2.0, const=2.0, nargs='?',
+                    help='Memory in GiB that the adaptive workers leave to the system. Default 2')
+    #blank spaCy pipelines instead of the SciSpacy models
+    parser.add_argument('--stub_models', type=str2bool, default=False, nargs='?', const=True,
+                    help="Use blank spaCy pipelines with sentence splitting only instead of the SciSpacy models, for benchmarks and tests. Default False")
+    #load the models once in the parent and share them with the workers
+    parser.add_argument('--preload_models', type=str2bool, default=False, nargs='?', const=True,
+                    help="Load SciSpacy models once in the main process and share them copy-on-write with forked workers.")
+    #reuse the list of files while the CORD19 folders are unchanged
+    parser.add_argument('--discovery_cache', type=str2bool, default=True, nargs='?', const=True,
+                    help="Cache the list of CORD19 files and their sizes in preprocessed/discovery_index.json and reuse it while the folders are unchanged. Default True")
+    #one parse per paper
+    parser.add_argument('--duplicate_policy', type=str, default=None, const="pmc", nargs='?', choices=["pmc", "pdf", "largest", "all"],
+                    help='Which parse of a paper with several (a PMC parse and one or more PDF parses, joined to metadata.csv by sha and pmcid) is annotated: "pmc", "pdf" (the main PDF), "largest" or "all" of them. Default: the policy recorded in the manifest of the preprocessed folder, all for a folder processed before the planning (so that its paper ids and outputs are kept), pmc for a new folder')
+    #skip the files already processed with the same inputs and models
+    parser.add_argument('--resume', type=str2bool, default=True, nargs='?', const=True,
+                    help="Skip the files recorded in the processing manifest of the preprocessed folder whose content and model preferences haven't changed. Default True")
+    #granularity of the work handed out to the workers
+    parser.add_argument('--task_size', type=int, default=1, const=1, nargs='?',
+                    help='Number of files per task. The tasks are handed out largest files first to whichever worker is free. Default 1')
+    #re-queue the tasks of crashed workers
+    parser.add_argument('--max_retries', type=int, default=0, const=1, nargs='?',
+                    help='How many times a task is re-queued on another worker after the worker processing it has crashed. Default 0 (no re-queueing)')
+    #translation of non-English papers
+    parser.add_argument('--translation_backend', type=str, default="googletrans", const="googletrans", nargs='?', choices=["googletrans", "stub", "marian"],
+                    help='Translation backend for non-English papers: googletrans, stub (offline, keeps the text as it is) or marian (local MarianMT model, needs transformers). Default googletrans')
+    parser.add_argument('--translation_threads', type=int, default=8, const=8, nargs='?',
+                    help='Number of threads sending translation requests concurrently in the translation stage. Default 8')
+    parser.add_argument('--translation_batch_size', type=int, default=16, const=16, nargs='?',
+                    help='Number of texts per translation request. Default 16')
+    parser.add_argument('--language_processes', type=int, default=None, const=None, nargs='?',
+                    help='Number of processes detecting the language of the files in the translation stage. Default None (one per CPU)')
+    #layout of the output
+    parser.add_argument('--output_format', type=str, default="files", const="files", nargs='?', choices=["files", "jsonl"],
+                    help='Write one JSON file per paper ("files") or append the papers to compressed JSONL shards with an index in preprocessed/shards ("jsonl"). Default files')
+    #memoized UMLS linking
+    parser.add_argument('--umls_cache_size', type=int, default=100000, const=100000, nargs='?',
+                    help='Number of mention strings whose UMLS candidates are kept in memory by each worker (LRU). 0 disables the cache. Default 100000')
+    parser.add_argument('--umls_cache_persist', type=str2bool, default=False, nargs='?', const=True,
+                    help="Share the UMLS candidates between the workers and the runs through preprocessed/umls_cache.sqlite. Default False")
+    #how the token vectors of a sentence are combined
+    parser.add_argument('--sent2vec_mode', type=str, default="sum", const="sum", nargs='?', choices=["sum", "mean", "l2"],
+                    help='Sentence vector as the sum of the vectors of its non-stop tokens ("sum"), their mean ("mean") or the L2-normalized sum ("l2"). Default sum')
+    #output format of the sentence vectors
+    parser.add_argument('--vector_store', type=str, default="json", const="json", nargs='?', choices=["json", "npy"],
+                    help='Write the sentence vectors as float lists into the JSON files ("json") or as rows of memory-mappable binary shards in preprocessed/sent2vec ("npy"). Default json')
+    parser.add_argument('--vector_dtype', type=str, default="float32", const="float32", nargs='?', choices=["float32", "float16"],
+                    help='Data type of the binary sentence vector shards. Default float32')
+    #reading, NLP and writing overlapped inside each worker
+    parser.add_argument('--io_queue_size', type=int, default=4, const=4, nargs='?',
+                    help='Number of papers read ahead by a prefetching thread and waiting for a writer thread in each worker, so that the NLP does not wait on the disk. 0 reads, processes and writes one paper at a time. Default 4')
+    #per-stage timing of every paper
+    parser.add_argument('--stage_metrics', type=str2bool, default=True, nargs='?', const=True,
+                    help="Record the time spent in each pipeline stage for every paper in preprocessed/metrics and print a stage breakdown, latency percentiles and the slowest papers at the end of the run. Default True")
+    #batched nlp.pipe processing
+    parser.add_argument('--batch_size', type=int, default=None, const=64, nargs='?',
+                    help='Stream the sections and sentences of each paper through nlp.pipe in batches of this size. Default None (one nlp call per section/sentence)')
+    parser.add_argument('--n_process', type=int, default=1, const=1, nargs='?',
+                    help='Number of processes used by nlp.pipe within each worker in the batched mode. Default 1')
+    parser.add_argument('--max_section_chars', type=int, default=0, const=50000, nargs='?',
+                    help='Sections longer than this many characters are cut at paragraph or sentence boundaries and processed piece by piece, and the batches of the batched mode hold texts of similar length and at most this many characters. The sentences at the cuts, and so their ids and entities, can differ from the output of whole sections. Default 0 (the sections are kept whole)')
+    parser.add_argument('--ner_pipeline', type=str, default="ner", const="ner", nargs='?', choices=["full", "ner", "shared"],
+                    help='Components of the NER models: "full" runs their whole pipeline, "ner" leaves out the tagger and parser the output does not use, "shared" also reuses the tokens of en_core_sci_lg instead of tokenizing every sentence again. Default ner')
+    parser.add_argument('--abbreviation_mode', type=str, default="detect", const="detect", nargs='?', choices=["reparse", "detect"],
+                    help='How the abbreviations of en_core_sci_lg are expanded: "reparse" parses every section, expands its abbreviations and parses it again, "detect" finds them with a pipeline reduced to the parser and the abbreviation detector before a single full parse. Default detect')
     #en_core_sci_lg
     parser.add_argument('--en_core_sci_lg', type=str2bool, default=True, nargs='?', const=True,
                         help="A full spaCy pipeline for biomedical data with a larger vocabulary and 600k word vectors.")
@@ -40,10 +117,39 @@ def main():
                         help="A spaCy NER model trained on the BIONLP13CG corpus.")
     
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    #wall time of the stages of the run
+    timings = {}
+    run_start = time.perf_counter()
     
     assert args.CORD19_path != None, "you should specify a path to CORD19 collection"
     
+    #gather SciSpacy model preferences and pack them into chunks for each process
+    model_dict = {"description":"""
+    A dictionary of SciSpacy model preferences specified by the user. 
+    By default all models will be loaded"""}
+    model_dict["en_core_sci_lg"] = args.en_core_sci_lg 
+    model_dict["en_ner_craft_md"] = args.en_ner_craft_md 
+    model_dict["en_ner_jnlpba_md"] = args.en_ner_jnlpba_md 
+    model_dict["en_ner_bc5cdr_md"] = args.en_ner_bc5cdr_md
+    model_dict["en_ner_bionlp13cg_md"] = args.en_ner_bionlp13cg_md
+    model_dict["stub_models"] = args.stub_models
+    model_dict["batch_size"] = args.batch_size
+    model_dict["n_process"] = args.n_process
+    model_dict["ner_pipeline"] = args.ner_pipeline
+    model_dict["abbreviation_mode"] = args.abbreviation_mode
+    model_dict["max_section_chars"] = args.max_section_chars
+    model_dict["translation_backend"] = args.translation_backend
+    model_dict["umls_cache_size"] = args.umls_cache_size
+    model_dict["umls_cache_path"] = os.path.join("preprocessed", "umls_cache.sqlite") if args.umls_cache_persist else None
+    model_dict["sent2vec_mode"] = args.sent2vec_mode
+    model_dict["output_format"] = args.output_format
+    model_dict["vector_store"] = args.vector_store
+    model_dict["vector_dtype"] = args.vector_dtype
+    model_dict["io_queue_size"] = args.io_queue_size
+    #the workers write their stage timings to files named after the run
+    model_dict["metrics_run_id"] = time.strftime("%Y%m%d-%H%M%S") + "-{}".format(os.getpid()) if args.stage_metrics else None
+    
     if args.delta == None:
         print("No delta file specified. The pipeline will process the whole collection.")
         delta_sha_list = False
@@ -51,16 +157,35 @@ def main():
         with open(args.delta) as f:
             delta_file = json.load(f)
             delta_sha_list = delta_file["delta list"]
-            delta_sha_list = ''.join(delta_sha_list)
+            delta_sha_list = set(delta_sha_list)
     
     # Preprocess the metadata to get folder and subfolder structre and the names of files
-    files, paths_to_files = preprocess_metadata(args.CORD19_path)
+    stage_start = time.perf_counter()
+    discovery_index = os.path.join("preprocessed", "discovery_index.json") if args.discovery_cache else None
+    files, paths_to_files, file_size_list, file_mtime_list, metadata_keys = preprocess_metadata(args.CORD19_path, discovery_index)
+    file_mtimes = dict(zip(paths_to_files, file_mtime_list))
+    if args.duplicate_policy == None:
+        #a folder processed before the planning has the outputs of every parse: switching to pmc would
+        #change the paper_id of the papers with a PMC parse and leave their <sha>.json outputs behind
+        args.duplicate_policy = load_setting(manifest_path("preprocessed"), "duplicate_policy")
+        if args.duplicate_policy == None and os.path.exists(manifest_path("preprocessed")):
+            args.duplicate_policy = "all"
+            print("The preprocessed folder was processed before the duplicate planning: all parses are kept, as in the runs before. Pass --duplicate_policy to change it.")
+        elif args.duplicate_policy == None:
+            args.duplicate_policy = "pmc"
+    #keep one parse per cord_uid
+    files, paths_to_files, file_size_list, planning_report = plan_papers(args.CORD19_path, files, paths_to_files, file_size_list,
+                                                                         args.duplicate_policy, metadata_keys)
+    print_planning_report(planning_report)
     #files, paths_to_files = files[:100], paths_to_files[:100]
     if delta_sha_list:
         old_doc_nubmer = len(files)
-        files_and_paths = [(file, file_path) for (file, file_path) in zip(files, paths_to_files) if file not in delta_sha_list]
+        files_and_paths = [(file, file_path, file_size) for (file, file_path, file_size) in zip(files, paths_to_files, file_size_list)
+                           if file not in delta_sha_list]
         print(len(files_and_paths))
-        files, paths_to_files = zip(*files_and_paths)
+        files = [file for (file, _, _) in files_and_paths]
+        paths_to_files = [file_path for (_, file_path, _) in files_and_paths]
+        file_size_list = [file_size for (_, _, file_size) in files_and_paths]
         new_doc_number = len(files)
         print("""
            A Delta file for CORD19 database has been applied. 
@@ -72,56 +197,145 @@ def main():
     #quit()
     #paths_to_files = paths_to_files[:100]
     #print(paths_to_files)
-    file_size_list = [os.path.getsize(x) for x in paths_to_files]
     pathsAndFileSizes = list(zip(paths_to_files,file_size_list))
-    paths_to_files_sorted, file_size_list_sorted = zip(*sorted(pathsAndFileSizes, key = lambda x: x[1]))
-    paths_to_files_sorted = list(paths_to_files_sorted)
-    random.shuffle(paths_to_files_sorted)
+    
+    if args.resume:
+        manifest = load_manifest(manifest_path("preprocessed"))
+        current_config_hash = config_hash(model_dict)
+        outputs = existing_outputs(manifest)
+        old_doc_number = len(pathsAndFileSizes)
+        pathsAndFileSizes = [(path, size) for (path, size) in pathsAndFileSizes
+                             if not is_up_to_date(manifest.get(file_sha(path)), path, size, file_mtimes[path], current_config_hash, outputs)]
+        if len(pathsAndFileSizes) < old_doc_number:
+            print("""
+           The processing manifest has been applied. 
+           {} files are already up to date, {} of them will be annotated. 
+            """.format(old_doc_number - len(pathsAndFileSizes), len(pathsAndFileSizes)))
+    
+    timings["discovery_s"] = time.perf_counter() - stage_start
     
     if args.max_n_files != None:
-        paths_to_files_sorted = paths_to_files_sorted[:args.max_n_files]
+        #a random subset of the collection
+        random.shuffle(pathsAndFileSizes)
+        pathsAndFileSizes = pathsAndFileSizes[:args.max_n_files]
+    
+    #small tasks, the largest files first
+    tasks = size_ordered_tasks(pathsAndFileSizes, args.task_size)
     
     print("""
-       We are going to process {} files from CORD19 database. 
-    """.format(len(paths_to_files_sorted)))
+       We are going to process {} files from CORD19 database in {} tasks. 
+    """.format(len(pathsAndFileSizes), len(tasks)))
        
+    #translate the non-English papers before the NLP workers start, so that they
+    #find the translations in the cache and never wait on the network
+    stage_start = time.perf_counter()
+    if pathsAndFileSizes:
+        if not os.path.exists("preprocessed"):
+            os.mkdir("preprocessed")
+        n_translated = translation_stage([path for path, _ in pathsAndFileSizes], args.translation_backend,
+                                         os.path.join("preprocessed", CACHE_NAME), args.translation_threads, args.translation_batch_size,
+                                         args.language_processes)
+        print("""
+       {} non-English files have been translated. 
+        """.format(n_translated))
+        init_manifest(manifest_path("preprocessed"))
+        record_setting(manifest_path("preprocessed"), "duplicate_policy", args.duplicate_policy)
+    
+    timings["translation_s"] = time.perf_counter() - stage_start
+    
+    if model_dict["ner_pipeline"] == "shared" and pathsAndFileSizes:
+        #the shared tokens are used only if they give the entities of the separate tokenizers on the first papers
+        same_entities = check_shared_tokens(model_dict, sample_texts([path for path, _ in pathsAndFileSizes]), args.batch_size)
+        if not same_entities or not args.preload_models:
+            unload_models(model_dict)
+        if not same_entities:
+            model_dict["ner_pipeline"] = "ner"
+            print("""
+       The NER models find other entities on the shared tokens than with their own tokenizers
+       on the first papers: the run uses --ner_pipeline ner instead.
+            """)
+    
+    #with preloaded models each worker needs RAM only for its own working data
+    if args.RAM_per_worker == None:
+        args.RAM_per_worker = 3 if args.preload_models else 12
+    
+    stage_start = time.perf_counter()
+    parent_memory = None
+    if args.preload_models:
+        if mp.get_start_method() != "fork":
+            print("Model preloading needs the 'fork' start method; the workers will load their own models.")
+        else:
+            #the models must be loaded before the pool forks its workers
+            preload_models(model_dict)
+            parent_memory = process_memory()
+    timings["preload_s"] = time.perf_counter() - stage_start
+    
     #'pipeline' function is supposed to be sent to each process and digest a sublist of
     cpu_n = cpu_count()
     mem = virtual_memory()
-    ram_size_gib= mem.free/1024**3 #or mem.total
+    #available memory includes the page cache the system can reclaim
+    ram_size_gib= mem.available/1024**3 #or mem.total
     
-    n_cpus_realistic = int(ram_size_gib/args.RAM_per_worker)
+    n_cpus_realistic = max(1, int(ram_size_gib/args.RAM_per_worker))
     cpu_number = min(cpu_n,n_cpus_realistic)
-    pool = ProcessPool(nodes=cpu_number)
-    paths_chunks = chunking(paths_to_files_sorted,cpu_number)
+    supervisor = None
+    if args.n_workers != None:
+        cpu_number = args.n_workers
+    elif args.adaptive_workers:
+        #up to a worker per CPU, starting with as many as the memory budget allows
+        supervisor = MemorySupervisor(cpu_n, initial_workers(args.RAM_per_worker, cpu_n), args.memory_reserve)
+        cpu_number = cpu_n
     
-    #gather SciSpacy model preferences and pack them into chunks for each process
-    model_dict = {"description":"""
-    A dictionary of SciSpacy model preferences specified by the user. 
-    By default all models will be loaded"""}
-    model_dict["en_core_sci_lg"] = args.en_core_sci_lg 
-    model_dict["en_ner_craft_md"] = args.en_ner_craft_md 
-    model_dict["en_ner_jnlpba_md"] = args.en_ner_jnlpba_md 
-    model_dict["en_ner_bc5cdr_md"] = args.en_ner_bc5cdr_md
-    model_dict["en_ner_bionlp13cg_md"] = args.en_ner_bionlp13cg_md
+    models_selected = ["--"+k for k in SCISPACY_MODELS if model_dict[k] == True]
     
-    models_selected = ["--"+k for k,v in model_dict.items() if type(v) == bool and v == True]
+    if supervisor is not None:
+        print("""
+       We have up to {} workers, starting with {} ({} GiB RAM per worker until measured).
+       User-specified models for annotation:
+       {}
     
-    print("""
+    """.format(cpu_number, supervisor.target, args.RAM_per_worker, "\n       ".join(models_selected)))
+    else:
+        print("""
        We have {} workers with at least {} GiB RAM free per worker.
        User-specified models for annotation:
        {}
-       {}
-       {}
-       {}
-       {}
     
-    """.format(cpu_number, args.RAM_per_worker, *models_selected))
+    """.format(cpu_number, args.RAM_per_worker, "\n       ".join(models_selected)))
+    
+    #hand the tasks out to the workers as they become free
+    stage_start = time.perf_counter()
+    results, failed_files = schedule(tasks, model_dict, cpu_number, args.max_retries, supervisor=supervisor)
+    timings["nlp_s"] = time.perf_counter() - stage_start
+    timings["total_s"] = time.perf_counter() - run_start
+    
+    if failed_files:
+        print("""
+       {} files could not be processed because their workers crashed:
+       {}
+        """.format(len(failed_files), "\n       ".join(failed_files)))
+    print_memory_report(parent_memory, results)
+    print_scaling_report(supervisor)
+    print_cache_report([result.get("umls_cache") for result in results if isinstance(result, dict)])
+    stage_metrics = None
+    if args.stage_metrics:
+        metrics_folder = os.path.join("preprocessed", METRICS_FOLDER)
+        stage_metrics = aggregate_metrics(metrics_folder, model_dict["metrics_run_id"])
+        print_metrics_report(stage_metrics)
+        if stage_metrics["n_papers"]:
+            with open(os.path.join(metrics_folder, model_dict["metrics_run_id"] + "_summary.json"), "w") as f:
+                json.dump(stage_metrics, f, indent=2)
     
-    #each process is supposed to receive one copy of the model_dict.
-    model_preferences_list = [model_dict] * cpu_number
-    #send file path chunks to a pool of workers
-    results = pool.map(pipeline, paths_chunks, list(range(cpu_number)), model_preferences_list)
+    #summary of the run, e.g. for the benchmarks
+    return {"n_workers": cpu_number,
+            "n_files": len(pathsAndFileSizes),
+            "planning": planning_report,
+            "failed_files": failed_files,
+            "timings": timings,
+            "parent_memory": parent_memory,
+            "stage_metrics": stage_metrics,
+            "worker_scaling": supervisor.history if supervisor is not None else None,
+            "worker_reports": [result for result in results if isinstance(result, dict)]}
     
            
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import os, warnings
+from queue import Empty
+from tqdm import tqdm
+from psutil import Process, NoSuchProcess, STATUS_ZOMBIE
+from pathos.pools import ProcessPool
+from pathos.helpers import mp
+
+# The files are handed out in small tasks, the largest first, through a queue
+# shared with the workers. Every worker runs a stream: its prefetching thread
+# takes the next tasks from the queue and reads their files while the current
+# paper is parsed, and its writer thread writes the previous papers, so that
+# reading, NLP and writing overlap from one task to the next and the output is
+# waited for only once, when the stream ends. The workers report the tasks
+# they take and finish on an event queue, which the main process uses for the
+# progress bar, to re-queue the tasks of crashed workers and to run as many
+# streams as the supervisor allows. Every stream has a pool of one process of
+# its own: only the workers in use exist, and a stream stopped by the
+# supervisor ends with its process once its output is written, instead of
+# the process being killed.
+
+
+def size_ordered_tasks(paths_and_sizes, task_size):
+    #largest papers first, so that the slowest tasks start early and
+    #the small ones fill up the gaps at the end of the run
+    ordered = sorted(paths_and_sizes, key=lambda x: x[1], reverse=True)
+    paths = [path for path, size in ordered]
+    return [paths[i:i+task_size] for i in range(0, len(paths), task_size)]
+
+def run_stream(stream):
+    #executed by a worker: the stream is (slot, work_queue, events, control, model_prefs_dict)
+    slot, work_queue, events, control, model_prefs_dict = stream
+    pid = os.getpid()
+    events.put(("start", slot, pid))
+    #task of every path taken from the queue, and the number of files of each task not written yet
+    task_of_path = {}
+    n_left = {}
+
+    def paths():
+        #run by the prefetching thread: the tasks of the queue, until the queue is
+        #closed or the supervisor allows fewer streams than this slot
+        while control["target"] > slot:
+            try:
+                task_nb, attempt, task_paths = work_queue.get(timeout=0.2)
+            except Empty:
+                if control["closed"]:
+                    return
+                continue
+            events.put(("take", task_nb, attempt, pid))
+            n_left[(task_nb, attempt)] = len(task_paths)
+            for path in task_paths:
+                task_of_path[path] = (task_nb, attempt)
+                yield path
+
+    def done(path):
+        #run by the writer once a file is written and recorded in the manifest
+        task = task_of_path.pop(path)
+        n_left[task] -= 1
+        if n_left[task] == 0:
+            del n_left[task]
+            events.put(("done",) + task)
+
+    from Pipeline_v19 import pipeline
+    return pipeline(paths(), slot, model_prefs_dict, show_progress=False, on_done=done)
+
+def _is_dead(pid):
+    try:
+        return Process(pid).status() == STATUS_ZOMBIE
+    except NoSuchProcess:
+        return True
+
+def _start_stream(stream_nb, stream):
+    #a pool of one process per stream, created when the stream is started
+    pool = ProcessPool(nodes=1, id="cord19_stream_{}_{}".format(os.getpid(), stream_nb))
+    return pool, pool.apipe(run_stream, stream)
+
+def _stop_pool(pool, terminate=False):
+    #close: the worker exits normally once its stream has returned
+    if terminate:
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+    pool.clear()
+
+def _next_events(events, timeout):
+    #wait for an event, then take all the ones already there
+    found = []
+    try:
+        found.append(events.get(timeout=timeout))
+        while True:
+            found.append(events.get_nowait())
+    except Empty:
+        pass
+    return found
+
+def schedule(tasks, model_prefs_dict, n_workers, max_retries=0, poll_interval=1.0, supervisor=None):
+    """
+    Run n_workers worker processes (or as many as the supervisor, a
+    Supervisor.MemorySupervisor, allows at a time) that take the tasks from a
+    shared queue, and collect the report of every worker. With max_retries > 0
+    the tasks taken by a worker that died (segfault, OOM killer...) are
+    re-queued for another one. Returns the reports of the workers and the list
+    of paths that could not be processed.
+    """
+    pbar = tqdm(total=sum(len(paths) for paths in tasks))
+    pbar.set_description("Preprocessing json files")
+    results = []
+    failed = []
+
+    #the queues live in a manager process, so that the streams can take them as arguments
+    manager = mp.Manager()
+    work_queue, events, control = manager.Queue(), manager.Queue(), manager.dict()
+    for task_nb, paths in enumerate(tasks):
+        work_queue.put((task_nb, 0, paths))
+    control["target"] = target = 0
+    control["closed"] = False
+    #slot -> (pool, async result) of the running streams and pid of their worker
+    streams = {}
+    stream_pids = {}
+    n_streams = 0
+    #(task_nb, attempt) -> pid of the worker that took it
+    taken = {}
+    finished = set()
+    dead = {}
+
+    def is_dead(pid):
+        if pid not in dead:
+            dead[pid] = _is_dead(pid)
+        return dead[pid]
+
+    while len(finished) < len(tasks) or streams:
+        if len(finished) == len(tasks) and not control["closed"]:
+            #the streams end once their output is written
+            control["closed"] = True
+        elif len(finished) < len(tasks):
+            new_target = supervisor.target if supervisor is not None else n_workers
+            if new_target != target:
+                control["target"] = target = new_target
+            for slot in range(target):
+                if slot not in streams:
+                    streams[slot] = _start_stream(n_streams, (slot, work_queue, events, control, model_prefs_dict))
+                    n_streams += 1
+        for event in _next_events(events, poll_interval if streams else 0):
+            if event[0] == "start":
+                stream_pids[event[1]] = event[2]
+            elif event[0] == "take":
+                taken[(event[1], event[2])] = event[3]
+            elif event[0] == "done":
+                taken.pop((event[1], event[2]), None)
+                #a task re-queued for a worker that was wrongly taken for dead is counted once
+                if event[1] not in finished:
+                    finished.add(event[1])
+                    pbar.update(len(tasks[event[1]]))
+        #the processes are looked up once per round
+        dead.clear()
+        for slot, (pool, async_result) in list(streams.items()):
+            if async_result.ready():
+                results.append(async_result.get())
+                _stop_pool(pool)
+                del streams[slot]
+                stream_pids.pop(slot, None)
+                if supervisor is not None and slot >= target and len(finished) < len(tasks):
+                    supervisor.n_retired += 1
+            elif slot in stream_pids and is_dead(stream_pids[slot]):
+                #the stream died with its worker: the pool has replaced the worker by an idle one,
+                #which goes with the pool, and the slot gets a new stream
+                _stop_pool(pool, terminate=True)
+                del streams[slot]
+                del stream_pids[slot]
+        for (task_nb, attempt), pid in list(taken.items()):
+            if task_nb in finished:
+                del taken[(task_nb, attempt)]
+                continue
+            if not is_dead(pid):
+                continue
+            del taken[(task_nb, attempt)]
+            if attempt < max_retries:
+                warnings.warn("Worker {} died while processing task {}, re-queueing it (attempt {} of {})".format(
+                    pid, task_nb, attempt+1, max_retries))
+                work_queue.put((task_nb, attempt+1, tasks[task_nb]))
+            else:
+                warnings.warn("Worker {} died while processing task {}, giving up on files: {}".format(
+                    pid, task_nb, tasks[task_nb]))
+                failed.extend(tasks[task_nb])
+                finished.add(task_nb)
+                pbar.update(len(tasks[task_nb]))
+        if supervisor is not None and supervisor.due():
+            supervisor.update([stream_pids[slot] for slot in streams if slot in stream_pids], len(finished))
+
+    manager.shutdown()
+    pbar.close()
+    return results, failed
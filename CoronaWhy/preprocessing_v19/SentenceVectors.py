@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import time, argparse
+import numpy as np
+
+# The sent2vec of a sentence is the sum of the vectors of its non-stop tokens.
+# Instead of stacking token.vector copies sentence by sentence, the vector rows
+# of all the tokens of a doc are gathered from the vocab vector table at once
+# and summed per sentence with a single np.add.reduceat.
+SENT2VEC_MODES = ["sum", "mean", "l2"]
+
+
+def reduce_sentence_vectors(table, rows, token_sentences, n_sentences, mode="sum"):
+    """
+    table: (n_vectors, dim) vector table, rows: vector row of every kept token
+    (-1 for tokens without a vector), token_sentences: sentence number of every
+    kept token, in increasing order. Returns an (n_sentences, dim) array and
+    the number of tokens of each sentence.
+    """
+    counts = np.bincount(token_sentences, minlength=n_sentences)
+    sums = np.zeros((n_sentences, table.shape[1]), dtype=table.dtype)
+    #a pipeline without word vectors has an empty table
+    if len(rows) > 0 and table.shape[0] > 0:
+        gathered = table[np.maximum(rows, 0)]
+        #tokens without a vector count as zero vectors, like token.vector
+        gathered[rows < 0] = 0
+        nonempty = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums[nonempty] = np.add.reduceat(gathered, starts[nonempty], axis=0)
+    if mode == "mean":
+        sums[counts > 0] /= counts[counts > 0, None]
+    elif mode == "l2":
+        norms = np.linalg.norm(sums, axis=1)
+        sums[norms > 0] /= norms[norms > 0, None]
+    return sums, counts
+
+def sentence_vectors(doc, sentences, mode="sum"):
+    #sent2vec of each sentence of the doc, or [] for sentences made of stop words only
+    #and for every sentence when the vocab has no vectors
+    from spacy.attrs import ORTH, IS_STOP
+    attrs = doc.to_array([ORTH, IS_STOP])
+    lengths = [sentence.end - sentence.start for sentence in sentences]
+    token_sentences = np.repeat(np.arange(len(sentences)), lengths)
+    kept = attrs[:, 1] == 0
+    rows = doc.vocab.vectors.find(keys=attrs[kept, 0])
+    sums, counts = reduce_sentence_vectors(doc.vocab.vectors.data, np.asarray(rows), token_sentences[kept], len(sentences), mode)
+    return [vector if count > 0 and vector.size > 0 else [] for vector, count in zip(sums, counts)]
+
+
+def _loop_sentence_vectors(table, sentences):
+    #the former implementation: a stacked copy of the token vectors per sentence
+    vectors = []
+    for sentence in sentences:
+        token_vectors = [table[row] for row in sentence]
+        vectors.append(np.stack(token_vectors, axis=0).sum(0) if token_vectors else [])
+    return vectors
+
+def benchmark(n_docs=2000, sentences_per_doc=20, sentence_length=25, n_vectors=100000, dim=200):
+    """
+    Time the per-sentence loop against the vectorized reduction on random
+    docs (sections) drawn from a random vector table, one call per doc as
+    in the pipeline.
+    """
+    rng = np.random.RandomState(0)
+    table = rng.rand(n_vectors, dim).astype("float32")
+    docs = []
+    for _ in range(n_docs):
+        lengths = rng.randint(0, sentence_length * 2, sentences_per_doc)
+        rows = rng.randint(0, n_vectors, lengths.sum())
+        docs.append((rows, np.repeat(np.arange(sentences_per_doc), lengths), np.split(rows, np.cumsum(lengths)[:-1])))
+
+    start = time.perf_counter()
+    loop_vectors = [_loop_sentence_vectors(table, sentences) for _, _, sentences in docs]
+    timings = {"loop": time.perf_counter() - start}
+    start = time.perf_counter()
+    reduced = [reduce_sentence_vectors(table, rows, token_sentences, sentences_per_doc) for rows, token_sentences, _ in docs]
+    timings["reduceat"] = time.perf_counter() - start
+
+    #the summation order differs, so the sums match up to float32 rounding
+    max_difference = max(float(np.abs(a - b).max()) for doc_loop, (sums, counts) in zip(loop_vectors, reduced)
+                         for a, b, count in zip(doc_loop, sums, counts) if count > 0)
+    return timings, max_difference
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Micro-benchmark of the sentence vector computation.')
+    parser.add_argument('--n_docs', type=int, default=2000)
+    parser.add_argument('--sentences_per_doc', type=int, default=20)
+    parser.add_argument('--sentence_length', type=int, default=25)
+    args = parser.parse_args()
+    timings, max_difference = benchmark(args.n_docs, args.sentences_per_doc, args.sentence_length)
+    print("loop: {:.3f} s, reduceat: {:.3f} s ({:.1f}x), max. absolute difference: {:.2e}".format(
+        timings["loop"], timings["reduceat"], timings["loop"] / timings["reduceat"], max_difference))
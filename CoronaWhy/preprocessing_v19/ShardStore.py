@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import os, json, gzip
+
+# Instead of one JSON file per paper, each worker can append its papers to its
+# own shard preprocessed/shards/papers_<pid>.jsonl.gz. Every paper is written
+# as a separate gzip member, so the whole shard is still a valid gzip file of
+# JSON lines, while a single paper can be decompressed from its (offset, length).
+# Next to each shard an index of JSON lines maps the paper to its position
+# and lists the ids of its sentences.
+SHARD_FOLDER = "shards"
+
+_writers = {}
+
+
+def sentence_ids(preprocessed_file):
+    return [k for k, v in preprocessed_file.items() if isinstance(v, dict) and "sentence_id" in v]
+
+
+class ShardWriter:
+
+    def __init__(self, folder):
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.name = "papers_{}.jsonl.gz".format(os.getpid())
+        self.path = os.path.join(folder, self.name)
+        self.index_path = os.path.join(folder, "papers_{}.idx.jsonl".format(os.getpid()))
+
+    def write(self, preprocessed_file):
+        #append the paper and return the path of the shard
+        member = gzip.compress((json.dumps(preprocessed_file, ensure_ascii=False) + "\n").encode("utf-8"))
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            f.write(member)
+        #the index line is written only once the paper is on the disk
+        entry = {"paper_id": preprocessed_file["paper_id"], "shard": self.name, "offset": offset,
+                 "length": len(member), "sentence_ids": sentence_ids(preprocessed_file)}
+        with open(self.index_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+        return self.path
+
+
+def get_shard_writer(folder):
+    #one writer per process and folder
+    if folder not in _writers:
+        _writers[folder] = ShardWriter(folder)
+    return _writers[folder]
+
+
+class ShardReader:
+    """
+    Random access to the papers and sentences of a folder of shards.
+    The indices are read once, a paper is then read with a single seek.
+    The sentence index (an entry per sentence of the corpus) is only built
+    by the first get_sentence.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        #paper_id -> (shard, offset, length)
+        self.papers = {}
+        self.sentences = None
+        for entry in self._index_entries():
+            #a paper processed again later replaces the older copy
+            self.papers[entry["paper_id"]] = (entry["shard"], entry["offset"], entry["length"])
+
+    def _index_entries(self):
+        for name in sorted(os.listdir(self.folder)):
+            if not name.endswith(".idx.jsonl"):
+                continue
+            with open(os.path.join(self.folder, name), encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def _sentence_index(self):
+        #sentence_id -> paper_id, in the order of the indices so that the latest copy wins
+        if self.sentences is None:
+            self.sentences = {}
+            for entry in self._index_entries():
+                for sentence_id in entry["sentence_ids"]:
+                    self.sentences[sentence_id] = entry["paper_id"]
+        return self.sentences
+
+    def paper_ids(self):
+        return list(self.papers.keys())
+
+    def get_paper(self, paper_id):
+        shard, offset, length = self.papers[paper_id]
+        with open(os.path.join(self.folder, shard), "rb") as f:
+            f.seek(offset)
+            return json.loads(gzip.decompress(f.read(length)).decode("utf-8"))
+
+    def get_sentence(self, sentence_id):
+        return self.get_paper(self._sentence_index()[sentence_id])[sentence_id]
+
+    def iter_papers(self):
+        for paper_id in self.papers:
+            yield self.get_paper(paper_id)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import os, threading
+from queue import Queue, Full
+
+# Inside a worker the papers go through three stages connected by bounded
+# queues: a reader thread that reads and parses the next JSON files ahead of
+# time, the NLP in the worker's main thread and a writer thread that writes
+# the output and records the papers in the manifest. File I/O releases the
+# GIL, so a slow (network) disk and the NLP keep each other busy. The queue
+# sizes cap the number of papers held in memory on either side.
+
+_END = object()
+
+
+def prefetch(items, read, depth=4):
+    """
+    Yield read(item) in the order of items while a thread reads up to depth
+    items ahead. An exception raised by read is raised by the generator at the
+    position of its item.
+    """
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(result):
+        #give up when the consumer is gone
+        while not stop.is_set():
+            try:
+                queue.put(result, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def reader():
+        for item in items:
+            try:
+                result = (read(item), None)
+            except Exception as e:
+                result = (None, e)
+            if not put(result):
+                return
+        put(_END)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result = queue.get()
+            if result is _END:
+                return
+            value, error = result
+            if error is not None:
+                raise error
+            yield value
+    finally:
+        stop.set()
+
+
+class AsyncWriter:
+    #a thread running the output functions in order, at most depth of them waiting
+
+    def __init__(self, depth=4):
+        self.queue = Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            function, args = self.queue.get()
+            try:
+                #after an error the remaining output is dropped, drain() raises it
+                if self.error is None:
+                    function(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def submit(self, function, *args):
+        if self.error is not None:
+            self.drain()
+        self.queue.put((function, args))
+
+    def drain(self):
+        #wait for all the submitted output, e.g. before a task reports back
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+_async_writers = {}
+
+def get_async_writer(depth=4):
+    #one writer thread per process, the SQLite connection of the manifest stays in it
+    if os.getpid() not in _async_writers:
+        _async_writers[os.getpid()] = AsyncWriter(depth)
+    return _async_writers[os.getpid()]
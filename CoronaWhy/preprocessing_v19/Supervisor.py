@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import time
+from psutil import Process, NoSuchProcess, AccessDenied, virtual_memory
+
+# Adaptive number of workers. The scheduler runs as many worker processes as
+# the supervisor allows, starting with the number the memory budget allows
+# (RAM_per_worker), up to the number of CPUs. The supervisor measures the
+# unique memory (USS) of the workers, i.e. the real footprint of a worker with
+# the selected models and of the papers it works on, and compares it with the
+# memory still available to the system (page cache included, unlike free
+# memory). The number of workers grows while there is room for another worker
+# at its measured peak, and shrinks before the OOM killer steps in: the
+# workers beyond the target take no new task, write their output and exit.
+GIB = 1024**3
+
+
+class MemorySupervisor:
+
+    def __init__(self, max_workers, initial_workers, reserve_gib=2.0, warmup_tasks=1, sample_interval=5.0, verbose=True):
+        self.max_workers = max_workers
+        self.target = max(1, min(initial_workers, max_workers))
+        self.reserve_gib = reserve_gib
+        self.warmup_tasks = warmup_tasks
+        self.sample_interval = sample_interval
+        self.verbose = verbose
+        #largest unique memory of a worker seen so far
+        self.footprint_gib = None
+        self.worker_uss_gib = {}
+        self.history = []
+        self.n_retired = 0
+        self._last_sample = 0.0
+        self._start = time.perf_counter()
+        self._log("start", virtual_memory().available/GIB)
+
+    def _log(self, reason, available_gib):
+        entry = {"elapsed_s": round(time.perf_counter() - self._start, 1), "target": self.target,
+                 "footprint_gib": self.footprint_gib, "available_gib": round(available_gib, 2), "reason": reason}
+        self.history.append(entry)
+        if self.verbose:
+            print("Workers: {} ({}; available {:.1f} GiB, worker footprint {})".format(
+                self.target, reason, available_gib,
+                "{:.2f} GiB".format(self.footprint_gib) if self.footprint_gib is not None else "not measured yet"))
+
+    def _sample(self, worker_pids):
+        #workers waiting for a task keep the memory of their models and last papers too
+        self.worker_uss_gib = {}
+        for pid in worker_pids:
+            try:
+                self.worker_uss_gib[pid] = Process(pid).memory_full_info().uss/GIB
+            except (NoSuchProcess, AccessDenied):
+                pass
+        if self.worker_uss_gib:
+            self.footprint_gib = max(self.footprint_gib or 0.0, max(self.worker_uss_gib.values()))
+
+    def due(self):
+        #memory_full_info reads the page maps of the processes, so not at every poll
+        return time.perf_counter() - self._last_sample >= self.sample_interval
+
+    def update(self, worker_pids, n_finished):
+        """
+        Called by the scheduler when due() with the pids of the running
+        workers and the number of finished tasks. Returns the number of
+        workers that may run.
+        """
+        self._last_sample = time.perf_counter()
+        self._sample(worker_pids)
+        available_gib = virtual_memory().available/GIB
+        #the workers that haven't reached the footprint yet will still grow
+        growth = sum(max(0.0, (self.footprint_gib or 0.0) - self.worker_uss_gib.get(pid, 0.0)) for pid in worker_pids)
+        headroom = available_gib - self.reserve_gib - growth
+        target, reason = self.target, None
+        if headroom < 0:
+            #backpressure: one worker less, it exits once its output is written
+            target, reason = max(1, min(self.target, len(worker_pids)) - 1), "backpressure"
+        elif n_finished >= self.warmup_tasks and self.footprint_gib:
+            target = max(1, min(self.max_workers, len(worker_pids) + int(headroom / self.footprint_gib)))
+            reason = "scale up" if target > self.target else "scale down"
+        if target != self.target:
+            self.target = target
+            self._log(reason, available_gib)
+        return self.target
+
+
+def initial_workers(ram_per_worker_gib, max_workers):
+    #first guess from the available memory, corrected once the workers are measured
+    return max(1, min(max_workers, int(virtual_memory().available/GIB / ram_per_worker_gib)))
+
+def print_scaling_report(supervisor):
+    if supervisor is None:
+        return
+    targets = [entry["target"] for entry in supervisor.history]
+    print("""
+       Adaptive workers: between {} and {} workers, {} changes, {} workers retired, measured worker footprint {}
+    """.format(min(targets), max(targets), len(targets) - 1, supervisor.n_retired,
+               "{:.2f} GiB".format(supervisor.footprint_gib) if supervisor.footprint_gib is not None else "n/a"))
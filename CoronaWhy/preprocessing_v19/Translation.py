@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import os, json, sqlite3, hashlib, threading, warnings
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from tqdm import tqdm
+
+# Translation of non-English papers runs as a stage of its own in the main
+# process, before the NLP workers start. It detects the language of every
+# file on a pool of processes (langdetect is pure Python and holds the GIL),
+# translates the unique section texts and titles of the non-English files in
+# batches on a pool of threads and stores the translations in a persistent
+# cache keyed by the hash of the text, with the language found for each file.
+# The NLP workers then only read the cache, with a translator that never
+# calls the backend.
+CACHE_NAME = "translation_cache.sqlite"
+
+
+class StubBackend:
+    #offline backend for tests and development, returns the text as it is
+    name = "stub"
+
+    def translate_batch(self, texts):
+        return list(texts)
+
+
+class GoogleTransBackend:
+    name = "googletrans"
+
+    def __init__(self):
+        #googletrans Translator objects are not thread-safe, one per thread
+        self._local = threading.local()
+
+    def translate_batch(self, texts):
+        from googletrans import Translator
+        if not hasattr(self._local, "translator"):
+            self._local.translator = Translator()
+        return [x.text for x in self._local.translator.translate(list(texts), dest='en')]
+
+
+class MarianBackend:
+    #local multilingual to English model, needs the transformers library
+    name = "marian"
+
+    def __init__(self, model_name="Helsinki-NLP/opus-mt-mul-en"):
+        from transformers import MarianMTModel, MarianTokenizer
+        self.tokenizer = MarianTokenizer.from_pretrained(model_name)
+        self.model = MarianMTModel.from_pretrained(model_name)
+        self._lock = threading.Lock()
+
+    def translate_batch(self, texts):
+        with self._lock:
+            batch = self.tokenizer(list(texts), return_tensors="pt", padding=True, truncation=True)
+            generated = self.model.generate(**batch)
+            return self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+
+
+BACKENDS = {"googletrans": GoogleTransBackend, "stub": StubBackend, "marian": MarianBackend}
+
+
+def text_key(backend_name, text):
+    return hashlib.sha1((backend_name + "\0" + text).encode("utf-8")).hexdigest()
+
+
+class TranslationCache:
+
+    def __init__(self, path):
+        self.path = path
+        #a connection per process, so that the forked workers don't share the parent's
+        self._connections = {}
+
+    def _connect(self):
+        if os.getpid() not in self._connections:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, translation TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS languages (path TEXT PRIMARY KEY, language TEXT)")
+            conn.commit()
+            self._connections[os.getpid()] = conn
+        return self._connections[os.getpid()]
+
+    def get_many(self, keys):
+        conn = self._connect()
+        found = {}
+        keys = list(keys)
+        #stay below the SQLite limit of variables per statement
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            rows = conn.execute("SELECT key, translation FROM translations WHERE key IN ({})".format(
+                ",".join("?" * len(chunk))), chunk).fetchall()
+            found.update(rows)
+        return found
+
+    def put_many(self, items):
+        conn = self._connect()
+        conn.executemany("INSERT OR REPLACE INTO translations VALUES (?,?)", items)
+        conn.commit()
+
+    def get_language(self, path):
+        #language found by the translation stage for a file, None if it wasn't detected
+        row = self._connect().execute("SELECT language FROM languages WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def put_languages(self, items):
+        conn = self._connect()
+        conn.executemany("INSERT OR REPLACE INTO languages VALUES (?,?)", items)
+        conn.commit()
+
+
+class CachedTranslator:
+
+    def __init__(self, backend, cache, backend_name=None):
+        #without a backend only the cache is read, the texts missing from it are kept as they are
+        self.backend = backend
+        self.name = backend.name if backend is not None else backend_name
+        self.cache = cache
+
+    def translate_texts(self, texts, batch_size=16, n_threads=1):
+        #translations in the input order; only the texts missing from the cache go to the backend
+        texts = [str(text) for text in texts]
+        keys = [text_key(self.name, text) for text in texts]
+        translations = self.cache.get_many(set(keys))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in translations and key not in missing:
+                if text.strip():
+                    missing[key] = text
+                else:
+                    translations[key] = text
+        if missing and self.backend is None:
+            warnings.warn("{} texts are missing from the translation cache, the original text is kept".format(len(missing)))
+            translations.update(missing)
+        elif missing:
+            missing_keys = list(missing.keys())
+            batches = [missing_keys[i:i+batch_size] for i in range(0, len(missing_keys), batch_size)]
+            with ThreadPoolExecutor(max_workers=max(1, n_threads)) as executor:
+                results = executor.map(self._translate_batch, [[missing[key] for key in batch] for batch in batches])
+                for batch, batch_translations in zip(batches, results):
+                    if batch_translations is None:
+                        #a failed batch is not cached, the next run sends it again
+                        translations.update((key, missing[key]) for key in batch)
+                        continue
+                    items = list(zip(batch, batch_translations))
+                    translations.update(items)
+                    self.cache.put_many(items)
+        return [translations[key] for key in keys]
+
+    def _translate_batch(self, texts):
+        try:
+            return self.backend.translate_batch(texts)
+        except Exception as e:
+            #keep the original text rather than fail the whole stage
+            warnings.warn("Translation of a batch failed ({}), the original text is kept".format(e))
+            return None
+
+
+_translators = {}
+
+def get_translator(backend_name, cache_path, cache_only=False):
+    #one translator per process, backend and cache; a cache-only one doesn't even create the backend
+    key = (os.getpid(), backend_name, cache_path, cache_only)
+    if key not in _translators:
+        backend = None if cache_only else BACKENDS[backend_name]()
+        _translators[key] = CachedTranslator(backend, TranslationCache(cache_path), backend_name)
+    return _translators[key]
+
+
+def init_language_detection():
+    #langdetect draws random numbers unless seeded, and loads its language profiles
+    #on the first call, which threads racing on it can leave half built
+    from langdetect import DetectorFactory, detect
+    DetectorFactory.seed = 0
+    detect("This sentence is written in English.")
+
+
+def paper_sections(json_file):
+    #abstract paragraphs followed by the body text, as seen by the pipeline
+    try:
+        paper_abstract = json_file["abstract"]
+    except:
+        paper_abstract = []
+    return (paper_abstract or []) + json_file["body_text"]
+
+def _texts_to_translate(path_to_file):
+    #(language or None, texts to translate) of a file
+    from langdetect import detect
+    with open(path_to_file, "rb") as f:
+        sections = paper_sections(json.load(f))
+    all_text = ' '.join([x['text'] for x in sections])
+    if len(all_text) <= 5:
+        return None, []
+    try:
+        language = detect(all_text[:1000])
+    except:
+        return None, []
+    if language == 'en':
+        return language, []
+    return language, [x['text'] for x in sections] + [x['section'] for x in sections]
+
+def translation_stage(paths_to_files, backend_name, cache_path, n_threads=8, batch_size=16, n_processes=None):
+    """
+    Detect the language of the files on n_processes processes (default: one
+    per CPU) and fill the translation cache for the non-English ones, whose
+    texts are the only ones sent back to the main process. The languages are
+    stored in the cache too, for the workers to use the same ones. Returns
+    the number of files that need translation.
+    """
+    translator = get_translator(backend_name, cache_path)
+    texts = []
+    languages = []
+    n_files = 0
+    n_processes = n_processes or os.cpu_count() or 1
+    #files in chunks, so that the processes don't wait on the queue for every small file
+    chunksize = max(1, min(64, len(paths_to_files) // (4 * n_processes)))
+    with ProcessPoolExecutor(max_workers=n_processes, initializer=init_language_detection) as executor:
+        for path, (language, file_texts) in tqdm(zip(paths_to_files, executor.map(_texts_to_translate, paths_to_files, chunksize=chunksize)),
+                                                 total=len(paths_to_files), desc="Detecting languages"):
+            if language is not None:
+                languages.append((path, language))
+            if file_texts:
+                n_files += 1
+                texts.extend(file_texts)
+    translator.cache.put_languages(languages)
+    #repeated texts like section titles are translated once
+    translator.translate_texts(list(dict.fromkeys(texts)), batch_size, n_threads)
+    return n_files
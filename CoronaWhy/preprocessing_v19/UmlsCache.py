@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import os, pickle, sqlite3
+from collections import OrderedDict
+
+# The same surface forms ("SARS-CoV-2", "ACE2", "patients"...) come back in
+# nearly every sentence. The UMLS linker asks its candidate generator for the
+# candidates of every mention string, which is the expensive part of linking.
+# The generator is wrapped with a bounded LRU cache keyed by the mention
+# string, optionally backed by a SQLite file shared by the workers and later
+# runs. The linker still scores and filters the candidates itself, so the
+# annotations are the same as without the cache.
+
+
+class CachedCandidateGenerator:
+
+    def __init__(self, candidate_generator, max_size=100000, path=None):
+        self.candidate_generator = candidate_generator
+        self.max_size = max_size
+        self.path = path
+        self.cache = OrderedDict()
+        #cui -> canonical name, as bounded as the candidates
+        self.canonical_names = OrderedDict()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+        self._connections = {}
+
+    def _connect(self):
+        #a connection per process, the workers are forked from the parent
+        if os.getpid() not in self._connections:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS candidates (mention TEXT, k INTEGER, candidates BLOB, PRIMARY KEY (mention, k))")
+            conn.commit()
+            self._connections[os.getpid()] = conn
+        return self._connections[os.getpid()]
+
+    def _remember(self, key, candidates):
+        _lru_put(self.cache, key, candidates, self.max_size)
+
+    def _from_disk(self, mentions, k):
+        conn = self._connect()
+        found = {}
+        for i in range(0, len(mentions), 500):
+            chunk = mentions[i:i+500]
+            rows = conn.execute("SELECT mention, candidates FROM candidates WHERE k = ? AND mention IN ({})".format(
+                ",".join("?" * len(chunk))), [k] + chunk).fetchall()
+            found.update((mention, pickle.loads(blob)) for mention, blob in rows)
+        return found
+
+    def _to_disk(self, found, k):
+        conn = self._connect()
+        conn.executemany("INSERT OR REPLACE INTO candidates VALUES (?,?,?)",
+                         [(mention, k, pickle.dumps(candidates)) for mention, candidates in found.items()])
+        conn.commit()
+
+    def __call__(self, mention_texts, k):
+        results = {}
+        #every lookup not found in memory, a mention repeated in the batch counts each time
+        pending = []
+        for mention in mention_texts:
+            key = (mention, k)
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                results[mention] = self.cache[key]
+                self.stats["hits"] += 1
+            else:
+                pending.append(mention)
+        missing = list(dict.fromkeys(pending))
+        if missing and self.path is not None:
+            found = self._from_disk(missing, k)
+            self.stats["disk_hits"] += sum(mention in found for mention in pending)
+            for mention, candidates in found.items():
+                results[mention] = candidates
+                self._remember((mention, k), candidates)
+            missing = [mention for mention in missing if mention not in found]
+            pending = [mention for mention in pending if mention not in found]
+        if missing:
+            self.stats["misses"] += len(pending)
+            #one batched call for all the new mention strings
+            found = dict(zip(missing, self.candidate_generator(missing, k)))
+            for mention, candidates in found.items():
+                results[mention] = candidates
+                self._remember((mention, k), candidates)
+            if self.path is not None:
+                self._to_disk(found, k)
+        return [results[mention] for mention in mention_texts]
+
+    def canonical_name(self, umls, cui):
+        if cui in self.canonical_names:
+            self.canonical_names.move_to_end(cui)
+            return self.canonical_names[cui]
+        name = umls.cui_to_entity[cui].canonical_name
+        _lru_put(self.canonical_names, cui, name, self.max_size)
+        return name
+
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        return (self.stats["hits"] + self.stats["disk_hits"]) / lookups if lookups else 0.0
+
+
+def _lru_put(cache, key, value, max_size):
+    #add to an OrderedDict used as LRU, dropping the least recently used entry beyond max_size
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > max_size:
+        cache.popitem(last=False)
+
+def install_cache(linker, max_size=100000, path=None):
+    #wrap the candidate generator of a UmlsEntityLinker, once
+    if not isinstance(linker.candidate_generator, CachedCandidateGenerator):
+        linker.candidate_generator = CachedCandidateGenerator(linker.candidate_generator, max_size, path)
+    return linker.candidate_generator
+
+def canonical_name(linker, cui):
+    if isinstance(linker.candidate_generator, CachedCandidateGenerator):
+        return linker.candidate_generator.canonical_name(linker.umls, cui)
+    return linker.umls.cui_to_entity[cui].canonical_name
+
+def cache_stats(linker):
+    if linker is None or not isinstance(linker.candidate_generator, CachedCandidateGenerator):
+        return None
+    return dict(linker.candidate_generator.stats)
+
+def print_cache_report(stats_list):
+    #sum of the statistics of all tasks
+    total = {"hits": 0, "disk_hits": 0, "misses": 0}
+    for stats in stats_list:
+        if stats:
+            for key in total:
+                total[key] += stats[key]
+    lookups = sum(total.values())
+    if lookups == 0:
+        return
+    print("""
+       UMLS link cache: {} lookups, {} hits in memory, {} on disk, {} misses (hit rate {:.1%})
+    """.format(lookups, total["hits"], total["disk_hits"], total["misses"], (total["hits"] + total["disk_hits"]) / lookups))
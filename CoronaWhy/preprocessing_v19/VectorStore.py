@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import os, json, time, argparse, tempfile, shutil
+import numpy as np
+
+# Sentence vectors can be stored apart from the JSON output: each worker appends
+# the rows to its own raw binary shard (preprocessed/sent2vec/sent2vec_<pid>.bin)
+# described by a small JSON header with the dtype and the dimension. The paper
+# JSON keeps the shard name and each sentence only its row number, and readers
+# memory-map the shards without copying.
+VECTOR_FOLDER = "sent2vec"
+
+_writers = {}
+_shards = {}
+
+
+class VectorShardWriter:
+
+    def __init__(self, folder, dtype="float32"):
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.dtype = np.dtype(dtype)
+        self.name = "sent2vec_{}.bin".format(os.getpid())
+        self.path = os.path.join(folder, self.name)
+        self.dim = None
+        self.rows = []
+        self.n_rows = None
+
+    def _init_header(self, dim):
+        header_path = self.path[:-len(".bin")] + ".json"
+        if os.path.exists(header_path):
+            with open(header_path) as f:
+                header = json.load(f)
+            #a shard left by an earlier process with the same pid
+            if header["dim"] != dim or header["dtype"] != self.dtype.name:
+                self.name = "sent2vec_{}_{}.bin".format(os.getpid(), int(time.time()))
+                self.path = os.path.join(self.folder, self.name)
+                return self._init_header(dim)
+        else:
+            with open(header_path, "w") as f:
+                json.dump({"dtype": self.dtype.name, "dim": dim}, f)
+        self.dim = dim
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.n_rows = size // (dim * self.dtype.itemsize)
+
+    def append(self, vector):
+        #row number of the vector in the shard, written on flush()
+        if self.dim is None:
+            self._init_header(len(vector))
+        self.rows.append(np.asarray(vector, dtype=self.dtype))
+        return self.n_rows + len(self.rows) - 1
+
+    def flush(self):
+        if self.rows:
+            with open(self.path, "ab") as f:
+                f.write(np.stack(self.rows).tobytes())
+            self.n_rows += len(self.rows)
+            self.rows = []
+
+
+def get_writer(folder, dtype="float32"):
+    #one writer per process and folder
+    if folder not in _writers:
+        _writers[folder] = VectorShardWriter(folder, dtype)
+    return _writers[folder]
+
+def open_shard(folder, shard):
+    #memory-mapped (n_rows, dim) array of a shard
+    path = os.path.join(folder, shard)
+    if path not in _shards:
+        with open(path[:-len(".bin")] + ".json") as f:
+            header = json.load(f)
+        vectors = np.memmap(path, dtype=header["dtype"], mode="r")
+        _shards[path] = vectors.reshape(-1, header["dim"])
+    return _shards[path]
+
+def sentence_vector(folder, preprocessed_file, sentence_id):
+    #the sent2vec of a sentence of a preprocessed paper, whichever format it was written in
+    sentence_dict = preprocessed_file[sentence_id]
+    if "sent2vec" in sentence_dict:
+        return np.asarray(sentence_dict["sent2vec"])
+    row = sentence_dict.get("sent2vec_row")
+    if row is None:
+        return np.asarray([])
+    return open_shard(folder, preprocessed_file["sent2vec_shard"])[row]
+
+
+def _folder_size(folder):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(folder) for name in names)
+
+def compare_formats(n_papers=200, n_sentences=100, dim=200, dtype="float32"):
+    """
+    Write the same random sentence vectors as JSON float lists and to a binary
+    shard, then compare the size on disk and the time to load all vectors back.
+    """
+    work_dir = tempfile.mkdtemp()
+    rng = np.random.RandomState(0)
+    json_dir = os.path.join(work_dir, "json")
+    store_dir = os.path.join(work_dir, "store")
+    os.makedirs(json_dir)
+    os.makedirs(store_dir)
+    vector_folder = os.path.join(store_dir, VECTOR_FOLDER)
+    writer = VectorShardWriter(vector_folder, dtype)
+    for paper_nb in range(n_papers):
+        vectors = rng.rand(n_sentences, dim).astype("float32")
+        json_paper = {str(i): {"sent2vec": v.tolist()} for i, v in enumerate(vectors)}
+        store_paper = {str(i): {"sent2vec_row": writer.append(v)} for i, v in enumerate(vectors)}
+        writer.flush()
+        store_paper["sent2vec_shard"] = writer.name
+        for folder, paper in ((json_dir, json_paper), (store_dir, store_paper)):
+            with open(os.path.join(folder, "{}.json".format(paper_nb)), "w") as f:
+                json.dump(paper, f)
+
+    results = {}
+    for name, folder in (("json", json_dir), ("store", store_dir)):
+        _shards.clear()
+        start = time.perf_counter()
+        total = 0.0
+        for paper_nb in range(n_papers):
+            with open(os.path.join(folder, "{}.json".format(paper_nb))) as f:
+                paper = json.load(f)
+            for i in range(n_sentences):
+                total += float(sentence_vector(vector_folder, paper, str(i))[0])
+        results[name] = {"size_mb": _folder_size(folder)/1024**2, "load_s": time.perf_counter() - start}
+    _shards.clear()
+    shutil.rmtree(work_dir)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare JSON float lists with binary shards for sentence vectors.')
+    parser.add_argument('--n_papers', type=int, default=200)
+    parser.add_argument('--n_sentences', type=int, default=100)
+    parser.add_argument('--dtype', type=str, default="float32", choices=["float32", "float16"])
+    args = parser.parse_args()
+    for name, result in compare_formats(args.n_papers, args.n_sentences, dtype=args.dtype).items():
+        print("{:>6}: {:8.1f} MB on disk, {:6.2f} s to load all vectors".format(name, result["size_mb"], result["load_s"]))
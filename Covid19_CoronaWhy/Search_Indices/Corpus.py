@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os, sys, json
+import numpy as np
+
+# Reading the output of the CORD19 preprocessing (CoronaWhy/preprocessing_v19):
+# either one JSON file per paper in the preprocessed folder, or the gzipped
+# JSON lines shards of preprocessed/shards (--output_format jsonl). A paper
+# lists its sections in "abstract" (next to the raw abstract paragraphs) and
+# "text_body", every section the ids of its sentences, and every sentence has
+# its text ("tokens"), "lemmas" and UMLS terms. The sentence vectors are
+# either in the sentences ("sent2vec") or rows of the binary shards of
+# preprocessed/sent2vec (--vector_store npy, "sent2vec_row"). The shards are
+# read with the readers of the preprocessing.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "CoronaWhy", "preprocessing_v19"))
+from ShardStore import ShardReader, SHARD_FOLDER
+from VectorStore import open_shard, VECTOR_FOLDER
+
+#the JSON files the preprocessing writes next to the papers
+NON_PAPER_FILES = {"discovery_index.json"}
+
+def iter_papers(preprocessed_folder):
+    #the preprocessed papers of the folder one at a time, the latest copy of each paper from the shards
+    #a paper both in the shards and in a JSON file (a run with each output format) is read once, from the shards
+    shard_folder = os.path.join(preprocessed_folder, SHARD_FOLDER)
+    seen = set()
+    if os.path.isdir(shard_folder):
+        #only the shard indices are kept in memory, each paper is read with a seek
+        reader = ShardReader(shard_folder)
+        seen.update(reader.paper_ids())
+        for paper in reader.iter_papers():
+            yield paper
+    for name in sorted(os.listdir(preprocessed_folder)):
+        #the papers are written to <paper_id>.json, the other files are left out before being opened
+        if not name.endswith(".json") or name in NON_PAPER_FILES or name[:-len(".json")] in seen:
+            continue
+        with open(os.path.join(preprocessed_folder, name), encoding="utf-8") as f:
+            paper = json.load(f)
+        #files of older runs or copied in by hand
+        if isinstance(paper, dict) and "paper_id" in paper and "text_body" in paper and paper["paper_id"] not in seen:
+            seen.add(paper["paper_id"])
+            yield paper
+
+def paper_sections(paper):
+    #(section name, sentence dicts) of the sections of a paper, in order
+    #"abstract" is False for the parses without one, like every PMC parse
+    sections = [("abstract", section_id) for section_id in paper.get("abstract") or [] if isinstance(section_id, str)]
+    sections += [(section["section_name"], section["section_id"]) for section in paper["text_body"]]
+    return [(name, [paper[sentence_id] for sentence_id in paper.get(section_id, [])]) for name, section_id in sections]
+
+def paper_sentences(paper):
+    return [sentence for _, sentences in paper_sections(paper) for sentence in sentences]
+
+def sentence_vectors(preprocessed_folder, paper, sentences=None):
+    #(n, dim) array of the sentence vectors of a paper, sentences without a vector are left out
+    sentences = paper_sentences(paper) if sentences is None else sentences
+    if "sent2vec_shard" in paper:
+        rows = [sentence["sent2vec_row"] for sentence in sentences if sentence.get("sent2vec_row") is not None]
+        if rows:
+            #one gather from the shard for the whole paper
+            return np.asarray(open_shard(os.path.join(preprocessed_folder, VECTOR_FOLDER), paper["sent2vec_shard"])[rows], dtype=np.float32)
+    else:
+        vectors = [sentence["sent2vec"] for sentence in sentences if len(sentence.get("sent2vec", []))]
+        if vectors:
+            return np.asarray(vectors, dtype=np.float32)
+    return np.zeros((0, 0), dtype=np.float32)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os, json, time, mmap, random, argparse
+import numpy as np
+from Corpus import iter_papers, paper_sections
+
+# A document store for printing search hits: the text of every paper is built
+# once from the preprocessed output and appended as a JSON record to a single
+# blob (docs.bin), papers.txt lists the paper ids and offsets.npy the start of
+# each record (plus the end of the last one). Opening the store reads the ids
+# only; the blob is memory-mapped, so hydrating a few hits reads a few pages
+# instead of loading the corpus.
+BLOB_NAME = "docs.bin"
+OFFSETS_NAME = "offsets.npy"
+IDS_NAME = "papers.txt"
+
+
+def paper_record(paper):
+    #the text of the paper with the position of its sections
+    texts, sections, start = [], [], 0
+    for section_name, sentences in paper_sections(paper):
+        text = " ".join(sentence["tokens"] for sentence in sentences)
+        sections.append({"section_name": section_name, "start": start})
+        texts.append(text)
+        start += len(text) + 2
+    return {"paper_id": paper["paper_id"], "text": "\n\n".join(texts), "sections": sections}
+
+def build_document_store(preprocessed_folder, store_folder):
+    #write the store of all papers of the preprocessed folder, returns the number of papers
+    if not os.path.exists(store_folder):
+        os.makedirs(store_folder)
+    offsets = [0]
+    paper_ids = []
+    with open(os.path.join(store_folder, BLOB_NAME), "wb") as f:
+        for paper in iter_papers(preprocessed_folder):
+            record = json.dumps(paper_record(paper), ensure_ascii=False).encode("utf-8")
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+            paper_ids.append(paper["paper_id"])
+    np.save(os.path.join(store_folder, OFFSETS_NAME), np.array(offsets, dtype=np.int64))
+    with open(os.path.join(store_folder, IDS_NAME), "w", encoding="utf-8") as f:
+        f.write("\n".join(paper_ids))
+    return len(paper_ids)
+
+
+class DocumentStore:
+    """
+    Read-only access to a store written by build_document_store. get() takes
+    a batch of paper ids and returns their records (paper_id, text and the
+    start of each section in the text), None for unknown ids. Reads are
+    thread-safe.
+    """
+
+    def __init__(self, store_folder):
+        with open(os.path.join(store_folder, IDS_NAME), encoding="utf-8") as f:
+            paper_ids = f.read()
+        self.paper_ids = paper_ids.split("\n") if paper_ids else []
+        self.rows = {paper_id: row for row, paper_id in enumerate(self.paper_ids)}
+        self.offsets = np.load(os.path.join(store_folder, OFFSETS_NAME), mmap_mode="r")
+        self._file = open(os.path.join(store_folder, BLOB_NAME), "rb")
+        #mmap can't map an empty file
+        self.blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.paper_ids else b""
+
+    def __len__(self):
+        return len(self.paper_ids)
+
+    def __contains__(self, paper_id):
+        return paper_id in self.rows
+
+    def get(self, paper_ids):
+        rows = [self.rows.get(paper_id) for paper_id in paper_ids]
+        records = {}
+        #read the records in the order of the blob
+        for row in sorted(set(row for row in rows if row is not None)):
+            records[row] = json.loads(self.blob[int(self.offsets[row]):int(self.offsets[row + 1])].decode("utf-8"))
+        return [records.get(row) for row in rows]
+
+    def close(self):
+        if self.paper_ids:
+            self.blob.close()
+        self._file.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the document store from the preprocessed CORD19 output and time the hydration of search hits.')
+    parser.add_argument('--preprocessed', type=str, required=True, help='Folder with the output of PreProcess_v19')
+    parser.add_argument('--store', type=str, default="document_store", help='Folder of the document store. Default document_store')
+    parser.add_argument('--n_hits', type=int, default=10, help='Number of papers per get() call. Default 10')
+    parser.add_argument('--n_queries', type=int, default=1000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    n_papers = build_document_store(args.preprocessed, args.store)
+    print("{} papers stored in {:.1f} s".format(n_papers, time.perf_counter() - start))
+    start = time.perf_counter()
+    store = DocumentStore(args.store)
+    print("store opened in {:.1f} ms".format((time.perf_counter() - start) * 1000))
+    latencies = []
+    for _ in range(args.n_queries if len(store) else 0):
+        hits = random.sample(store.paper_ids, min(args.n_hits, len(store)))
+        start = time.perf_counter()
+        store.get(hits)
+        latencies.append(time.perf_counter() - start)
+    if latencies:
+        print("get() of {} papers: p50 {:.2f} ms, p99 {:.2f} ms".format(
+            args.n_hits, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import time, argparse
+import numpy as np
+from Corpus import iter_papers, paper_sentences, sentence_vectors
+from WhooshIndex import index_papers
+from VectorIndex import build_annoy_index
+
+# Building the search indices straight from the output of the preprocessing
+# (CoronaWhy/preprocessing_v19) instead of running en_core_sci_lg over the
+# corpus a second time: the papers are streamed from the preprocessed folder,
+# the lemmas and UMLS terms of their sentences go to the Whoosh writer (with
+# several processes if asked) and the document vector of a paper is computed
+# from its sentence vectors with NumPy.
+DOC_VECTOR_MODES = ["mean", "l2"]
+
+
+def doc_vector(vectors, mode="mean"):
+    #mean of the sentence vectors, "l2" normalises them first; None for a paper without vectors
+    if len(vectors) == 0:
+        return None
+    if mode == "l2":
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+    return vectors.mean(axis=0)
+
+def paper_fields(preprocessed_folder, paper, mode="mean"):
+    #(paper id, lemmas, UMLS terms, doc vector) of a preprocessed paper
+    sentences = paper_sentences(paper)
+    lemmas = " ".join(lemma for sentence in sentences for lemma in sentence.get("lemmas", []))
+    umls = " ".join(term for sentence in sentences for term in sentence.get("umls", []))
+    return paper["paper_id"], lemmas, umls, doc_vector(sentence_vectors(preprocessed_folder, paper, sentences), mode)
+
+def iter_paper_fields(preprocessed_folder, mode="mean"):
+    for paper in iter_papers(preprocessed_folder):
+        yield paper_fields(preprocessed_folder, paper, mode)
+
+def build_indices(preprocessed_folder, whoosh_dir="whoosh_index", annoy_path="semantic_search_doc.tree",
+                  paper_ids_path="paper_id_list.txt", vectors_path="doc_vectors.npy", mode="mean",
+                  procs=1, limitmb=256, n_trees=50, metric="angular"):
+    """
+    Write the Whoosh index of all papers, and the Annoy forest, its
+    paper_id_list.txt and doc_vectors.npy for the papers with sentence
+    vectors, in one pass over the preprocessed folder. Returns the number of
+    papers in each index.
+    """
+    paper_id_list, vectors_doc_list = [], []
+
+    def papers():
+        for paper_id, lemmas, umls, vector in iter_paper_fields(preprocessed_folder, mode):
+            if vector is not None:
+                paper_id_list.append(paper_id)
+                vectors_doc_list.append(vector)
+            yield paper_id, lemmas, umls
+
+    ix = index_papers(whoosh_dir, papers(), procs, limitmb)
+    n_whoosh = ix.doc_count()
+    ix.close()
+    with open(paper_ids_path, "w") as f:
+        f.write("\n".join(paper_id_list))
+    if vectors_doc_list:
+        vectors = np.stack(vectors_doc_list).astype(np.float32)
+        np.save(vectors_path, vectors)
+        build_annoy_index(vectors, n_trees, metric, annoy_path)
+    return n_whoosh, len(paper_id_list)
+
+def add_to_segments(preprocessed_folder, segments, mode="mean", procs=1, batch_size=5000):
+    #add the papers of a preprocessed folder to a SegmentedIndex, batch_size papers per add
+    batch = []
+    n_papers = 0
+    for fields in iter_paper_fields(preprocessed_folder, mode):
+        batch.append(fields)
+        if len(batch) == batch_size:
+            segments.add_papers(*zip(*batch), procs=procs)
+            n_papers += len(batch)
+            batch = []
+    if batch:
+        segments.add_papers(*zip(*batch), procs=procs)
+        n_papers += len(batch)
+    return n_papers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the Whoosh index and the Annoy forest from the preprocessed CORD19 output.')
+    parser.add_argument('--preprocessed', type=str, required=True, help='Folder with the output of PreProcess_v19')
+    parser.add_argument('--whoosh_dir', type=str, default="whoosh_index", help='Directory of the Whoosh index. Default whoosh_index')
+    parser.add_argument('--annoy', type=str, default="semantic_search_doc.tree", help='Annoy forest. Default semantic_search_doc.tree')
+    parser.add_argument('--paper_ids', type=str, default="paper_id_list.txt", help='Paper id of each Annoy item. Default paper_id_list.txt')
+    parser.add_argument('--vectors', type=str, default="doc_vectors.npy", help='Document vectors, as the Annoy items. Default doc_vectors.npy')
+    parser.add_argument('--doc_vector_mode', type=str, default="mean", choices=DOC_VECTOR_MODES,
+                        help='Document vector as the mean of the sentence vectors ("mean") or of the normalised sentence vectors ("l2"). Default mean')
+    parser.add_argument('--procs', type=int, default=1, help='Whoosh writer processes. Default 1')
+    parser.add_argument('--limitmb', type=int, default=256, help='Memory of each Whoosh writer process in MB. Default 256')
+    parser.add_argument('--n_trees', type=int, default=50, help='Trees of the Annoy forest. Default 50')
+    parser.add_argument('--dim', type=int, default=200, help='Dimension of the sentence vectors, for new segmented indices. Default 200')
+    parser.add_argument('--segments', type=str, default=None, help='Add the papers to segmented indices (SegmentedIndex.py) in this root instead. Default None')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.segments:
+        from SegmentedIndex import SegmentedIndex
+        segments = SegmentedIndex(args.segments, dim=args.dim, n_trees=args.n_trees)
+        n_papers = add_to_segments(args.preprocessed, segments, args.doc_vector_mode, args.procs)
+        print("{} papers added in {:.1f} s: {}".format(n_papers, time.perf_counter() - start, segments.status()))
+    else:
+        n_whoosh, n_annoy = build_indices(args.preprocessed, args.whoosh_dir, args.annoy, args.paper_ids, args.vectors,
+                                          args.doc_vector_mode, args.procs, args.limitmb, args.n_trees)
+        print("{} papers in the Whoosh index, {} in the Annoy forest, built in {:.1f} s".format(n_whoosh, n_annoy, time.perf_counter() - start))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import json, time, random, argparse, threading
+from urllib.request import Request, urlopen
+import numpy as np
+
+# Load generator for SearchService.py: a number of client threads send batches
+# of queries to POST /search as fast as they are answered, then the latency of
+# the requests (p50/p99) and the throughput in queries per second are printed.
+SAMPLE_QUERIES = ["covid19 heart diseases risks", "incubation period of SARS-CoV-2", "ACE2 receptor binding of the spike protein",
+                  "asymptomatic transmission in children", "hydroxychloroquine treatment outcomes", "smoking as a risk factor",
+                  "vaccine candidates for coronavirus", "viral shedding duration", "ferrets as animal model", "ICU mortality of patients"]
+
+
+def post_queries(url, queries, k, hydrate=False):
+    body = json.dumps({"queries": queries, "k": k, "hydrate": hydrate}).encode("utf-8")
+    request = Request(url, data=body, headers={"Content-Type": "application/json"})
+    with urlopen(request) as response:
+        return json.loads(response.read())["results"]
+
+def run_load(url, queries, n_requests=200, concurrency=4, batch_size=1, k=10, seed=0):
+    #send n_requests batches from concurrency threads, returns the latency of each request and the wall time
+    rng = random.Random(seed)
+    batches = [[rng.choice(queries) for _ in range(batch_size)] for _ in range(n_requests)]
+    latencies = []
+    lock = threading.Lock()
+    next_batch = iter(batches)
+
+    def client():
+        while True:
+            with lock:
+                batch = next(next_batch, None)
+            if batch is None:
+                return
+            start = time.perf_counter()
+            post_queries(url, batch, k)
+            latency = time.perf_counter() - start
+            with lock:
+                latencies.append(latency)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+def print_load_report(latencies, wall_s, batch_size):
+    n_queries = len(latencies) * batch_size
+    print("{} requests of {} queries in {:.2f} s".format(len(latencies), batch_size, wall_s))
+    print("latency per request: p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+        np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000, max(latencies) * 1000))
+    print("throughput: {:.1f} queries/s".format(n_queries / wall_s if wall_s else 0.0))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load generator for the search service.')
+    parser.add_argument('--url', type=str, default="http://127.0.0.1:8765/search")
+    parser.add_argument('--queries', type=str, default=None, help='File with one query per line. Default: a few sample queries')
+    parser.add_argument('--n_requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of client threads. Default 4')
+    parser.add_argument('--batch_size', type=int, default=1, help='Queries per request. Default 1')
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    queries = SAMPLE_QUERIES
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    latencies, wall_s = run_load(args.url, queries, args.n_requests, args.concurrency, args.batch_size, args.k)
+    print_load_report(latencies, wall_s, args.batch_size)
@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+import os, re, json, time, argparse, threading
+import numpy as np
+
+# A query is searched with its lemmas in the Whoosh index and with its vector
+# in the Annoy forest, both computed by en_core_sci_lg with the COVID-19
+# vectors added as in the preprocessing. Loading that model takes far longer
+# than a search, so export_query_model() writes once what the queries need
+# from it: the rules of its tokenizer, the vector table (with the COVID-19
+# vectors) and a lemma for each word, and LightQueryEncoder computes the
+# tokens, lemmas and vector of a query from these files without spaCy, with
+# the vector table memory-mapped. The tokens and the vector are the ones of
+# spaCy. spaCy picks the lemma of a word from its part of speech in the
+# query, so the table only holds the words whose lemma is the same for every
+# tag of the model; a query with another word gets its lemmas from the spaCy
+# model, loaded in the background, so that they are always the same.
+COVID_DESCRIPTION = """Positive-sense single‐stranded ribonucleic acid virus, subgenus 
+                       sarbecovirus of the genus Betacoronavirus. 
+                       Also known as severe acute respiratory syndrome coronavirus 2, 
+                       also known by 2019 novel coronavirus. It is 
+                       contagious in humans and is the cause of the ongoing pandemic of 
+                       coronavirus disease. Coronavirus disease 2019 is a zoonotic infectious 
+                       disease."""
+COVID_WORDS = ["COVID-19", "2019-nCoV", "SARS-CoV-2"]
+VECTORS_NAME = "vectors.npy"
+WORDS_NAME = "words.bin"
+WORD_OFFSETS_NAME = "word_offsets.npy"
+WORD_ROWS_NAME = "word_rows.npy"
+VOCAB_NAME = "vocab.json"
+TOKENIZER_NAME = "tokenizer.json"
+#spacy.attrs.ORTH and spacy.attrs.LEMMA of the tokenizer special cases
+ORTH, LEMMA = 65, 73
+MODEL = "en_core_sci_lg"
+
+
+def load_spacy_nlp(model=MODEL):
+    import spacy
+    spacy_nlp = spacy.load(model, disable=["parser", "ner"])
+    new_vector = spacy_nlp(COVID_DESCRIPTION).vector
+    for word in COVID_WORDS:
+        spacy_nlp.vocab.set_vector(word, new_vector)
+    return spacy_nlp
+
+
+class SpacyQueryEncoder:
+    #lemmas and vectors of the queries with the full spaCy model
+
+    def __init__(self, spacy_nlp=None):
+        self.nlp = spacy_nlp if spacy_nlp is not None else load_spacy_nlp()
+
+    def encode(self, queries):
+        #(lemma string, vector) of each query
+        return [(' '.join([x.lemma_ for x in doc]), doc.vector) for doc in self.nlp.pipe(queries)]
+
+
+def _pattern(method):
+    #pattern and flags of the compiled regex behind a tokenizer callback
+    if method is None:
+        return None
+    return {"pattern": method.__self__.pattern, "flags": method.__self__.flags}
+
+def corpus_sentences(preprocessed_folder, max_sentences=200000):
+    #text of the first max_sentences sentences of the preprocessed papers
+    from Corpus import iter_papers, paper_sentences
+    n_sentences = 0
+    for paper in iter_papers(preprocessed_folder):
+        for sentence in paper_sentences(paper):
+            if n_sentences == max_sentences:
+                return
+            yield sentence["tokens"]
+            n_sentences += 1
+
+def word_token(spacy_nlp, word):
+    #the word as a single token, whatever the tokenizer would make of it
+    from spacy.tokens import Doc
+    return Doc(spacy_nlp.vocab, words=[word])[0]
+
+def tag_lemmas(spacy_nlp, word):
+    #the lemmas spaCy gives the word for each tag its tagger can predict, as the tagger would set them
+    token = word_token(spacy_nlp, word)
+    lemmas = set()
+    for tag in spacy_nlp.get_pipe("tagger").labels:
+        #an empty lemma lets the tag set it
+        token.lemma_ = ""
+        token.tag_ = tag
+        lemmas.add(token.lemma_)
+    return lemmas
+
+def export_query_model(folder, spacy_nlp=None, lemma_texts=(), max_lemma_words=100000, batch_size=1000, model=MODEL):
+    """
+    Write the tokenizer rules, the vector table and the lemmas of spacy_nlp
+    (load_spacy_nlp(model) by default) to folder. The lemma table covers the
+    words of lemma_texts (sentences of the corpus, see corpus_sentences(),
+    and past queries) and the max_lemma_words first words of the vector
+    table. With a tagger it only holds the words whose lemma is the same
+    for every tag; LightQueryEncoder asks model for the others.
+    """
+    spacy_nlp = spacy_nlp if spacy_nlp is not None else load_spacy_nlp(model)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    tokenizer = spacy_nlp.tokenizer
+    specials = {string: [[attrs[ORTH], attrs.get(LEMMA)] for attrs in tokens] for string, tokens in getattr(tokenizer, "rules", {}).items()}
+    rules = {"prefix": _pattern(tokenizer.prefix_search), "suffix": _pattern(tokenizer.suffix_search),
+             "infix": _pattern(tokenizer.infix_finditer),
+             "token_match": _pattern(tokenizer.token_match), "url_match": _pattern(getattr(tokenizer, "url_match", None)),
+             "specials": specials}
+    with open(os.path.join(folder, TOKENIZER_NAME), "w", encoding="utf-8") as f:
+        json.dump(rules, f, ensure_ascii=False)
+
+    #only the used rows of the table, set_vector leaves empty rows when it grows it
+    vectors = spacy_nlp.vocab.vectors
+    words, rows = [], []
+    for key, row in vectors.key2row.items():
+        if key in spacy_nlp.vocab.strings:
+            words.append(spacy_nlp.vocab.strings[key])
+            rows.append(row)
+    used = sorted(set(rows))
+    new_rows = {row: nb for nb, row in enumerate(used)}
+    np.save(os.path.join(folder, VECTORS_NAME), np.asarray(vectors.data[used] if used else vectors.data[:0], dtype=np.float32))
+    #the words sorted by their UTF-8 bytes in one blob, looked up by binary search instead of building a dict at load time
+    encoded = sorted((word.encode("utf-8"), new_rows[row]) for word, row in zip(words, rows))
+    with open(os.path.join(folder, WORDS_NAME), "wb") as f:
+        f.write(b"".join(word for word, _ in encoded))
+    np.save(os.path.join(folder, WORD_OFFSETS_NAME), np.cumsum([0] + [len(word) for word, _ in encoded]).astype(np.int64))
+    np.save(os.path.join(folder, WORD_ROWS_NAME), np.array([row for _, row in encoded], dtype=np.int64))
+
+    #the tokens of the lemma texts and the words with the first rows of the vector table
+    candidates = set()
+    for doc in spacy_nlp.tokenizer.pipe(lemma_texts, batch_size=batch_size):
+        candidates.update(token.text for token in doc)
+    candidates.update(word for _, word in sorted(zip(rows, words))[:max_lemma_words])
+    candidates.update(attrs[0] for tokens in specials.values() for attrs in tokens if attrs[1] is None)
+    candidates = sorted(word for word in candidates if word.strip())
+    tagged = "tagger" in spacy_nlp.pipe_names
+    lemmas = {}
+    n_ambiguous = 0
+    for word in candidates:
+        if tagged:
+            #the same lemma whatever the tag, else the model decides in the query
+            word_lemmas = tag_lemmas(spacy_nlp, word)
+            if len(word_lemmas) == 1:
+                lemmas[word] = word_lemmas.pop()
+            else:
+                n_ambiguous += 1
+        else:
+            #without a tagger the lemma of a word comes from the lookup table, whatever the query
+            lemmas[word] = word_token(spacy_nlp, word).lemma_
+    meta = spacy_nlp.meta
+    with open(os.path.join(folder, VOCAB_NAME), "w", encoding="utf-8") as f:
+        json.dump({"lemmas": lemmas, "model": model,
+                   "model_version": "{}_{}-{}".format(meta.get("lang"), meta.get("name"), meta.get("version"))}, f, ensure_ascii=False)
+    return len(words), len(lemmas), n_ambiguous
+
+
+class QueryTokenizer:
+    """
+    The tokenization of spaCy (v2) from its exported rules: the text is
+    split on whitespace, special cases are kept as given, prefixes and
+    suffixes are split off the other substrings and what remains is split
+    on the infixes. Returns (text, lemma of a special case or None) tuples.
+    """
+
+    def __init__(self, rules):
+        compile_rule = lambda rule: re.compile(rule["pattern"], rule["flags"]) if rule else None
+        self.prefix = compile_rule(rules["prefix"])
+        self.suffix = compile_rule(rules["suffix"])
+        self.infix = compile_rule(rules["infix"])
+        self.token_match = compile_rule(rules["token_match"])
+        self.url_match = compile_rule(rules["url_match"])
+        self.specials = {string: [tuple(token) for token in tokens] for string, tokens in rules["specials"].items()}
+
+    def _find_prefix(self, string):
+        match = self.prefix.search(string) if self.prefix else None
+        return match.end() - match.start() if match else 0
+
+    def _find_suffix(self, string):
+        match = self.suffix.search(string) if self.suffix else None
+        return match.end() - match.start() if match else 0
+
+    def _split_affixes(self, string):
+        prefixes, suffixes = [], []
+        last_size = 0
+        while string and len(string) != last_size:
+            if self.token_match and self.token_match.match(string) and not self._find_prefix(string) and not self._find_suffix(string):
+                break
+            if string in self.specials:
+                break
+            last_size = len(string)
+            pre_len = self._find_prefix(string)
+            if pre_len:
+                prefix, minus_pre = string[:pre_len], string[pre_len:]
+                if minus_pre and minus_pre in self.specials:
+                    prefixes.append(prefix)
+                    string = minus_pre
+                    break
+            suf_len = self._find_suffix(string)
+            if suf_len:
+                suffix, minus_suf = string[-suf_len:], string[:-suf_len]
+                if minus_suf and minus_suf in self.specials:
+                    suffixes.append(suffix)
+                    string = minus_suf
+                    break
+            if pre_len and suf_len and (pre_len + suf_len) <= len(string):
+                string = string[pre_len:-suf_len]
+                prefixes.append(prefix)
+                suffixes.append(suffix)
+            elif pre_len:
+                string = minus_pre
+                prefixes.append(prefix)
+            elif suf_len:
+                string = minus_suf
+                suffixes.append(suffix)
+            if string and string in self.specials:
+                break
+        return prefixes, string, suffixes
+
+    def _attach(self, string, tokens):
+        if string in self.specials:
+            tokens.extend(self.specials[string])
+        elif (self.token_match and self.token_match.match(string)) or (self.url_match and self.url_match.match(string)):
+            tokens.append((string, None))
+        else:
+            start = 0
+            for match in (self.infix.finditer(string) if self.infix else []):
+                if match.start() == 0:
+                    continue
+                if match.start() != start:
+                    tokens.append((string[start:match.start()], None))
+                if match.start() != match.end():
+                    tokens.append((string[match.start():match.end()], None))
+                start = match.end()
+            if string[start:]:
+                tokens.append((string[start:], None))
+
+    def _tokenize(self, string, tokens):
+        if string in self.specials:
+            tokens.extend(self.specials[string])
+            return
+        prefixes, string, suffixes = self._split_affixes(string)
+        tokens.extend((prefix, None) for prefix in prefixes)
+        if string:
+            self._attach(string, tokens)
+        tokens.extend((suffix, None) for suffix in reversed(suffixes))
+
+    def __call__(self, text):
+        tokens = []
+        #runs of whitespace and of other characters, one space after a word belongs to the word
+        for match in re.finditer(r"\s+|\S+", text):
+            span = match.group()
+            if not span.isspace():
+                self._tokenize(span, tokens)
+            elif match.start() > 0 and span[0] == " ":
+                if len(span) > 1:
+                    self._tokenize(span[1:], tokens)
+            else:
+                self._tokenize(span, tokens)
+        return tokens
+
+
+class LightQueryEncoder:
+    """
+    Lemmas and vectors of the queries from a folder written by
+    export_query_model, the same as SpacyQueryEncoder. A query with a word
+    out of the lemma table (its lemma depends on its part of speech, or the
+    word wasn't exported) gets its lemmas from fallback, a SpacyQueryEncoder
+    of the exported model that is loaded in a background thread if not
+    given; its model must be the one exported, else using it raises a
+    ValueError.
+    """
+
+    def __init__(self, folder, fallback=None):
+        with open(os.path.join(folder, TOKENIZER_NAME), encoding="utf-8") as f:
+            self.tokenizer = QueryTokenizer(json.load(f))
+        with open(os.path.join(folder, VOCAB_NAME), encoding="utf-8") as f:
+            vocab = json.load(f)
+        with open(os.path.join(folder, WORDS_NAME), "rb") as f:
+            self.words = f.read()
+        self.word_offsets = np.load(os.path.join(folder, WORD_OFFSETS_NAME), mmap_mode="r")
+        self.word_rows = np.load(os.path.join(folder, WORD_ROWS_NAME), mmap_mode="r")
+        self.lemma_table = vocab["lemmas"]
+        self.model, self.model_version = vocab["model"], vocab["model_version"]
+        self.vectors = np.load(os.path.join(folder, VECTORS_NAME), mmap_mode="r")
+        self.n_fallback_queries = 0
+        self._fallback, self._fallback_error = fallback, None
+        self._fallback_loaded = threading.Event()
+        if fallback is not None:
+            self._fallback_loaded.set()
+        else:
+            threading.Thread(target=self._load_fallback, daemon=True).start()
+
+    def _load_fallback(self):
+        try:
+            spacy_nlp = load_spacy_nlp(self.model)
+            meta = spacy_nlp.meta
+            version = "{}_{}-{}".format(meta.get("lang"), meta.get("name"), meta.get("version"))
+            if version != self.model_version:
+                raise ValueError("The query model was exported from {}, {} is {}".format(self.model_version, self.model, version))
+            self._fallback = SpacyQueryEncoder(spacy_nlp)
+        except Exception as e:
+            self._fallback_error = e
+        self._fallback_loaded.set()
+
+    def fallback(self):
+        #the encoder of the queries with a word of ambiguous lemma, waits for it to be loaded
+        self._fallback_loaded.wait()
+        if self._fallback_error is not None:
+            raise self._fallback_error
+        return self._fallback
+
+    def lemma(self, text, special_lemma=None):
+        #None if the lemma depends on the tag of the word in the query or the word is unknown
+        if special_lemma is not None:
+            return special_lemma
+        return self.lemma_table.get(text)
+
+    def row(self, text):
+        #row of a word in the vector table, None without a vector
+        key = text.encode("utf-8")
+        lo, hi = 0, len(self.word_rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.words[self.word_offsets[mid]:self.word_offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.word_rows) and self.words[self.word_offsets[lo]:self.word_offsets[lo + 1]] == key:
+            return int(self.word_rows[lo])
+        return None
+
+    def vector(self, texts):
+        #mean of the token vectors, tokens without a vector count as zeros, like doc.vector
+        if not texts:
+            return np.zeros(self.vectors.shape[1], dtype=np.float32)
+        total = np.zeros(self.vectors.shape[1], dtype=np.float32)
+        #summed one by one in the order of the tokens, as spaCy does
+        for row in map(self.row, texts):
+            if row is not None:
+                total = total + self.vectors[row]
+        return np.asarray(total / len(texts), dtype=np.float32)
+
+    def encode(self, queries):
+        encoded = []
+        ambiguous = []
+        for nb, query in enumerate(queries):
+            tokens = self.tokenizer(query)
+            lemmas = [self.lemma(text, lemma) for text, lemma in tokens]
+            if None in lemmas:
+                ambiguous.append(nb)
+            encoded.append((None if None in lemmas else ' '.join(lemmas), self.vector([text for text, _ in tokens])))
+        if ambiguous:
+            #the model tags these queries to pick the lemmas, the vectors stay the ones computed here
+            self.n_fallback_queries += len(ambiguous)
+            for nb, (lemmas, _) in zip(ambiguous, self.fallback().encode([queries[nb] for nb in ambiguous])):
+                encoded[nb] = (lemmas, encoded[nb][1])
+        return encoded
+
+
+def check_parity(queries, spacy_encoder, light_encoder, atol=1e-5):
+    #compare the lemma strings and vectors of both encoders, returns the queries that differ;
+    #the queries should be held out of the lemma texts, or the lemma table is checked against itself
+    mismatches = []
+    for query, (spacy_lemmas, spacy_vector), (light_lemmas, light_vector) in zip(queries, spacy_encoder.encode(queries), light_encoder.encode(queries)):
+        vector_diff = float(np.abs(np.asarray(spacy_vector) - light_vector).max()) if len(light_vector) else 0.0
+        if spacy_lemmas != light_lemmas or vector_diff > atol:
+            mismatches.append({"query": query, "spacy": spacy_lemmas, "light": light_lemmas, "vector_diff": vector_diff})
+    return mismatches
+
+def check_encoder(folder, queries, spacy_encoder, max_load_s=1.0):
+    """
+    Checks of the exported query model in folder against spacy_encoder (the
+    model it was exported from) on queries held out of its lemma texts:
+    every lemma string and vector must be the same and LightQueryEncoder
+    must load within max_load_s seconds. Returns the problems found and the
+    light encoder.
+    """
+    problems = []
+    start = time.perf_counter()
+    light_encoder = LightQueryEncoder(folder, fallback=spacy_encoder)
+    load_s = time.perf_counter() - start
+    if load_s > max_load_s:
+        problems.append("the light encoder loaded in {:.2f} s, more than {:.2f} s".format(load_s, max_load_s))
+    if not queries:
+        problems.append("no held-out query to check")
+    mismatches = check_parity(queries, spacy_encoder, light_encoder)
+    if mismatches:
+        problems.append("{} of {} queries differ from spaCy, e.g. {}".format(len(mismatches), len(queries), mismatches[0]))
+    return problems, light_encoder
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the query model and check the light query encoder against spaCy.')
+    parser.add_argument('--folder', type=str, default="query_model", help='Folder of the exported query model. Default query_model')
+    parser.add_argument('--model', type=str, default=MODEL, help='spaCy model the query model is exported from. Default en_core_sci_lg')
+    parser.add_argument('--export', action='store_true', help='Export the query model from --model first')
+    parser.add_argument('--preprocessed', type=str, default=None, help='Output of PreProcess_v19 whose sentences the lemma table is built from. Default None')
+    parser.add_argument('--max_sentences', type=int, default=200000, help='Corpus sentences for the lemma table. Default 200000')
+    parser.add_argument('--lemma_texts', type=str, default=None, help='File with more texts for the lemma table, one per line, e.g. past queries. Default None')
+    parser.add_argument('--queries', type=str, default=None,
+                        help='File with one query per line for the timing and the check, those among the lemma texts are left out of the check. Default: a few sample queries')
+    parser.add_argument('--max_lemma_words', type=int, default=100000, help='Words of the vector table given a lemma. Default 100000')
+    parser.add_argument('--check', action='store_true',
+                        help='Check that the lemmas and vectors of every held-out query are the same as with the spaCy model and that the light encoder loads within --max_load_s, exit with an error otherwise')
+    parser.add_argument('--max_load_s', type=float, default=1.0, help='Load time allowed to the light encoder by --check. Default 1.0')
+    args = parser.parse_args()
+
+    from LoadGenerator import SAMPLE_QUERIES
+    queries = SAMPLE_QUERIES
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    lemma_texts = []
+    if args.preprocessed:
+        lemma_texts += list(corpus_sentences(args.preprocessed, args.max_sentences))
+    if args.lemma_texts:
+        with open(args.lemma_texts, encoding="utf-8") as f:
+            lemma_texts += [line.strip() for line in f if line.strip()]
+    spacy_nlp = None
+    if args.export or args.check:
+        start = time.perf_counter()
+        spacy_nlp = load_spacy_nlp(args.model)
+        print("spaCy model loaded in {:.2f} s".format(time.perf_counter() - start))
+    if args.export:
+        start = time.perf_counter()
+        n_words, n_lemmas, n_ambiguous = export_query_model(args.folder, spacy_nlp, lemma_texts, args.max_lemma_words, model=args.model)
+        print("{} words and {} lemmas ({} words whose lemma depends on their tag) from {} texts exported in {:.1f} s".format(
+            n_words, n_lemmas, n_ambiguous, len(lemma_texts), time.perf_counter() - start))
+    if args.check:
+        #a query the lemma table was built from would only check the table against itself
+        seen = set(lemma_texts)
+        held_out = [query for query in queries if query not in seen]
+        problems, encoder = check_encoder(args.folder, held_out, SpacyQueryEncoder(spacy_nlp), args.max_load_s)
+        print("{} held-out queries checked ({} among the lemma texts left out), {} of them lemmatized by spaCy".format(
+            len(held_out), len(queries) - len(held_out), encoder.n_fallback_queries))
+        print("Checks {}".format("failed: " + "; ".join(problems) if problems else "passed"))
+        raise SystemExit(1 if problems else 0)
+    start = time.perf_counter()
+    encoder = LightQueryEncoder(args.folder)
+    print("light encoder loaded in {:.3f} s".format(time.perf_counter() - start))
+    start = time.perf_counter()
+    encoder.encode(queries)
+    print("{} queries encoded in {:.2f} ms ({} lemmatized by spaCy, loaded in the background)".format(
+        len(queries), (time.perf_counter() - start) * 1000, encoder.n_fallback_queries))
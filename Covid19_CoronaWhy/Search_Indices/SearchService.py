@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+import json, time, threading, argparse, traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from WhooshIndex import open_index, parse_query, search_index
+from VectorIndex import load_annoy_index
+
+# A search service that stays up between queries: the Whoosh index is opened
+# from its directory, the Annoy forest is memory-mapped and both stay warm
+# together with a cache of recent results. The lexical (Whoosh on the lemmas)
+# and the vector (Annoy on the query vector) lookups of a query run at the
+# same time in a thread pool and their hit lists are merged by reciprocal
+# rank fusion. Batches of queries are encoded together. The service can be
+# used as a library or over HTTP (POST /search), where every error is answered
+# with a JSON body.
+RRF_K = 60
+
+
+def rank_fusion(result_lists, k=RRF_K):
+    #reciprocal rank fusion of lists of (paper id, score): sum of 1 / (k + rank) over the lists
+    fused = {}
+    for name, results in result_lists.items():
+        for rank, (paper_id, score) in enumerate(results):
+            hit = fused.setdefault(paper_id, {"paper_id": paper_id, "score": 0.0})
+            hit["score"] += 1.0 / (k + rank + 1)
+            hit[name] = score
+    return sorted(fused.values(), key=lambda hit: -hit["score"])
+
+
+class SearchService:
+    """
+    Hybrid search over a Whoosh index directory and an Annoy forest whose
+    items are the lines of paper_id_list.txt. encoder turns queries into
+    (lemma string, vector), e.g. QueryEncoder.SpacyQueryEncoder. vectors
+    replaces the Annoy forest by another vector index with a search(vector,
+    k) method, e.g. SegmentedIndex.SegmentedIndex.
+    """
+
+    def __init__(self, whoosh_dir, annoy_path, paper_ids_path, encoder, dim=200, metric="angular",
+                 search_k=-1, n_threads=8, cache_size=10000, store=None, vectors=None):
+        self.ix = open_index(whoosh_dir)
+        self.vectors = vectors
+        if vectors is None:
+            self.annoy = load_annoy_index(annoy_path, dim, metric)
+            with open(paper_ids_path, "r") as f:
+                self.paper_ids = [line.strip() for line in f]
+        self.encoder = encoder
+        self.search_k = search_k
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=n_threads)
+        #Whoosh searchers are not shared between threads, each has a lock so that
+        #close_searchers() can close the ones of every thread
+        self._local = threading.local()
+        self._searchers = []
+        self._searchers_lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        self.n_cache_hits = 0
+        self._generation = None
+
+    def _searcher(self):
+        #(searcher, lock) of this thread, a new one once the last was closed
+        entry = getattr(self._local, "searcher", None)
+        if entry is None or entry[0].is_closed:
+            entry = (self.ix.searcher(), threading.Lock())
+            with self._searchers_lock:
+                self._searchers = [other for other in self._searchers if not other[0].is_closed] + [entry]
+            self._local.searcher = entry
+        return entry
+
+    def close_searchers(self):
+        #also the searchers of idle threads, which keep the files of old segments open
+        with self._searchers_lock:
+            searchers, self._searchers = self._searchers, []
+        for searcher, lock in searchers:
+            with lock:
+                searcher.close()
+
+    def lexical(self, lemmas, k):
+        query = parse_query(self.ix, lemmas)
+        while True:
+            searcher, lock = self._searcher()
+            with lock:
+                #closed by close_searchers(), or papers were added since it was opened
+                if not searcher.is_closed and searcher.up_to_date():
+                    return search_index(searcher, query, k)
+                searcher.close()
+
+    def vector(self, vector, k):
+        if self.vectors is not None:
+            return self.vectors.search(vector, k, self.search_k)
+        items, distances = self.annoy.get_nns_by_vector(vector, k, search_k=self.search_k, include_distances=True)
+        return [(self.paper_ids[item], distance) for item, distance in zip(items, distances)]
+
+    def _cached(self, key):
+        with self._cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.n_cache_hits += 1
+                return self.cache[key]
+        return None
+
+    def _remember(self, key, hits):
+        with self._cache_lock:
+            self.cache[key] = hits
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def reload(self):
+        #papers were added: the cached hits may be out of date and the searchers hold the old segments
+        with self._cache_lock:
+            self.cache.clear()
+        self.close_searchers()
+
+    def search_batch(self, queries, k=10, hydrate=False):
+        #fused hits of every query, the lookups of all queries run concurrently
+        generation = getattr(self.vectors, "generation", None)
+        if generation != self._generation:
+            self.reload()
+            self._generation = generation
+        results = [self._cached((query, k)) for query in queries]
+        todo = [nb for nb, hits in enumerate(results) if hits is None]
+        if todo:
+            encoded = self.encoder.encode([queries[nb] for nb in todo])
+            lookups = [(self.executor.submit(self.lexical, lemmas, k), self.executor.submit(self.vector, vector, k))
+                       for lemmas, vector in encoded]
+            for nb, (lexical, vector) in zip(todo, lookups):
+                results[nb] = rank_fusion({"lexical": lexical.result(), "vector": vector.result()})[:k]
+                self._remember((queries[nb], k), results[nb])
+        if hydrate and self.store is not None:
+            results = [self._hydrate(hits) for hits in results]
+        return results
+
+    def search(self, query, k=10, hydrate=False):
+        return self.search_batch([query], k, hydrate)[0]
+
+    def _hydrate(self, hits):
+        docs = self.store.get([hit["paper_id"] for hit in hits])
+        return [dict(hit, text=doc["text"][:300] if doc is not None else None) for hit, doc in zip(hits, docs)]
+
+    def close(self):
+        #the searchers once the lookups running have returned
+        self.executor.shutdown()
+        self.close_searchers()
+
+
+def serve(service, host="127.0.0.1", port=8765):
+    """
+    Answer POST /search with a JSON body {"queries": [...], "k": 10,
+    "hydrate": false} by {"results": [[hit, ...], ...]}, and the errors by
+    {"error": message} with the status 404, 400 (bad request) or 500.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != "/search":
+                self._send_json(404, {"error": "Not found: {}".format(self.path)})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                results = service.search_batch(request["queries"], request.get("k", 10), request.get("hydrate", False))
+                body = {"results": results}
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {"error": "{}: {}".format(type(e).__name__, e)})
+                return
+            except Exception as e:
+                #a failing index or encoder answers this request, the service stays up
+                traceback.print_exc()
+                self._send_json(500, {"error": "{}: {}".format(type(e).__name__, e)})
+                return
+            self._send_json(200, body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print("Search service listening on http://{}:{}/search".format(host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Hybrid Whoosh + Annoy search service for the CORD19 papers.')
+    parser.add_argument('--whoosh_dir', type=str, default="whoosh_index", help='Directory of the Whoosh index. Default whoosh_index')
+    parser.add_argument('--annoy', type=str, default="semantic_search_doc.tree", help='Annoy forest. Default semantic_search_doc.tree')
+    parser.add_argument('--paper_ids', type=str, default="paper_id_list.txt", help='Paper id of each Annoy item. Default paper_id_list.txt')
+    parser.add_argument('--segments', type=str, default=None, help='Root of segmented indices (SegmentedIndex.py), replaces --whoosh_dir, --annoy and --paper_ids. Default None')
+    parser.add_argument('--query_model', type=str, default=None, help='Folder of the light query encoder (QueryEncoder.py --export): the service starts without waiting for en_core_sci_lg, which is loaded in the background for the lemmas the encoder cannot decide. Default None')
+    parser.add_argument('--store', type=str, default=None, help='Document store (DocStore.py) to return the beginning of the hits. Default None')
+    parser.add_argument('--search_k', type=int, default=-1, help='Nodes inspected by Annoy per query. Default -1 (n_trees * k)')
+    parser.add_argument('--n_threads', type=int, default=8, help='Threads for the lookups. Default 8')
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    from QueryEncoder import SpacyQueryEncoder, LightQueryEncoder
+    from DocStore import DocumentStore
+    start = time.perf_counter()
+    vectors = None
+    if args.segments:
+        from SegmentedIndex import SegmentedIndex
+        vectors = SegmentedIndex(args.segments)
+        args.whoosh_dir = vectors.whoosh_dir
+    encoder = LightQueryEncoder(args.query_model) if args.query_model else SpacyQueryEncoder()
+    service = SearchService(args.whoosh_dir, args.annoy, args.paper_ids, encoder, search_k=args.search_k,
+                            n_threads=args.n_threads, store=DocumentStore(args.store) if args.store else None, vectors=vectors)
+    print("Indices and models loaded in {:.1f} s".format(time.perf_counter() - start))
+    serve(service, args.host, args.port)
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+import os, json, time, shutil, argparse, tempfile, threading, multiprocessing
+from collections import namedtuple
+import numpy as np
+from whoosh.index import create_in, open_dir
+from WhooshIndex import SCHEMA
+from VectorIndex import build_annoy_index, load_annoy_index
+
+# Search indices that take new papers without a rebuild. The layout of the
+# root folder:
+#   whoosh/          one Whoosh index, every add commits new segments and
+#                    leaves the existing ones untouched
+#   shard_NNNNN/     a sealed Annoy forest with the vectors it was built from
+#                    (vectors.npy), the paper id of each item (paper_ids.txt)
+#                    and the papers added again without a vector (removed_ids.txt)
+#   delta_NNNNN/     the vectors added since the last shard was sealed, searched
+#                    by brute force until delta_size of them are sealed in a shard
+#   manifest.json    the settings, the live shards, the current delta, the
+#                    retired segments and a generation counter raised by every
+#                    write, so that readers reload only when it has changed
+# A vector query fans out to every shard and the delta and merges their hits,
+# the Whoosh searcher does the same over its segments. A paper added again
+# replaces its older copy. compact() merges the shards (and the Whoosh
+# segments) into one, in a background thread if asked, while the old shards
+# keep answering queries until the manifest is swapped. Segments left out of
+# the manifest are only deleted retire_after seconds later, so that readers of
+# an older manifest in other processes can still open them.
+MANIFEST_NAME = "manifest.json"
+WHOOSH_FOLDER = "whoosh"
+FOREST_NAME = "forest.tree"
+VECTORS_NAME = "vectors.npy"
+IDS_NAME = "paper_ids.txt"
+REMOVED_NAME = "removed_ids.txt"
+
+#what a search needs from one manifest, swapped in as a whole
+Snapshot = namedtuple("Snapshot", ["manifest", "shards", "newest", "stale", "n_papers", "delta_ids", "delta_removed", "delta_vectors"])
+
+
+def read_ids(folder, name=IDS_NAME):
+    path = os.path.join(folder, name)
+    #segments written before removed_ids.txt existed
+    if not os.path.exists(path) and name != IDS_NAME:
+        return []
+    with open(path, encoding="utf-8") as f:
+        paper_ids = f.read()
+    return paper_ids.split("\n") if paper_ids else []
+
+def write_segment(folder, paper_ids, vectors, removed_ids=()):
+    #the vectors and paper ids of a shard or of the delta, written to a temporary folder first
+    tmp = folder + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, VECTORS_NAME), vectors)
+    with open(os.path.join(tmp, IDS_NAME), "w", encoding="utf-8") as f:
+        f.write("\n".join(paper_ids))
+    with open(os.path.join(tmp, REMOVED_NAME), "w", encoding="utf-8") as f:
+        f.write("\n".join(removed_ids))
+    return tmp
+
+def exact_distances(vectors, vector, metric):
+    #the distances Annoy reports for the metric, for dot the dot product (higher is better)
+    if metric == "angular":
+        norms = np.maximum(np.linalg.norm(vectors, axis=1) * np.linalg.norm(vector), 1e-12)
+        return np.sqrt(np.maximum(2 - 2 * (vectors @ vector) / norms, 0))
+    if metric == "euclidean":
+        return np.linalg.norm(vectors - vector, axis=1)
+    return vectors @ vector
+
+
+class SegmentedIndex:
+    """
+    Whoosh segments, Annoy shards and a brute-force delta under one root
+    folder. The settings of an existing root are read from its manifest.
+    search() returns (paper id, distance) like SearchService.vector, ix is
+    the Whoosh index of all segments. One process writes (add_papers,
+    compact), any number of processes can search and pick up the changes
+    with refresh().
+    """
+
+    def __init__(self, root, dim=200, metric="angular", n_trees=50, delta_size=5000, search_k=-1, retire_after=600):
+        self.root = root
+        self.whoosh_dir = os.path.join(root, WHOOSH_FOLDER)
+        self.retire_after = retire_after
+        #adds and compactions of this process change the manifest one at a time
+        self._lock = threading.Lock()
+        #searches of several threads reload the segments once
+        self._refresh_lock = threading.Lock()
+        self._snapshot = None
+        manifest_path = os.path.join(root, MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            os.makedirs(self.whoosh_dir, exist_ok=True)
+            create_in(self.whoosh_dir, SCHEMA)
+            os.replace(write_segment(os.path.join(root, "delta_00000"), [], np.zeros((0, dim), dtype=np.float32)), os.path.join(root, "delta_00000"))
+            self._write_manifest({"dim": dim, "metric": metric, "n_trees": n_trees, "delta_size": delta_size,
+                                  "shards": [], "delta": "delta_00000", "next_segment": 1, "retired": [], "generation": 0})
+        self.ix = open_dir(self.whoosh_dir)
+        self.search_k = search_k
+        #paper ids of the Whoosh index and the index generation they were read at
+        self._whoosh_ids, self._whoosh_generation = set(), None
+        self.refresh()
+
+    def _write_manifest(self, manifest):
+        #manifests written before the counter existed start at 0
+        manifest["generation"] = manifest.get("generation", 0) + 1
+        path = os.path.join(self.root, MANIFEST_NAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def _load(self, manifest, previous=None):
+        #segments are never changed once written: the ones of the previous snapshot are reused
+        loaded = {}
+        if previous is not None:
+            loaded = {shard[0]: shard for shard in previous.shards}
+        shards = []
+        for name in manifest["shards"]:
+            if name not in loaded:
+                folder = os.path.join(self.root, name)
+                loaded[name] = (name, load_annoy_index(os.path.join(folder, FOREST_NAME), manifest["dim"], manifest["metric"]),
+                                read_ids(folder), read_ids(folder, REMOVED_NAME))
+            shards.append(loaded[name])
+        if previous is not None and previous.manifest["delta"] == manifest["delta"]:
+            delta_ids, delta_removed, delta_vectors = previous.delta_ids, previous.delta_removed, previous.delta_vectors
+        else:
+            delta_folder = os.path.join(self.root, manifest["delta"])
+            delta_ids, delta_removed = read_ids(delta_folder), read_ids(delta_folder, REMOVED_NAME)
+            delta_vectors = np.load(os.path.join(delta_folder, VECTORS_NAME))
+        #the newest segment of every paper, None for a paper added again without a vector;
+        #older copies are skipped in the results
+        newest = {}
+        for name, _, paper_ids, removed_ids in shards + [(manifest["delta"], None, delta_ids, delta_removed)]:
+            newest.update((paper_id, None) for paper_id in removed_ids)
+            newest.update((paper_id, name) for paper_id in paper_ids)
+        #items of each shard replaced by a newer copy, a search asks the shard for as many more hits
+        stale = {name: sum(newest[paper_id] != name for paper_id in paper_ids) for name, _, paper_ids, _ in shards}
+        n_papers = sum(name is not None for name in newest.values())
+        return Snapshot(manifest, shards, newest, stale, n_papers, delta_ids, delta_removed, delta_vectors)
+
+    def refresh(self):
+        #open the new shards and delta when the manifest generation has changed, returns True if it had
+        path = os.path.join(self.root, MANIFEST_NAME)
+        with self._refresh_lock:
+            for attempt in range(3):
+                with open(path) as f:
+                    manifest = json.load(f)
+                previous = self._snapshot
+                if previous is not None and manifest.get("generation", 0) == previous.manifest.get("generation", 0):
+                    return False
+                try:
+                    self._snapshot = self._load(manifest, previous)
+                except FileNotFoundError:
+                    #a segment of a manifest read after a long pause was deleted meanwhile, read the new one
+                    if attempt == 2:
+                        raise
+                    continue
+                return True
+
+    def __len__(self):
+        return self._snapshot.n_papers
+
+    @property
+    def generation(self):
+        #raised by every add and compaction
+        self.refresh()
+        return self._snapshot.manifest.get("generation", 0)
+
+    def _known_ids(self, writer):
+        #paper ids in the Whoosh index, read again only if another writer changed it
+        generation = self.ix.latest_generation()
+        if generation != self._whoosh_generation:
+            self._whoosh_ids = set(term.decode("utf-8") for term in writer.reader().lexicon("title"))
+            self._whoosh_generation = generation
+        return self._whoosh_ids
+
+    def _retire(self, manifest, names=()):
+        #delete the segments retired more than retire_after seconds ago and retire names
+        now = time.time()
+        retired = []
+        for name, since in manifest.get("retired", []):
+            if now - since >= self.retire_after:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            else:
+                retired.append([name, since])
+        manifest["retired"] = retired + [[name, now] for name in names]
+
+    def add_papers(self, paper_id_list, list_lemma, list_umls, vectors, procs=1, limitmb=256, lock_timeout=3600):
+        #index new (or updated) papers: new Whoosh segments and the vectors to the delta
+        #the last copy of a paper given twice
+        last = {paper_id: nb for nb, paper_id in enumerate(paper_id_list)}
+        papers = [(paper_id_list[nb], list_lemma[nb], list_umls[nb], vectors[nb]) for nb in sorted(last.values())]
+        writer = self.ix.writer(procs=procs, limitmb=limitmb, multisegment=procs > 1, timeout=lock_timeout)
+        known = self._known_ids(writer)
+        for paper_id, lemmas, umls, _ in papers:
+            #only known papers are looked up in the existing segments to delete their old copy
+            if paper_id in known:
+                writer.update_document(title=paper_id, content=lemmas, umls=umls)
+            else:
+                writer.add_document(title=paper_id, content=lemmas, umls=umls)
+        #merge=False keeps the existing segments as they are, compact() merges them
+        writer.commit(merge=False)
+        known.update(last)
+        self._whoosh_generation = self.ix.latest_generation()
+        with self._lock:
+            self.refresh()
+            snapshot = self._snapshot
+            keep = [nb for nb, paper_id in enumerate(snapshot.delta_ids) if paper_id not in last]
+            #papers without a vector are only in the Whoosh index
+            with_vectors = [(paper_id, vector) for paper_id, _, _, vector in papers if vector is not None]
+            delta_ids = [snapshot.delta_ids[nb] for nb in keep] + [paper_id for paper_id, _ in with_vectors]
+            #and hide the vector of their older copy
+            removed_ids = [paper_id for paper_id in snapshot.delta_removed if paper_id not in last]
+            removed_ids += [paper_id for paper_id, _, _, vector in papers if vector is None and paper_id in snapshot.newest]
+            delta_vectors = snapshot.delta_vectors[keep]
+            if with_vectors:
+                new_vectors = np.asarray([vector for _, vector in with_vectors], dtype=np.float32)
+                if new_vectors.shape[1] != snapshot.manifest["dim"]:
+                    raise ValueError("Vectors of dimension {} for an index of dimension {}".format(new_vectors.shape[1], snapshot.manifest["dim"]))
+                delta_vectors = np.concatenate([delta_vectors, new_vectors])
+            manifest = dict(snapshot.manifest)
+            if len(delta_ids) >= manifest["delta_size"]:
+                #seal the delta in a new shard
+                name = self._next_name(manifest, "shard")
+                self._build_shard(name, delta_ids, delta_vectors, removed_ids)
+                manifest["shards"] = manifest["shards"] + [name]
+                delta_ids, removed_ids, delta_vectors = [], [], delta_vectors[:0]
+            #the new delta is written next to the old one and swapped in with the manifest
+            old_delta, manifest["delta"] = manifest["delta"], self._next_name(manifest, "delta")
+            folder = os.path.join(self.root, manifest["delta"])
+            os.replace(write_segment(folder, delta_ids, delta_vectors, removed_ids), folder)
+            self._retire(manifest, [old_delta])
+            self._write_manifest(manifest)
+            self.refresh()
+
+    def _next_name(self, manifest, kind):
+        manifest["next_segment"] += 1
+        return "{}_{:05d}".format(kind, manifest["next_segment"] - 1)
+
+    def _build_shard(self, name, paper_ids, vectors, removed_ids=()):
+        tmp = write_segment(os.path.join(self.root, name), paper_ids, vectors, removed_ids)
+        build_annoy_index(vectors, self._snapshot.manifest["n_trees"], self._snapshot.manifest["metric"], os.path.join(tmp, FOREST_NAME))
+        os.replace(tmp, os.path.join(self.root, name))
+
+    def search(self, vector, k=10, search_k=None):
+        #(paper id, distance) of the k nearest papers over all shards and the delta
+        self.refresh()
+        snapshot = self._snapshot
+        search_k = self.search_k if search_k is None else search_k
+        hits = []
+        for name, forest, paper_ids, _ in snapshot.shards:
+            #the replaced items found are dropped, the shard is asked for enough hits to make up for them
+            n_hits = min(k + snapshot.stale[name], len(paper_ids))
+            items, distances = forest.get_nns_by_vector(vector, n_hits, search_k=search_k, include_distances=True)
+            hits += [(paper_ids[item], distance) for item, distance in zip(items, distances) if snapshot.newest.get(paper_ids[item]) == name]
+        if len(snapshot.delta_ids):
+            distances = exact_distances(snapshot.delta_vectors, np.asarray(vector, dtype=np.float32), snapshot.manifest["metric"])
+            hits += list(zip(snapshot.delta_ids, distances.tolist()))
+        return sorted(hits, key=lambda hit: -hit[1] if snapshot.manifest["metric"] == "dot" else hit[1])[:k]
+
+    def compact(self, optimize_whoosh=True, lock_timeout=3600):
+        #merge the shards present now into a single shard, dropping replaced papers
+        with self._lock:
+            self.refresh()
+            snapshot = self._snapshot
+            merged = [(name, paper_ids) for name, _, paper_ids, _ in snapshot.shards]
+            #a single shard is rewritten too if it holds replaced papers
+            needed = len(merged) > 1 or any(snapshot.stale.values())
+            if needed:
+                manifest = dict(snapshot.manifest)
+                name = self._next_name(manifest, "shard")
+                self._write_manifest(manifest)
+        if needed:
+            paper_ids, vectors = [], []
+            for old_name, old_ids in merged:
+                keep = [nb for nb, paper_id in enumerate(old_ids) if snapshot.newest.get(paper_id) == old_name]
+                paper_ids += [old_ids[nb] for nb in keep]
+                vectors.append(np.load(os.path.join(self.root, old_name, VECTORS_NAME))[keep])
+            #the slow part runs without the lock, queries use the old shards meanwhile;
+            #the removed papers of the merged shards are left out, so their lists are not needed anymore
+            if paper_ids:
+                self._build_shard(name, paper_ids, np.concatenate(vectors))
+            with self._lock:
+                self.refresh()
+                manifest = dict(self._snapshot.manifest)
+                old_names = [old_name for old_name, _ in merged]
+                #shards sealed during the compaction stay after the merged one
+                manifest["shards"] = [name] * bool(paper_ids) + [shard for shard in manifest["shards"] if shard not in old_names]
+                self._retire(manifest, old_names)
+                self._write_manifest(manifest)
+                self.refresh()
+        if optimize_whoosh:
+            #waits for the writers of add_papers
+            self.ix.writer(timeout=lock_timeout).commit(optimize=True)
+
+    def compact_in_background(self, optimize_whoosh=True, lock_timeout=3600):
+        thread = threading.Thread(target=self.compact, args=(optimize_whoosh, lock_timeout), daemon=True)
+        thread.start()
+        return thread
+
+    def status(self):
+        snapshot = self._snapshot
+        return {"papers": len(self), "shards": {name: len(paper_ids) for name, _, paper_ids, _ in snapshot.shards},
+                "replaced": sum(snapshot.stale.values()), "delta": len(snapshot.delta_ids),
+                "retired": len(snapshot.manifest.get("retired", [])), "whoosh_segments": len(self.ix._segments())}
+
+
+def _check_reader(root, k, stop, results):
+    #searches of another process while the writer adds papers and compacts
+    index = SegmentedIndex(root)
+    rng = np.random.RandomState(1)
+    n_searches, errors, short = 0, [], 0
+    while not stop.is_set():
+        n_papers = len(index)
+        try:
+            hits = index.search(rng.normal(size=index._snapshot.manifest["dim"]), k=k)
+        except Exception as e:
+            errors.append(repr(e))
+            continue
+        n_searches += 1
+        #no paper loses its vector during the check, the index only grows
+        short += len(hits) < min(k, n_papers)
+    results.put((n_searches, errors[:5], short))
+
+def check_index(root, dim=16, k=10, duration=10.0):
+    """
+    Checks of the segmented index in the empty folder root, returns the
+    problems found: a paper re-added without a vector, a shard holding
+    replaced copies, the reuse of the unchanged segments on refresh and a
+    reader process searching while a writer adds papers and compacts.
+    """
+    problems = []
+    rng = np.random.RandomState(0)
+    vectors = rng.normal(size=(600, dim)).astype(np.float32)
+    paper_ids = ["paper_{}".format(nb) for nb in range(len(vectors))]
+
+    #re-added twice without a vector: one Whoosh document, no vector hit
+    index = SegmentedIndex(os.path.join(root, "readd"), dim=dim, delta_size=100)
+    index.add_papers(paper_ids[:50], ["lemma"] * 50, ["umls"] * 50, list(vectors[:50]))
+    for _ in range(2):
+        index.add_papers(paper_ids[:1], ["lemma"], ["umls"], [None])
+    with index.ix.searcher() as searcher:
+        n_documents = len(list(searcher.documents(title=paper_ids[0])))
+    if n_documents != 1:
+        problems.append("{} Whoosh documents for a paper added three times".format(n_documents))
+    if paper_ids[0] in [paper_id for paper_id, _ in index.search(vectors[0], k=k)]:
+        problems.append("the vector of a paper re-added without one is still found")
+
+    #a shard of 300 papers, 90 of them replaced by a newer vector in the delta
+    index = SegmentedIndex(os.path.join(root, "replaced"), dim=dim, delta_size=300, search_k=100000)
+    index.add_papers(paper_ids[:300], ["lemma"] * 300, ["umls"] * 300, list(vectors[:300]))
+    index.add_papers(paper_ids[:90], ["lemma"] * 90, ["umls"] * 90, list(vectors[300:390]))
+    live = np.concatenate([vectors[300:390], vectors[90:300]])
+    live_ids = paper_ids[:300]
+    recalls = []
+    for query in vectors[400:450]:
+        truth = set(live_ids[nb] for nb in np.argsort(exact_distances(live, query, "angular"))[:k])
+        hits = [paper_id for paper_id, _ in index.search(query, k=k)]
+        if len(hits) != k:
+            problems.append("{} hits instead of {} with replaced papers in a shard".format(len(hits), k))
+            break
+        recalls.append(len(truth.intersection(hits)) / k)
+    if recalls and min(recalls) < 1.0:
+        problems.append("recall {:.2f} instead of 1.0 with replaced papers in a shard".format(min(recalls)))
+
+    #a reader opens only the segments that changed: the sealed shard is reused
+    reader = SegmentedIndex(os.path.join(root, "replaced"))
+    generation, forest = reader.generation, reader._snapshot.shards[0][1]
+    index.add_papers(paper_ids[390:391], ["lemma"], ["umls"], list(vectors[390:391]))
+    if reader.generation != generation + 1:
+        problems.append("the generation went from {} to {} after one add".format(generation, reader.generation))
+    if reader._snapshot.shards[0][1] is not forest:
+        problems.append("an unchanged shard was loaded again on refresh")
+    if reader.refresh():
+        problems.append("refresh reloaded an unchanged manifest")
+
+    #a reader process searching while this one adds papers and compacts, segments deleted right away
+    folder = os.path.join(root, "concurrent")
+    index = SegmentedIndex(folder, dim=dim, delta_size=50, retire_after=0)
+    index.add_papers(paper_ids[:k], ["lemma"] * k, ["umls"] * k, list(vectors[:k]))
+    stop, results = multiprocessing.Event(), multiprocessing.Queue()
+    process = multiprocessing.Process(target=_check_reader, args=(folder, k, stop, results))
+    process.start()
+    start, nb = time.perf_counter(), k
+    while time.perf_counter() - start < duration:
+        batch = [nb % len(vectors) for nb in range(nb, nb + 20)]
+        nb += 20
+        index.add_papers([paper_ids[b] for b in batch], ["lemma"] * 20, ["umls"] * 20, [vectors[b] for b in batch])
+        if nb % 200 == 0:
+            index.compact(optimize_whoosh=False)
+    stop.set()
+    n_searches, errors, short = results.get()
+    process.join()
+    if errors:
+        problems.append("{} errors in the searches of the reader: {}".format(len(errors), "; ".join(errors)))
+    if short:
+        problems.append("{} of {} searches of the reader returned fewer than {} papers".format(short, n_searches, k))
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Status and compaction of segmented search indices.')
+    parser.add_argument('--root', type=str, default="segmented_index", help='Root folder of the indices. Default segmented_index')
+    parser.add_argument('--compact', action='store_true', help='Merge the shards and the Whoosh segments')
+    parser.add_argument('--check', action='store_true', help='Run the checks of check_index in a temporary folder instead, exit with an error if one fails')
+    args = parser.parse_args()
+
+    if args.check:
+        temp_dir = tempfile.mkdtemp(prefix="segmented_index_check_")
+        problems = check_index(temp_dir)
+        shutil.rmtree(temp_dir)
+        print("Checks {}".format("failed: " + "; ".join(problems) if problems else "passed"))
+        raise SystemExit(1 if problems else 0)
+
+    if not os.path.exists(os.path.join(args.root, MANIFEST_NAME)):
+        raise FileNotFoundError("No segmented index in {}".format(args.root))
+    index = SegmentedIndex(args.root)
+    print(index.status())
+    if args.compact:
+        start = time.perf_counter()
+        index.compact()
+        print("compacted in {:.1f} s".format(time.perf_counter() - start))
+        print(index.status())
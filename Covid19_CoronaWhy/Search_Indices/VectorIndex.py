@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os, time, argparse, tempfile
+import numpy as np
+
+# Building and querying the Annoy forest of the document vectors. n_trees
+# (build), search_k (query) and the metric are parameters instead of being
+# hard-coded, and benchmark() compares the Annoy hits with an exact search
+# over the same vectors (a single matrix product in NumPy) to report the
+# recall@k, the build time, the size of the forest and the latency per query
+# of each setting.
+METRICS = ["angular", "euclidean", "dot"]
+
+
+def build_annoy_index(vectors, n_trees=50, metric="angular", path=None, n_jobs=-1):
+    #add the vectors as items 0..n-1 and build the forest, saved to path if given
+    from annoy import AnnoyIndex
+    index = AnnoyIndex(len(vectors[0]), metric)
+    for nb, x in enumerate(vectors):
+        index.add_item(nb, x)
+    index.build(n_trees, n_jobs=n_jobs)
+    if path is not None:
+        index.save(path)
+    return index
+
+def load_annoy_index(path, dim=200, metric="angular"):
+    from annoy import AnnoyIndex
+    index = AnnoyIndex(dim, metric)
+    index.load(path)
+    return index
+
+def search_annoy(index, query_vectors, k=10, search_k=-1):
+    #item ids of the k nearest neighbours of each query, search_k=-1 inspects n_trees * k nodes
+    return [index.get_nns_by_vector(vector, k, search_k=search_k) for vector in query_vectors]
+
+def exact_search(doc_vectors, query_vectors, k=10, metric="angular"):
+    #item ids of the true k nearest neighbours of each query, best first
+    doc_vectors = np.asarray(doc_vectors, dtype=np.float32)
+    query_vectors = np.asarray(query_vectors, dtype=np.float32)
+    if metric == "angular":
+        #angular distance is monotonic in the cosine similarity
+        doc_norms = np.linalg.norm(doc_vectors, axis=1, keepdims=True)
+        query_norms = np.linalg.norm(query_vectors, axis=1, keepdims=True)
+        scores = (query_vectors / np.maximum(query_norms, 1e-12)) @ (doc_vectors / np.maximum(doc_norms, 1e-12)).T
+    elif metric == "euclidean":
+        #-|q - d|^2 without the |q|^2 term, which is constant per query
+        scores = 2 * query_vectors @ doc_vectors.T - (doc_vectors ** 2).sum(axis=1)
+    elif metric == "dot":
+        scores = query_vectors @ doc_vectors.T
+    else:
+        raise ValueError("Unknown metric {}, expected one of {}".format(metric, METRICS))
+    k = min(k, doc_vectors.shape[0])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+def recall_at_k(found, truth):
+    #share of the true neighbours found, averaged over the queries
+    return float(np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth) if len(t)]))
+
+def benchmark(doc_vectors, query_vectors, k=10, n_trees_list=(10, 50, 100), search_k_list=(10, -1), metric="angular", n_jobs=-1):
+    #one result per (n_trees, search_k), a negative search_k -m stands for m * n_trees * k
+    truth = exact_search(doc_vectors, query_vectors, k, metric).tolist()
+    start = time.perf_counter()
+    exact_search(doc_vectors, query_vectors, k, metric)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_trees in n_trees_list:
+            path = os.path.join(tmp, "forest_{}.tree".format(n_trees))
+            start = time.perf_counter()
+            index = build_annoy_index(doc_vectors, n_trees, metric, path, n_jobs)
+            build_s = time.perf_counter() - start
+            size_mb = os.path.getsize(path) / 2 ** 20
+            for search_k in search_k_list:
+                search_k = n_trees * k * -search_k if search_k < 0 else search_k
+                start = time.perf_counter()
+                found = search_annoy(index, query_vectors, k, search_k)
+                query_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+                results.append({"n_trees": n_trees, "search_k": search_k, "recall": recall_at_k(found, truth),
+                                "build_s": build_s, "size_mb": size_mb, "query_ms": query_ms})
+            index.unload()
+    return results, exact_ms
+
+def print_benchmark(results, exact_ms, k, n_docs):
+    print("{} documents, recall@{} against the exact search ({:.3f} ms/query)".format(n_docs, k, exact_ms))
+    print("{:>8} {:>9} {:>9} {:>10} {:>9} {:>9}".format("n_trees", "search_k", "recall", "build s", "size MB", "ms/query"))
+    for r in results:
+        print("{n_trees:>8} {search_k:>9} {recall:>9.3f} {build_s:>10.2f} {size_mb:>9.1f} {query_ms:>9.3f}".format(**r))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recall and latency of Annoy settings against the exact search.')
+    parser.add_argument('--vectors', type=str, default=None, help='.npy file with the document vectors. Default: random clustered vectors')
+    parser.add_argument('--n_docs', type=int, default=50000, help='Number of random vectors without --vectors. Default 50000')
+    parser.add_argument('--dim', type=int, default=200)
+    parser.add_argument('--n_queries', type=int, default=1000, help='Vectors held out of the index as queries. Default 1000')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--metric', type=str, choices=METRICS, default="angular")
+    parser.add_argument('--n_trees', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('--search_k', type=int, nargs='+', default=[10, -1, -4],
+                        help='Nodes inspected per query, a negative value -m means m * n_trees * k. Default 10 -1 -4')
+    parser.add_argument('--n_jobs', type=int, default=-1, help='Threads to build the forest. Default -1 (all cores)')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    if args.vectors:
+        vectors = np.load(args.vectors).astype(np.float32)
+    else:
+        n_vectors = args.n_docs + args.n_queries
+        centers = rng.normal(size=(n_vectors // 100 + 1, args.dim))
+        vectors = (centers[rng.randint(len(centers), size=n_vectors)] + rng.normal(scale=1.0, size=(n_vectors, args.dim))).astype(np.float32)
+    #the queries are held out from the indexed documents
+    rows = rng.permutation(len(vectors))
+    query_vectors, doc_vectors = vectors[rows[:args.n_queries]], vectors[rows[args.n_queries:]]
+    results, exact_ms = benchmark(doc_vectors, query_vectors, args.k, args.n_trees, args.search_k, args.metric, args.n_jobs)
+    print_benchmark(results, exact_ms, args.k, len(doc_vectors))
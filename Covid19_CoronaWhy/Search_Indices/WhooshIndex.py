@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import os
+from whoosh.index import create_in, open_dir, exists_in
+from whoosh.fields import Schema, ID, TEXT
+from whoosh.qparser import MultifieldParser, OrGroup
+
+# The Whoosh index of the papers lives in its own directory and is opened from
+# there, instead of being pickled: "title" holds the paper id, "content" the
+# lemmas and "umls" the UMLS terms of the paper.
+SCHEMA = Schema(title=ID(stored=True, unique=True), content=TEXT, umls=TEXT)
+SEARCH_FIELDS = ["title", "content", "umls"]
+
+
+def index_texts(index_dir, paper_id_list, list_lemma, list_umls, procs=1, limitmb=256):
+    #write the papers to a new index in index_dir, the lemmas and UMLS terms as space separated strings
+    return index_papers(index_dir, zip(paper_id_list, list_lemma, list_umls), procs, limitmb)
+
+def index_papers(index_dir, papers, procs=1, limitmb=256):
+    #same from an iterable of (paper id, lemmas, umls), e.g. a generator over the corpus
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    ix = create_in(index_dir, SCHEMA)
+    #with procs > 1 the documents are analysed by procs writer processes
+    writer = ix.writer(procs=procs, limitmb=limitmb, multisegment=procs > 1)
+    for paper_id, lemmas, umls in papers:
+        writer.add_document(title=paper_id, content=lemmas, umls=umls)
+    writer.commit()
+    return ix
+
+def open_index(index_dir):
+    if not exists_in(index_dir):
+        raise FileNotFoundError("No Whoosh index in {}".format(index_dir))
+    return open_dir(index_dir)
+
+def parse_query(ix, search_query):
+    return MultifieldParser(SEARCH_FIELDS, ix.schema, group=OrGroup).parse(search_query)
+
+def search_index(searcher, query, max_nb_docs):
+    #(paper id, score) of the best max_nb_docs papers
+    return [(hit["title"], hit.score) for hit in searcher.search(query, limit=max_nb_docs)]